@@ -1,6 +1,6 @@
 # file: app.py
 
-from flask import Flask, request, render_template, send_file, redirect, url_for, session, jsonify, flash
+from flask import Flask, request, render_template, send_file, redirect, url_for, session, jsonify, flash, Response
 import subprocess
 import json
 import os
@@ -10,74 +10,686 @@ import time
 import re
 from datetime import datetime
 import random
+import itertools
+import math
 import yt_dlp
 import logging
+import logging.handlers
+import queue
+import atexit
 from datetime import timedelta
 import traceback
+import shutil
+import hashlib
+import struct
+import zlib
+import hmac
+import errno
+import urllib.parse
+import urllib.request
+import urllib.error
+import http.client
+import socket
+import ipaddress
+import argparse
+import asyncio
+import signal
+from collections import OrderedDict
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
+import library_worker
 
 # Load environment variables from .env file if it exists
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
-)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # "text", or "json" for one structured record per line
+LOG_PROGRESS_SAMPLE = int(os.environ.get('LOG_PROGRESS_SAMPLE', 20))  # log every Nth yt-dlp progress line of a job, 0 for none
+LOG_OUTPUT_LINES_PER_SECOND = float(os.environ.get('LOG_OUTPUT_LINES_PER_SECOND', 5))  # per-job cap on logged yt-dlp output
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, including the job fields of per-job records"""
+    
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('download_id', 'event'):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves all formatting to the listener thread.
+    
+    Records never leave the process, so unlike the stock QueueHandler there is
+    no need to render the message on the thread that logged it.
+    """
+    
+    def prepare(self, record):
+        return record
+
+# Logging setup. Threads only put records on a queue, formatting and writing
+# happen on the listener's background thread (started by initialize_app).
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else
+                                logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler, respect_handler_level=True)
+# Before the Flask app exists, so Flask does not add a handler of its own to app.logger
+logging.basicConfig(level=LOG_LEVEL, handlers=[DeferredQueueHandler(log_queue)])
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
-app.logger.setLevel(logging.INFO)
+app.logger.setLevel(LOG_LEVEL)
 DOWNLOAD_FOLDER = "downloads"
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+
+# Storage tiers and their root directories. Finished files ("media") are spread
+# over hash-sharded subdirectories so no single directory grows too large.
+STORAGE_ROOTS = {
+    'media': os.environ.get('STORAGE_ROOT_MEDIA', DOWNLOAD_FOLDER),
+    'staging': os.environ.get('STORAGE_ROOT_STAGING', os.path.join(DOWNLOAD_FOLDER, ".staging")),
+    'cache': os.environ.get('STORAGE_ROOT_CACHE', os.path.join(DOWNLOAD_FOLDER, ".streamcache")),
+}
+STORAGE_SHARD_LEVELS = int(os.environ.get('STORAGE_SHARD_LEVELS', 2))  # 0 keeps a flat directory
 
 # Get YouTube credentials from environment variables
 YOUTUBE_USERNAME = os.environ.get('YOUTUBE_USERNAME')
 YOUTUBE_PASSWORD = os.environ.get('YOUTUBE_PASSWORD')
 YOUTUBE_COOKIES = os.environ.get('YOUTUBE_COOKIES')
 
-# Log if credentials are available (without revealing them)
-if YOUTUBE_USERNAME and YOUTUBE_PASSWORD:
-    app.logger.info("YouTube credentials found in environment variables")
-    USE_YOUTUBE_AUTH = True
-else:
-    app.logger.warning("No YouTube credentials found in environment variables")
-    USE_YOUTUBE_AUTH = False
+USE_YOUTUBE_AUTH = bool(YOUTUBE_USERNAME and YOUTUBE_PASSWORD)
 
 # Check for cookies file
 COOKIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookies.txt")
-if os.path.exists(COOKIES_FILE):
-    app.logger.info(f"YouTube cookies file found at {COOKIES_FILE}")
-    USE_YOUTUBE_COOKIES = True
-elif YOUTUBE_COOKIES:
-    app.logger.info("YouTube cookies found in environment variables but will not be used")
-    USE_YOUTUBE_COOKIES = False
-else:
-    app.logger.warning("No YouTube cookies found")
-    USE_YOUTUBE_COOKIES = False
+USE_YOUTUBE_COOKIES = os.path.exists(COOKIES_FILE)
+
+# Pool of identities (cookie files *.txt, credentials *.json) that jobs are spread over.
+# When the directory is empty, cookies.txt / the environment credentials above are used.
+IDENTITY_DIR = os.environ.get('COOKIES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookies"))
+IDENTITY_MAX_CONCURRENT = int(os.environ.get('IDENTITY_MAX_CONCURRENT', 2))  # yt-dlp runs per identity
+IDENTITY_WAIT_TIMEOUT = int(os.environ.get('IDENTITY_WAIT_TIMEOUT', 30))  # then exceed the limit
+IDENTITY_HEALTH_ALPHA = float(os.environ.get('IDENTITY_HEALTH_ALPHA', 0.3))
+IDENTITY_QUARANTINE_HEALTH = float(os.environ.get('IDENTITY_QUARANTINE_HEALTH', 0.5))
+IDENTITY_QUARANTINE_SECONDS = int(os.environ.get('IDENTITY_QUARANTINE_SECONDS', 900))
+IDENTITY_RELOAD_INTERVAL = int(os.environ.get('IDENTITY_RELOAD_INTERVAL', 10))  # Seconds between directory scans
+# Error classes (see DOWNLOAD_ERROR_CLASSES) that count against the identity a run used
+IDENTITY_FAILURE_CLASSES = ('anti_bot', 'cookies', 'forbidden', 'precondition_failed')
+identity_pool = {}  # file name -> identity state
+identity_condition = threading.Condition()
+identity_scan = {'scanned_at': 0.0}
+
+# Egress proxies (http://, https://, socks5://...; "direct" for the host's own address) that yt-dlp runs are routed over
+PROXY_POOL = [entry.strip() for entry in os.environ.get('PROXY_POOL', '').split(',') if entry.strip()]
+PROXY_MAX_CONCURRENT = int(os.environ.get('PROXY_MAX_CONCURRENT', 4))  # yt-dlp runs per proxy
+PROXY_WAIT_TIMEOUT = int(os.environ.get('PROXY_WAIT_TIMEOUT', 30))  # then exceed the limit
+PROXY_EWMA_ALPHA = float(os.environ.get('PROXY_EWMA_ALPHA', 0.3))
+PROXY_MAX_ERROR_RATE = float(os.environ.get('PROXY_MAX_ERROR_RATE', 0.5))  # ejected above this
+PROXY_EJECT_SECONDS = int(os.environ.get('PROXY_EJECT_SECONDS', 300))
+PROXY_PRIOR_LATENCY = 5.0  # Seconds assumed for an extraction until a proxy has been measured
+# Error classes that say something about the route rather than the video or the identity
+PROXY_FAILURE_CLASSES = ('anti_bot', 'forbidden', 'network', 'throttled', 'timeout')
+proxy_pool = [{'url': entry, 'active': 0, 'throughput': None, 'latency': None, 'error_rate': 0.0,
+               'ejected_until': 0, 'runs': 0, 'failures': 0} for entry in PROXY_POOL]
+proxy_condition = threading.Condition()
 
 # Store download progress information
 download_progress = {}
 
-# Check if yt-dlp command line is available
-try:
-    result = subprocess.run(["yt-dlp", "--version"], capture_output=True, text=True, timeout=5)
-    if result.returncode == 0:
-        app.logger.info(f"yt-dlp command line is available, version: {result.stdout.strip()}")
-        USE_YTDLP_COMMAND = True
-    else:
+# Job versions for POST /api/status. Every change to a job record takes the next
+# number of one counter, so a job's version only grows.
+STATUS_MAX_JOBS = int(os.environ.get('STATUS_MAX_JOBS', 1000))  # Job ids per /api/status request
+STATUS_MAX_WAIT = float(os.environ.get('STATUS_MAX_WAIT', 30))  # Longest long-poll in seconds
+STATUS_MAX_WAITERS = int(os.environ.get('STATUS_MAX_WAITERS', 4))  # Long-polls holding a server thread at once
+STATUS_RETRY_AFTER = int(os.environ.get('STATUS_RETRY_AFTER', 2))  # Seconds a long-poll turned away should back off
+UNVERSIONED_JOB_FIELDS = frozenset(('last_updated', 'version'))  # Bookkeeping that is not a change
+job_versions = itertools.count(1)
+job_status_condition = threading.Condition()
+job_status_generation = 0  # Bumped on every change while long-polls are waiting
+job_status_waiters = 0
+
+class JobRecord(dict):
+    """A download_progress entry that takes a new version whenever one of its fields changes"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bump()
+    
+    def bump(self):
+        dict.__setitem__(self, 'version', next(job_versions))
+        if job_status_waiters:
+            notify_job_watchers()
+    
+    def __setitem__(self, key, value):
+        # Runs for every progress line, so the check is kept inline
+        changed = key not in UNVERSIONED_JOB_FIELDS and (key not in self or self[key] != value)
+        dict.__setitem__(self, key, value)
+        if changed:
+            self.bump()
+    
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.bump()
+    
+    def update(self, *args, **kwargs):
+        fields = dict(*args, **kwargs)
+        changed = False
+        for key, value in fields.items():
+            if key not in UNVERSIONED_JOB_FIELDS and (key not in self or self[key] != value):
+                changed = True
+                break
+        dict.update(self, fields)
+        if changed:
+            self.bump()
+    
+    def pop(self, key, *default):
+        changed = key in self
+        value = super().pop(key, *default)
+        if changed:
+            self.bump()
+        return value
+
+def notify_job_watchers():
+    """Wake the waiting /api/status long-polls after a job changed or went away"""
+    global job_status_generation
+    if job_status_waiters:
+        with job_status_condition:
+            job_status_generation += 1
+            job_status_condition.notify_all()
+
+# Bundles: finished files that are downloaded together as one ZIP streamed on the fly
+BUNDLE_TTL = int(os.environ.get('BUNDLE_TTL', 3600))  # Seconds a bundle link stays valid
+BUNDLE_MAX_FILES = int(os.environ.get('BUNDLE_MAX_FILES', 500))
+BUNDLE_CHUNK_SIZE = 1024 * 1024  # Bytes read from a file at a time
+ZIP64_LIMIT = 0xFFFFFFFF  # Sizes and offsets from here on need ZIP64 fields
+bundles = {}  # bundle id -> {'files': [(archive name, path)], 'created': timestamp}
+bundles_lock = threading.Lock()
+
+# Download and post-processing run as separate stages with their own limits:
+# downloads are network-bound, merges and encodes are CPU-bound.
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 16))
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS', os.cpu_count() or 2))
+POSTPROCESS_TIMEOUT = int(os.environ.get('POSTPROCESS_TIMEOUT', 3600))  # 1 hour
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+postprocess_queue = []  # Pending post-processing jobs, oldest first
+postprocess_condition = threading.Condition()
+postprocess_workers = []
+
+# Job runner for downloads: "thread" runs each job on its own thread, "async"
+# supervises all yt-dlp processes from a single asyncio event loop
+JOB_RUNNER = os.environ.get('JOB_RUNNER', 'thread')
+DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', 6 * 3600))  # 6 hours
+async_loop = None
+async_loop_lock = threading.Lock()
+async_jobs = {}  # download_id -> future of the running coroutine
+child_processes = {}  # yt-dlp/ffmpeg process started by a thread -> download_id, so shutdown can stop it
+child_processes_lock = threading.Lock()
+CHILD_STOP_TIMEOUT = 10  # Seconds child processes get to exit on shutdown before they are killed
+
+# Without the yt-dlp command line, extraction and downloads use the library in a
+# pool of worker processes so they do not compete with requests for the GIL
+LIBRARY_WORKERS = int(os.environ.get('LIBRARY_WORKERS', min(4, os.cpu_count() or 1)))  # 0 runs them in-process
+LIBRARY_MAX_TASKS_PER_CHILD = int(os.environ.get('LIBRARY_MAX_TASKS_PER_CHILD', 25))  # recycle workers to contain leaks
+LIBRARY_CANCEL_POLL = 1  # Seconds between checks whether a job waiting on the pool was cancelled
+library_pool = None
+library_pool_lock = threading.Lock()
+library_progress_queue = None  # Shared by every pool, so a replaced pool leaves no relay thread behind
+library_slots = None  # One per worker; tasks wait for a slot here, where a cancelled job can still drop out
+
+# Download slots are handed out by a fair scheduler instead of first come, first
+# served: waiting jobs are queued per client (API key, otherwise IP address) and
+# the queues are served by deficit round-robin, weighted per API key.
+CLIENT_MAX_ACTIVE_DOWNLOADS = int(os.environ.get('CLIENT_MAX_ACTIVE_DOWNLOADS', 4))
+CLIENT_MAX_QUEUED_JOBS = int(os.environ.get('CLIENT_MAX_QUEUED_JOBS', 16))
+API_KEYS = {}  # API key -> scheduling weight, from API_KEYS="key1:4,key2"
+for api_key_entry in os.environ.get('API_KEYS', '').split(','):
+    api_key, _, api_key_weight = api_key_entry.strip().partition(':')
+    if api_key:
+        API_KEYS[api_key] = float(api_key_weight or 1)
+        # The round-robin credits a client its weight per turn, so it must be able to reach a full slot
+        if not math.isfinite(API_KEYS[api_key]) or API_KEYS[api_key] <= 0:
+            raise ValueError(f"API_KEYS: the weight of an API key must be a positive number, got '{api_key_weight}'")
+scheduler_lock = threading.Lock()
+scheduler_clients = OrderedDict()  # client -> queue state, in round-robin order
+slot_holders = {}  # download_id -> client, for every job holding a download slot
+
+# Order of the jobs waiting within a client's queue: "fifo", or "sjf" (smallest
+# estimated download first, with waiting time credited so big jobs still get through)
+SCHEDULER_POLICY = os.environ.get('SCHEDULER_POLICY', 'fifo')
+SJF_AGING_BYTES_PER_SECOND = float(os.environ.get('SJF_AGING_BYTES_PER_SECOND', 5 * 1024 * 1024))
+SJF_UNKNOWN_SIZE = int(os.environ.get('SJF_UNKNOWN_SIZE', 256 * 1024 * 1024))  # assumed size when there is no estimate
+job_clients = {}  # download_id -> client
+
+# Disk space admission: a job gets its download slot only once the space its output
+# needs is reserved, so a filling volume holds new jobs instead of failing them halfway
+DISK_RESERVE_FACTOR = float(os.environ.get('DISK_RESERVE_FACTOR', 2.2))  # reserved bytes per estimated output byte, 0 disables
+DISK_UNKNOWN_SIZE = int(os.environ.get('DISK_UNKNOWN_SIZE', 1024 * 1024 * 1024))  # assumed output size when there is no estimate
+DISK_QUOTA_BYTES = int(os.environ.get('DISK_QUOTA_BYTES', 0))  # most bytes the storage roots may hold, 0 for no quota
+DISK_RECHECK_INTERVAL = 5  # Seconds between admission checks while jobs are held for disk space
+DISK_USAGE_MAX_AGE = 10  # Seconds a measurement of the storage roots' size is reused
+disk_reservations = {}  # download_id -> reserved bytes, from the download slot until the job finishes
+# The last measurement of the storage, taken outside scheduler_lock and adjusted as jobs finish
+disk_usage_cache = {'bytes': 0, 'free': 0, 'written': {}, 'measured': 0.0, 'stale': False, 'failed': False, 'releases': 0}
+disk_measure_lock = threading.Lock()  # One measurement at a time
+disk_stats = {'holds': 0, 'finished': 0, 'reserved_bytes': 0, 'output_bytes': 0}
+
+# Cache of raw elementary streams keyed by (video id, format id), so a stream
+# shared by several outputs (e.g. the audio of 720p, 1080p and MP3) is fetched once
+STREAM_CACHE_MAX_BYTES = int(os.environ.get('STREAM_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024))  # 0 disables
+STREAM_CACHE_TTL = int(os.environ.get('STREAM_CACHE_TTL', 6 * 3600))  # retention window in seconds
+stream_cache = OrderedDict()  # (video_id, format_id) -> entry, least recently used first
+stream_cache_lock = threading.Lock()
+stream_cache_pending = set()  # Keys whose files are being copied into the cache
+stream_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0, 'bytes_served': 0}
+
+# Speculation: extract a URL as soon as it is pasted on the start page ("extract"),
+# and also fetch the preselected choice's streams into the stream cache at a
+# capped rate while the selection page is open ("warm"). Off by default.
+SPECULATION = os.environ.get('SPECULATION', 'off')  # "off", "extract" or "warm"
+SPECULATION_TTL = int(os.environ.get('SPECULATION_TTL', 300))  # Seconds speculative work waits to be used
+SPECULATION_MAX_EXTRACTIONS = int(os.environ.get('SPECULATION_MAX_EXTRACTIONS', 2))  # running at the same time
+SPECULATION_MAX_WARMING = int(os.environ.get('SPECULATION_MAX_WARMING', 2))  # warming downloads at the same time
+SPECULATION_RATE_LIMIT = int(os.environ.get('SPECULATION_RATE_LIMIT', 2 * 1024 * 1024))  # bytes per second per warming download
+SPECULATION_MAX_BYTES = int(os.environ.get('SPECULATION_MAX_BYTES', 512 * 1024 * 1024))  # larger choices are not warmed
+SPECULATION_MAX_ENTRIES = 32  # Unclaimed extractions kept at once (info dicts are large)
+speculative_extractions = {}  # url -> {'future': Future of the info dict, 'started': timestamp}
+speculative_warming = {}  # selection token -> warming state, see start_warming
+speculation_lock = threading.Lock()
+speculation_stats = {'extractions': 0, 'extraction_hits': 0, 'extraction_misses': 0, 'extractions_unused': 0,
+                     'warmings': 0, 'warm_hits': 0, 'warm_misses': 0, 'bytes_fetched': 0, 'bytes_used': 0,
+                     'bytes_wasted': 0}
+speculation_executor = ThreadPoolExecutor(max_workers=max(1, SPECULATION_MAX_EXTRACTIONS),
+                                          thread_name_prefix='speculate')
+
+# Rolling estimates of what this node actually achieves, in bytes per second:
+# "download" from yt-dlp's progress output, "remux" and "encode" from ffmpeg runs.
+# They predict how long each download choice takes. The priors are used until
+# the first measurement comes in.
+THROUGHPUT_EWMA_ALPHA = float(os.environ.get('THROUGHPUT_EWMA_ALPHA', 0.3))  # weight of the newest sample
+THROUGHPUT_MIN_SAMPLE_BYTES = 1024 * 1024  # smaller transfers are dominated by setup time
+THROUGHPUT_PRIORS = {
+    'download': float(os.environ.get('THROUGHPUT_PRIOR_DOWNLOAD', 4 * 1024 * 1024)),
+    'remux': float(os.environ.get('THROUGHPUT_PRIOR_REMUX', 100 * 1024 * 1024)),
+    'encode': float(os.environ.get('THROUGHPUT_PRIOR_ENCODE', 1024 * 1024)),
+}
+throughput_estimates = {}  # kind -> {'rate': bytes per second, 'samples': count, 'updated': timestamp}
+throughput_lock = threading.Lock()
+
+# Health checks. The expensive end-to-end extractor test runs in the background
+# and /check_ytdlp only serves its last result.
+SELF_TEST_URL = os.environ.get('SELF_TEST_URL', "https://www.youtube.com/watch?v=dQw4w9WgXcQ")  # A well-known video that's unlikely to be taken down
+SELF_TEST_INTERVAL = int(os.environ.get('SELF_TEST_INTERVAL', 1800))  # 0 disables the self-test
+READY_MAX_ACTIVE_JOBS = int(os.environ.get('READY_MAX_ACTIVE_JOBS', MAX_CONCURRENT_DOWNLOADS * 4))
+READY_MAX_POSTPROCESS_QUEUE = int(os.environ.get('READY_MAX_POSTPROCESS_QUEUE', POSTPROCESS_WORKERS * 4))
+READY_MIN_FREE_BYTES = int(os.environ.get('READY_MIN_FREE_BYTES', 1024 * 1024 * 1024))  # 1 GiB
+self_test_result = {}
+self_test_lock = threading.Lock()
+self_test_thread = None
+
+# Each job downloads and post-processes in its own directory in the staging
+# tier, finished files are then renamed into the media tier
+STREAM_PATH_MARKER = "[EasyTube] Stream: "
+
+# Patterns for yt-dlp and ffmpeg output, compiled once since they run on every output line
+PROGRESS_PERCENT_RE = re.compile(r'(\d+\.\d+)%')
+PROGRESS_SPEED_RE = re.compile(r'(\d+\.\d+\s*[KMG]iB/s)')
+PROGRESS_ETA_RE = re.compile(r'ETA\s+(\d+:\d+)')
+PROGRESS_SIZE_RE = re.compile(r'(\d+\.\d+\s*[KMG]iB)\s+of\s+(\d+\.\d+\s*[KMG]iB)')
+PROGRESS_DONE_RE = re.compile(r'100(?:\.0)?% of\s+~?\s*(\d+(?:\.\d+)?)\s*([KMG]?i?B)\s+in\s+(\d+(?::\d+){1,2})')
+# Clips are cut by ffmpeg, which yt-dlp runs with "-loglevel quiet" when --print is used.
+# Its -progress report does not depend on the log level and comes in on yt-dlp's stdout.
+CLIP_PROGRESS_DOWNLOADER_ARGS = "ffmpeg_o:-progress pipe:1 -nostats"
+CLIP_POSITION_PREFIX = "out_time_us="
+YOUTUBE_URL_RE = re.compile(
+    r'(https?://)?(www\.)?'
+    r'(youtube|youtu|youtube-nocookie)\.(com|be)/'
+    r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})')
+
+# Server-side store for format selections, keyed by an opaque token.
+# Keeps the cookie session small and lets /download reuse the cached extraction.
+SELECTION_TTL = int(os.environ.get('SELECTION_TTL', 1800))  # 30 minutes
+SELECTION_MAX_ENTRIES = int(os.environ.get('SELECTION_MAX_ENTRIES', 256))  # Oldest are dropped first (info dicts are large)
+selection_store = OrderedDict()  # token -> selection, oldest first
+selection_store_lock = threading.Lock()
+
+# Jobs submitted through the JSON API can register a callback URL that gets the
+# outcome POSTed to it, signed with HMAC-SHA256 when a secret is configured
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 5))
+WEBHOOK_RETRY_DELAY = float(os.environ.get('WEBHOOK_RETRY_DELAY', 2))  # doubled after every failed attempt
+WEBHOOK_TIMEOUT = int(os.environ.get('WEBHOOK_TIMEOUT', 10))
+# Callbacks only go to public addresses, hosts listed here may also be private (e.g. "hooks.internal,10.0.0.5")
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.environ.get('WEBHOOK_ALLOWED_HOSTS', '').split(',') if host.strip()}
+job_callbacks = {}  # download_id -> {'url': ..., 'secret': ...}, kept out of the public progress entry
+job_callbacks_lock = threading.Lock()
+
+# Per-job sampling and rate limiting of logged yt-dlp output lines
+output_log_state = {}  # download_id -> {'progress_lines', 'tokens', 'refilled', 'dropped'}
+
+USE_YTDLP_COMMAND = False  # Whether the yt-dlp command line is available, detected by initialize_app
+
+def ytdlp_command_available():
+    """Check if yt-dlp command line is available"""
+    try:
+        result = subprocess.run(["yt-dlp", "--version"], capture_output=True, text=True, timeout=5)
+        if result.returncode == 0:
+            app.logger.info(f"yt-dlp command line is available, version: {result.stdout.strip()}")
+            return True
         app.logger.warning("yt-dlp command line returned non-zero exit code, falling back to Python library")
-        USE_YTDLP_COMMAND = False
-except Exception as e:
-    app.logger.warning(f"yt-dlp command line is not available: {str(e)}")
-    USE_YTDLP_COMMAND = False
+    except Exception as e:
+        app.logger.warning(f"yt-dlp command line is not available: {str(e)}")
+    return False
 
-app.logger.info(f"Using yt-dlp command line: {USE_YTDLP_COMMAND}")
+def load_identity_file(path):
+    """Read one identity file; returns the identity's credentials or None if the file is unusable"""
+    if path.endswith('.txt'):
+        return {'kind': 'cookies', 'cookies': path}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('username') and data.get('password'):
+            return {'kind': 'credentials', 'username': data['username'], 'password': data['password']}
+    except (OSError, ValueError, AttributeError) as e:
+        app.logger.error(f"Could not read identity file {path}: {str(e)}")
+        return None
+    app.logger.error(f"Identity file {path} needs a username and a password")
+    return None
+
+def reload_identity_pool(force=False):
+    """Pick up added, changed and removed identity files (call with identity_condition held)"""
+    now = time.time()
+    if not force and now - identity_scan['scanned_at'] < IDENTITY_RELOAD_INTERVAL:
+        return
+    identity_scan['scanned_at'] = now
+
+    found = {}
+    try:
+        with os.scandir(IDENTITY_DIR) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('.') and entry.name.endswith(('.txt', '.json')):
+                    found[entry.name] = entry
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        app.logger.error(f"Could not scan identity directory {IDENTITY_DIR}: {str(e)}")
+        return
+
+    for name in list(identity_pool):
+        if name not in found:
+            app.logger.info(f"Identity {name} was removed")
+            del identity_pool[name]
+    for name, entry in found.items():
+        mtime = entry.stat().st_mtime
+        identity = identity_pool.get(name)
+        if identity and identity['mtime'] == mtime:
+            continue
+        credentials = load_identity_file(entry.path)
+        if credentials is None:
+            identity_pool.pop(name, None)
+            continue
+        if identity:
+            # Refreshed cookies or a new password: give the identity a clean slate
+            app.logger.info(f"Identity {name} was updated")
+            identity.update(credentials, mtime=mtime, health=1.0, quarantined_until=0)
+        else:
+            app.logger.info(f"Identity {name} was added")
+            identity_pool[name] = dict(credentials, name=name, mtime=mtime, active=0, last_used=0.0,
+                                       health=1.0, quarantined_until=0, successes=0, failures=0)
+
+def acquire_identity(download_id=None, wait=True):
+    """Take the least recently used healthy identity with a free run, or None to use cookies.txt/environment credentials.
+
+    Waits up to IDENTITY_WAIT_TIMEOUT for a free run (not at all with
+    wait=False), then goes over the limit on the least busy identity.
+    """
+    deadline = time.time() + (IDENTITY_WAIT_TIMEOUT if wait else 0)
+    with identity_condition:
+        while True:
+            reload_identity_pool()
+            now = time.time()
+            healthy = []
+            for identity in identity_pool.values():
+                if identity['quarantined_until'] and identity['quarantined_until'] <= now:
+                    # Back on probation: one more bad run quarantines it again
+                    identity['quarantined_until'] = 0
+                    identity['health'] = max(identity['health'], (1 + IDENTITY_QUARANTINE_HEALTH) / 2)
+                    app.logger.info(f"Identity {identity['name']} is out of quarantine")
+                if not identity['quarantined_until']:
+                    healthy.append(identity)
+            if not healthy:
+                if identity_pool:
+                    app.logger.warning("All identities are quarantined, falling back to the default credentials",
+                                       extra={'download_id': download_id})
+                return None
+
+            free = [identity for identity in healthy
+                    if IDENTITY_MAX_CONCURRENT <= 0 or identity['active'] < IDENTITY_MAX_CONCURRENT]
+            if free:
+                identity = min(free, key=lambda identity: identity['last_used'])
+                break
+            remaining = deadline - now
+            if remaining <= 0:
+                identity = min(healthy, key=lambda identity: (identity['active'], identity['last_used']))
+                app.logger.warning(f"All identities are busy, running over the limit on {identity['name']}",
+                                   extra={'download_id': download_id})
+                break
+            identity_condition.wait(min(remaining, IDENTITY_RELOAD_INTERVAL))
+
+        identity['active'] += 1
+        identity['last_used'] = now
+    app.logger.info(f"Using identity {identity['name']}", extra={'download_id': download_id})
+    return identity
+
+async def async_acquire_identity(download_id=None):
+    """acquire_identity for the async runner, waiting without blocking the event loop"""
+    deadline = time.time() + IDENTITY_WAIT_TIMEOUT
+    while True:
+        with identity_condition:
+            reload_identity_pool()
+            busy = identity_pool and all(
+                identity['quarantined_until'] or
+                (IDENTITY_MAX_CONCURRENT > 0 and identity['active'] >= IDENTITY_MAX_CONCURRENT)
+                for identity in identity_pool.values())
+            # Quarantined-only pools are handled (without waiting) by acquire_identity
+            waiting = busy and any(not identity['quarantined_until'] for identity in identity_pool.values())
+        if not waiting or time.time() >= deadline:
+            return acquire_identity(download_id, wait=False)
+        await asyncio.sleep(0.5)
+
+def release_identity(identity, error=None):
+    """Give back an identity after a yt-dlp run and update its health from the run's outcome"""
+    if identity is None:
+        return
+    error_class = classify_download_error(error)[0] if error is not None else None
+    with identity_condition:
+        identity['active'] -= 1
+        if error_class is None or error_class in IDENTITY_FAILURE_CLASSES:
+            # Other failures (network, missing formats, ...) say nothing about the identity
+            outcome = 1.0 if error_class is None else 0.0
+            identity['health'] += IDENTITY_HEALTH_ALPHA * (outcome - identity['health'])
+            identity['successes' if error_class is None else 'failures'] += 1
+            if identity['health'] < IDENTITY_QUARANTINE_HEALTH and not identity['quarantined_until']:
+                identity['quarantined_until'] = time.time() + IDENTITY_QUARANTINE_SECONDS
+                app.logger.warning(f"Identity {identity['name']} quarantined for {IDENTITY_QUARANTINE_SECONDS} seconds "
+                                   f"after {error_class} failures (health {identity['health']:.2f})")
+        identity_condition.notify_all()
+
+def identity_command_args(identity):
+    """yt-dlp command line options that sign in as an identity, or with cookies.txt/environment credentials"""
+    if identity is not None:
+        if identity['kind'] == 'cookies':
+            return ["--cookies", identity['cookies']]
+        return ["--username", identity['username'], "--password", identity['password']]
+    # Add cookies if available (preferred method)
+    if USE_YOUTUBE_COOKIES and COOKIES_FILE:
+        app.logger.info("Using YouTube cookies")
+        return ["--cookies", COOKIES_FILE]
+    # Fall back to username/password if no cookies
+    elif USE_YOUTUBE_AUTH:
+        app.logger.info("Using YouTube authentication")
+        return ["--username", YOUTUBE_USERNAME, "--password", YOUTUBE_PASSWORD]
+    return []
+
+def identity_library_options(identity):
+    """yt-dlp library options that sign in as an identity, or with cookies.txt/environment credentials"""
+    if identity is not None:
+        if identity['kind'] == 'cookies':
+            return {'cookiefile': identity['cookies']}
+        return {'username': identity['username'], 'password': identity['password']}
+    # Add cookies if available (preferred method)
+    if USE_YOUTUBE_COOKIES and COOKIES_FILE:
+        app.logger.info("Using YouTube cookies with Python library")
+        return {'cookiefile': COOKIES_FILE}
+    # Fall back to username/password if no cookies
+    elif USE_YOUTUBE_AUTH:
+        app.logger.info("Using YouTube authentication with Python library")
+        return {'username': YOUTUBE_USERNAME, 'password': YOUTUBE_PASSWORD}
+    return {}
+
+def proxy_label(proxy):
+    """A proxy's URL without user name and password, for logs and stats"""
+    parts = urllib.parse.urlsplit(proxy['url'])
+    if parts.username is None:
+        return proxy['url']
+    netloc = parts.hostname + (f":{parts.port}" if parts.port else "")
+    return urllib.parse.urlunsplit(parts._replace(netloc=netloc))
+
+def proxy_score(proxy, purpose='download'):
+    """Expected speed of one more run over a proxy (higher is better), sharing it with the runs already on it"""
+    share = (1 - proxy['error_rate']) / (proxy['active'] + 1)
+    if purpose == 'extract':
+        latency = proxy['latency'] if proxy['latency'] is not None else PROXY_PRIOR_LATENCY
+        return share / max(latency, 0.01)
+    # Unmeasured proxies are assumed to be as fast as downloads are on average, so they get tried
+    throughput = proxy['throughput'] if proxy['throughput'] is not None else estimated_throughput('download')
+    return share * throughput
+
+def acquire_proxy(download_id=None, purpose='download', wait=True):
+    """Take the best proxy for an extraction or download that has a free run, or None without a proxy pool.
+
+    Waits up to PROXY_WAIT_TIMEOUT for a free run (not at all with wait=False),
+    then goes over the limit on the best proxy.
+    """
+    if not proxy_pool:
+        return None
+    deadline = time.time() + (PROXY_WAIT_TIMEOUT if wait else 0)
+    with proxy_condition:
+        while True:
+            now = time.time()
+            usable = []
+            for proxy in proxy_pool:
+                if proxy['ejected_until'] and proxy['ejected_until'] <= now:
+                    # Back in rotation: another failure or two ejects it again
+                    proxy['ejected_until'] = 0
+                    proxy['error_rate'] = min(proxy['error_rate'], PROXY_MAX_ERROR_RATE / 2)
+                    app.logger.info(f"Proxy {proxy_label(proxy)} is back in rotation")
+                if not proxy['ejected_until']:
+                    usable.append(proxy)
+            if not usable:
+                # Rather than failing the job, use the proxy that comes back first
+                proxy = min(proxy_pool, key=lambda proxy: proxy['ejected_until'])
+                app.logger.warning(f"All proxies are ejected, using {proxy_label(proxy)}",
+                                   extra={'download_id': download_id})
+                break
+            
+            free = [proxy for proxy in usable if PROXY_MAX_CONCURRENT <= 0 or proxy['active'] < PROXY_MAX_CONCURRENT]
+            if free:
+                proxy = max(free, key=lambda proxy: proxy_score(proxy, purpose))
+                break
+            remaining = deadline - now
+            if remaining <= 0:
+                proxy = max(usable, key=lambda proxy: proxy_score(proxy, purpose))
+                app.logger.warning(f"All proxies are busy, running over the limit on {proxy_label(proxy)}",
+                                   extra={'download_id': download_id})
+                break
+            proxy_condition.wait(remaining)
+        
+        proxy['active'] += 1
+    app.logger.info(f"Routing {purpose} over proxy {proxy_label(proxy)}", extra={'download_id': download_id})
+    return proxy
+
+async def async_acquire_proxy(download_id=None, purpose='download'):
+    """acquire_proxy for the async runner, waiting without blocking the event loop"""
+    deadline = time.time() + PROXY_WAIT_TIMEOUT
+    while True:
+        with proxy_condition:
+            now = time.time()
+            usable = [proxy for proxy in proxy_pool if not proxy['ejected_until'] or proxy['ejected_until'] <= now]
+            waiting = PROXY_MAX_CONCURRENT > 0 and usable and all(
+                proxy['active'] >= PROXY_MAX_CONCURRENT for proxy in usable)
+        if not waiting or time.time() >= deadline:
+            return acquire_proxy(download_id, purpose, wait=False)
+        await asyncio.sleep(0.5)
+
+def release_proxy(proxy, error=None, num_bytes=0, seconds=0.0, latency=None):
+    """Give back a proxy after a yt-dlp run and fold the run's outcome, throughput or latency into its estimates"""
+    if proxy is None:
+        return
+    error_class = classify_download_error(error)[0] if error is not None else None
+    failed = error_class in PROXY_FAILURE_CLASSES
+    with proxy_condition:
+        proxy['active'] -= 1
+        proxy['runs'] += 1
+        if error_class is None or failed:
+            # Other failures (missing formats, cookies, ...) say nothing about the route
+            proxy['error_rate'] += PROXY_EWMA_ALPHA * ((1.0 if failed else 0.0) - proxy['error_rate'])
+        if failed:
+            proxy['failures'] += 1
+            if proxy['error_rate'] > PROXY_MAX_ERROR_RATE and not proxy['ejected_until']:
+                proxy['ejected_until'] = time.time() + PROXY_EJECT_SECONDS
+                app.logger.warning(f"Proxy {proxy_label(proxy)} ejected for {PROXY_EJECT_SECONDS} seconds "
+                                   f"after {error_class} failures (error rate {proxy['error_rate']:.2f})")
+        elif error_class is None:
+            if latency is not None:
+                proxy['latency'] = latency if proxy['latency'] is None else \
+                    proxy['latency'] + PROXY_EWMA_ALPHA * (latency - proxy['latency'])
+            if num_bytes >= THROUGHPUT_MIN_SAMPLE_BYTES and seconds > 0:
+                rate = num_bytes / seconds
+                proxy['throughput'] = rate if proxy['throughput'] is None else \
+                    proxy['throughput'] + PROXY_EWMA_ALPHA * (rate - proxy['throughput'])
+        proxy_condition.notify_all()
+
+def proxy_command_args(proxy):
+    """yt-dlp command line options that route a run over a proxy"""
+    if proxy is None or proxy['url'] == 'direct':
+        return []
+    return ["--proxy", proxy['url']]
+
+def proxy_library_options(proxy):
+    """yt-dlp library options that route a run over a proxy"""
+    if proxy is None or proxy['url'] == 'direct':
+        return {}
+    return {'proxy': proxy['url']}
+
+def total_file_size(paths):
+    """Combined size of the files that exist among paths"""
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
 
 def get_video_info(url):
+    """Extract a video's info dict, signed in as one of the pool's identities and routed over the best proxy"""
+    identity = acquire_identity()
+    proxy = acquire_proxy(purpose='extract')
+    started = time.time()
+    try:
+        video_info = fetch_video_info(url, identity, proxy)
+    except Exception as e:
+        release_identity(identity, e)
+        release_proxy(proxy, e)
+        raise
+    release_identity(identity)
+    release_proxy(proxy, latency=time.time() - started)
+    return video_info
+
+def fetch_video_info(url, identity=None, proxy=None):
+    """Extract a video's info dict with the yt-dlp command line, falling back to the library"""
     try:
         app.logger.info(f"Fetching video info for URL: {url}")
         
@@ -86,15 +698,8 @@ def get_video_info(url):
             try:
                 # Prepare command with authentication if available
                 cmd = ["yt-dlp", "--dump-json"]
-                
-                # Add cookies if available (preferred method)
-                if USE_YOUTUBE_COOKIES and COOKIES_FILE:
-                    app.logger.info("Using YouTube cookies for video info")
-                    cmd.extend(["--cookies", COOKIES_FILE])
-                # Fall back to username/password if no cookies
-                elif USE_YOUTUBE_AUTH:
-                    app.logger.info("Using YouTube authentication for video info")
-                    cmd.extend(["--username", YOUTUBE_USERNAME, "--password", YOUTUBE_PASSWORD])
+                cmd.extend(identity_command_args(identity))
+                cmd.extend(proxy_command_args(proxy))
                 
                 # Add options to bypass YouTube restrictions
                 cmd.extend([
@@ -173,25 +778,13 @@ def get_video_info(url):
             'nocheckcertificate': True,       # Don't check certificates (alternative option)
         }
         
-        # Add cookies if available (preferred method)
-        if USE_YOUTUBE_COOKIES and COOKIES_FILE:
-            app.logger.info("Using YouTube cookies with Python library")
-            ydl_opts.update({
-                'cookiefile': COOKIES_FILE,
-            })
-        # Fall back to username/password if no cookies
-        elif USE_YOUTUBE_AUTH:
-            app.logger.info("Using YouTube authentication with Python library")
-            ydl_opts.update({
-                'username': YOUTUBE_USERNAME,
-                'password': YOUTUBE_PASSWORD,
-            })
+        ydl_opts.update(identity_library_options(identity))
+        ydl_opts.update(proxy_library_options(proxy))
         
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                video_info = ydl.extract_info(url, download=False)
-                app.logger.info(f"Successfully fetched info for video via Python library: {video_info.get('title', 'Unknown')}")
-                return video_info
+            video_info = run_library_task(library_worker.extract_info, url, ydl_opts)
+            app.logger.info(f"Successfully fetched info for video via Python library: {video_info.get('title', 'Unknown')}")
+            return video_info
         except yt_dlp.utils.DownloadError as e:
             error_str = str(e)
             app.logger.error(f"yt-dlp download error: {error_str}")
@@ -215,6 +808,91 @@ def get_video_info(url):
         else:
             raise Exception(f"Error fetching video info: {str(e)}")
 
+def storage_shard_dir(filename, tier='media'):
+    """Directory a file lives in: two hex characters of its name's hash per shard level"""
+    root = STORAGE_ROOTS[tier]
+    if STORAGE_SHARD_LEVELS <= 0:
+        return root
+    digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    return os.path.join(root, *(digest[i * 2:i * 2 + 2] for i in range(STORAGE_SHARD_LEVELS)))
+
+def storage_path(filename, tier='media'):
+    """Full path of a stored file"""
+    return os.path.join(storage_shard_dir(filename, tier), filename)
+
+def storage_publish(src_path, filename, tier='media'):
+    """Move a finished file into its place in a storage tier and return the new path"""
+    final_path = storage_path(filename, tier)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    try:
+        # Atomic when the source is on the same filesystem (the usual staging setup)
+        os.replace(src_path, final_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Staging is on another filesystem: copy next to the target, then rename
+        temp_path = final_path + '.part'
+        shutil.copyfile(src_path, temp_path)
+        os.replace(temp_path, final_path)
+        os.remove(src_path)
+    return final_path
+
+def migrate_flat_storage(tier='media', dry_run=False):
+    """Move files from the top level of a storage tier into their shard directories"""
+    root = STORAGE_ROOTS[tier]
+    moved = 0
+    with os.scandir(root) as entries:
+        for entry in entries:
+            # Directories are shards or other tiers, dotfiles are not ours
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            target = storage_path(entry.name, tier)
+            if target == entry.path:
+                continue
+            app.logger.info(f"Migrating {entry.path} -> {target}")
+            if not dry_run:
+                storage_publish(entry.path, entry.name, tier)
+            moved += 1
+    return moved
+
+def store_selection(url, format_mode, video_info, choices):
+    """Store a format selection server-side and return its opaque token"""
+    token = uuid.uuid4().hex
+    now = time.time()
+    with selection_store_lock:
+        # All selections live equally long, so the expired ones are at the front
+        while selection_store and next(iter(selection_store.values()))['expires'] <= now:
+            selection_store.popitem(last=False)
+        while len(selection_store) >= SELECTION_MAX_ENTRIES:
+            selection_store.popitem(last=False)
+        
+        selection_store[token] = {
+            'url': url,
+            'format_mode': format_mode,
+            'video_title': video_info.get('title', 'Video'),
+            'video_info': video_info,
+            'choices': choices,
+            'expires': now + SELECTION_TTL
+        }
+    return token
+
+def get_selection(token):
+    """Return the stored selection for a token, or None if it is missing or expired"""
+    if not token:
+        return None
+    with selection_store_lock:
+        entry = selection_store.get(token)
+        if entry and entry['expires'] <= time.time():
+            del selection_store[token]
+            entry = None
+    return entry
+
+def write_info_json(video_info, info_path):
+    """Write an extracted info dict to disk so yt-dlp can download from it without re-extracting"""
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(yt_dlp.YoutubeDL.sanitize_info(video_info, remove_private_keys=True), f)
+    return info_path
+
 def extract_resolution_number(res):
     if isinstance(res, str):
         if 'x' in res:
@@ -229,9 +907,131 @@ def extract_resolution_number(res):
                 return 0
     return 0
 
-def extract_format_choices(formats, mode):
+# Codec families that can be stream-copied (remuxed) into each output container
+CONTAINER_CODECS = {
+    'mp4': {
+        'video': ('avc1', 'h264', 'hev1', 'hvc1', 'av01', 'vp09', 'vp9'),
+        'audio': ('mp4a', 'aac'),
+    },
+    'webm': {
+        'video': ('vp8', 'vp9', 'vp09', 'av01'),
+        'audio': ('opus', 'vorbis'),
+    },
+}
+
+# Audio download modes: "mp3" converts to MP3, "audio" keeps the source codec and container
+AUDIO_MODES = ("mp3", "audio")
+
+# Mimetypes for the files we serve
+MEDIA_MIMETYPES = {
+    '.mp3': 'audio/mpeg',
+    '.mp4': 'video/mp4',
+    '.m4a': 'audio/mp4',
+    '.webm': 'audio/webm',
+    '.opus': 'audio/ogg',
+    '.ogg': 'audio/ogg',
+}
+
+# Format selection policy used when building the choice list (see FORMAT_POLICIES)
+FORMAT_POLICY = os.environ.get('FORMAT_POLICY', 'remux')
+
+def codec_family(codec):
+    """Normalize a yt-dlp codec string such as 'avc1.640028' to its family ('avc1')"""
+    if not codec or codec == 'none':
+        return None
+    return codec.split('.')[0].lower()
+
+def can_stream_copy(fmt, container, kind):
+    """Check if the video or audio stream of a format can be copied into the container as-is"""
+    family = codec_family(fmt.get('vcodec') if kind == 'video' else fmt.get('acodec'))
+    if family is None:
+        # No stream of this kind, so there is nothing to convert
+        return True
+    return family in CONTAINER_CODECS.get(container, {}).get(kind, ())
+
+def estimate_format_size(fmt, duration=None):
+    """Estimate the size of a format in bytes from filesize, filesize_approx or bitrate"""
+    if fmt.get('filesize'):
+        return fmt['filesize']
+    if fmt.get('filesize_approx'):
+        return fmt['filesize_approx']
+    if fmt.get('tbr') and duration:
+        # tbr is in KBit/s
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return 0
+
+def policy_largest(fmt, container, kind, duration=None):
+    """Legacy policy: prefer formats already in the container's extension, then the largest file"""
+    return (fmt.get('ext') == container, fmt.get('filesize') or 0)
+
+def policy_remux(fmt, container, kind, duration=None):
+    """Prefer formats that can be stream-copied into the container, then the highest bitrate"""
+    return (can_stream_copy(fmt, container, kind), fmt.get('tbr') or fmt.get('abr') or 0, estimate_format_size(fmt, duration))
+
+def policy_efficient(fmt, container, kind, duration=None):
+    """Prefer stream-copyable formats, then the fewest bytes for the same resolution"""
+    size = estimate_format_size(fmt, duration)
+    if kind == 'audio':
+        # For audio there is no resolution to hold constant, so keep the best bitrate
+        return (can_stream_copy(fmt, container, kind), fmt.get('abr') or fmt.get('tbr') or 0, -size)
+    return (can_stream_copy(fmt, container, kind), -size if size else float('-inf'))
+
+# Pluggable selection policies. Each one maps (format, container, kind, duration)
+# to a sort key and the format with the highest key wins.
+FORMAT_POLICIES = {
+    'largest': policy_largest,
+    'remux': policy_remux,
+    'efficient': policy_efficient,
+}
+
+def pick_format(candidates, container, kind, policy, duration=None):
+    """Pick the best format from candidates according to a selection policy"""
+    if not candidates:
+        return None
+    return max(candidates, key=lambda f: policy(f, container, kind, duration))
+
+def audio_needs_transcode(fmt, format_mode):
+    """Check if an audio format has to be re-encoded for the given mode"""
+    # Only the MP3 mode converts, and only when the source is not MP3 already
+    return format_mode == "mp3" and codec_family(fmt.get("acodec")) != "mp3"
+
+def audio_output_ext(fmt, format_mode):
+    """Return the file extension an audio format ends up with in the given mode"""
+    if format_mode == "mp3":
+        return "mp3"
+    # Passthrough keeps the source container byte-for-byte (m4a for AAC, webm for Opus)
+    return fmt.get("ext") or "m4a"
+
+def make_audio_choice(fmt, format_mode, quality_desc, duration=None):
+    """Build an audio download choice for a format"""
+    size_mb = round(fmt["filesize"] / (1024 * 1024), 2) if fmt.get("filesize") else "Unknown"
+    ext = audio_output_ext(fmt, format_mode)
+    if format_mode == "audio":
+        label = f"Audio | {quality_desc} | {ext.upper()} (original, no conversion) | {size_mb}MB"
+    else:
+        label = f"Audio | {quality_desc} | {size_mb}MB"
+    return {
+        "id": fmt["format_id"],
+        "label": label,
+        "ext": ext,
+        "acodec": codec_family(fmt.get("acodec")),
+        "needs_transcode": audio_needs_transcode(fmt, format_mode),
+        "size": estimate_format_size(fmt, duration)
+    }
+
+def find_format(video_info, format_id):
+    """Look up a single format in an info dict by its format_id"""
+    if not video_info:
+        return None
+    for fmt in video_info.get("formats") or []:
+        if fmt.get("format_id") == format_id:
+            return fmt
+    return None
+
+def extract_format_choices(formats, mode, policy=None, container="mp4", duration=None):
+    """Build the list of download choices for a video, labelled with whether they need a transcode"""
     choices = []
-    if mode == "mp3":
+    if mode in AUDIO_MODES:
         # Filter audio formats
         audio_formats = [f for f in formats if f.get("acodec") != "none" and f.get("vcodec") == "none"]
         
@@ -245,83 +1045,88 @@ def extract_format_choices(formats, mode):
                 return choices
             
         # Sort by filesize (which correlates with quality)
-        sorted_audio = sorted(valid_audio_formats, key=lambda x: x.get("filesize", 0))
+        sorted_audio = sorted(valid_audio_formats, key=lambda x: x.get("filesize") or 0)
         
+        if mode == "audio":
+            # Passthrough mode: offer the best stream of each codec, kept in its original container
+            best_per_codec = {}
+            for af in sorted_audio:
+                best_per_codec[codec_family(af.get("acodec"))] = af
+            for af in sorted(best_per_codec.values(), key=lambda x: x.get("filesize") or 0, reverse=True):
+                choices.append(make_audio_choice(af, mode, "High Quality", duration))
         # Get the best quality (largest file size) - show this first
-        if len(sorted_audio) > 1:
-            best = sorted_audio[-1]
-            best_size_mb = round(best.get("filesize", 0) / (1024 * 1024), 2) if best.get("filesize") else "Unknown"
-            choices.append({
-                "id": best["format_id"],
-                "label": f"Audio | High Quality | {best_size_mb}MB"
-            })
+        elif len(sorted_audio) > 1:
+            choices.append(make_audio_choice(sorted_audio[-1], mode, "High Quality", duration))
+        
+        chosen_ids = {c["id"] for c in choices}
         
         # Get the worst quality (smallest file size) - show this second
-        if sorted_audio:
-            worst = sorted_audio[0]
-            worst_size_mb = round(worst.get("filesize", 0) / (1024 * 1024), 2) if worst.get("filesize") else "Unknown"
-            choices.append({
-                "id": worst["format_id"],
-                "label": f"Audio | Low Quality | {worst_size_mb}MB"
-            })
+        if sorted_audio and sorted_audio[0]["format_id"] not in chosen_ids:
+            choices.append(make_audio_choice(sorted_audio[0], mode, "Low Quality", duration))
+            chosen_ids.add(sorted_audio[0]["format_id"])
         
         # Add a fallback option using the best audio format
         if audio_formats:
-            best_audio = max(audio_formats, key=lambda a: a.get("abr", 0), default=None)
-            if best_audio and best_audio.get("format_id") and not any(c["id"] == best_audio["format_id"] for c in choices):
-                choices.append({
-                    "id": best_audio["format_id"],
-                    "label": f"Audio | Fallback Option | Size Unknown"
-                })
+            best_audio = max(audio_formats, key=lambda a: a.get("abr") or 0, default=None)
+            if best_audio and best_audio.get("format_id") and best_audio["format_id"] not in chosen_ids:
+                choice = make_audio_choice(best_audio, mode, "Fallback Option", duration)
+                choice["label"] = choice["label"].rsplit(" | ", 1)[0] + " | Size Unknown"
+                choices.append(choice)
         
         return choices
 
-    # For video, prefer MP4 formats but also include other formats that can be converted
-    # We'll use the --merge-output-format mp4 flag to ensure the final output is MP4
+    # For video, pick per resolution the formats the selection policy likes best.
+    # The default policy prefers streams that can be copied into the MP4 container
+    # (avc1 + mp4a), so the merge step is a remux rather than a re-encode.
+    if policy is None:
+        policy = FORMAT_POLICIES.get(FORMAT_POLICY, policy_remux)
+    
     video_formats = [f for f in formats if f.get("vcodec") != "none"]
     
-    # Prioritize MP4 formats
-    mp4_formats = [f for f in video_formats if f.get("ext") == "mp4"]
-    if mp4_formats:
-        video_formats = mp4_formats
+    # Video-only streams are paired with a separate audio stream, so prefer them
+    video_only_formats = [f for f in video_formats if f.get("acodec") == "none"]
+    if video_only_formats:
+        video_formats = video_only_formats
     
     audio_formats = [f for f in formats if f.get("acodec") != "none" and f.get("vcodec") == "none"]
 
-    best_audio = max(audio_formats, key=lambda a: a.get("filesize", 0), default=None)
-    if not best_audio:
-        best_audio = max(audio_formats, key=lambda a: a.get("abr", 0), default=None)
+    best_audio = pick_format([a for a in audio_formats if a.get("format_id")], container, "audio", policy, duration)
     
     if not best_audio:
         return choices
+    # The same audio stream goes with every resolution
+    audio_copyable = can_stream_copy(best_audio, container, "audio")
+    audio_estimate = estimate_format_size(best_audio, duration)
 
-    resolution_map = {}
+    # Group video formats by height
+    formats_by_height = {}
     for vf in video_formats:
-        if not vf.get("format_id"):
+        if not vf.get("format_id") or not vf.get("height"):
             continue
-            
-        height = vf.get("height")
-        if not height:
-            continue
-            
+        formats_by_height.setdefault(vf["height"], []).append(vf)
+
+    resolution_map = {}
+    for height, candidates in formats_by_height.items():
+        vf = pick_format(candidates, container, "video", policy, duration)
         res = f"{height}p"
         
         # Calculate total size if available
         if vf.get("filesize") and best_audio.get("filesize"):
             total_size = vf.get("filesize", 0) + best_audio.get("filesize", 0)
-            size_mb = round(total_size / (1024 * 1024), 2)
         else:
             total_size = 0
-            size_mb = "Unknown"
             
-        if res not in resolution_map or total_size > resolution_map[res]["total_size"]:
-            resolution_map[res] = {
-                "id": f"{vf['format_id']}+{best_audio['format_id']}",
-                "label": f"Video | {res} | {size_mb}MB",
-                "total_size": total_size,
-                "height": height,
-                "ext": vf.get("ext", "mp4"),  # Default to mp4 if not specified
-                "format_id": vf['format_id']
-            }
+        video_copyable = can_stream_copy(vf, container, "video")
+        resolution_map[res] = {
+            "id": f"{vf['format_id']}+{best_audio['format_id']}",
+            "total_size": total_size,
+            "height": height,
+            "ext": vf.get("ext", "mp4"),  # Default to mp4 if not specified
+            "format_id": vf['format_id'],
+            "estimated_size": estimate_format_size(vf, duration) + audio_estimate,
+            "needs_transcode": not (video_copyable and audio_copyable),
+            "needs_video_transcode": not video_copyable
+        }
 
     # Add user-friendly quality descriptions to video options
     formatted_choices = []
@@ -341,146 +1146,467 @@ def extract_format_choices(formats, mode):
         else:
             quality_desc = "Low Quality"
         
-        # Add format information to the label
-        ext = entry.get("ext", "mp4")
-        if ext != "mp4":
-            label = f"Video | {quality_desc} ({res}) | {size_mb}MB (Will convert to MP4)"
+        # Add format information to the label, matching the work plan_postprocessing does
+        if entry["needs_video_transcode"]:
+            label = f"Video | {quality_desc} ({res}) | {size_mb}MB (Will convert to {container.upper()})"
+        elif entry["needs_transcode"]:
+            label = f"Video | {quality_desc} ({res}) | {size_mb}MB (Will convert audio to AAC)"
         else:
             label = f"Video | {quality_desc} ({res}) | {size_mb}MB"
             
-        formatted_choices.append({"id": entry["id"], "label": label})
+        formatted_choices.append({
+            "id": entry["id"],
+            "label": label,
+            "container": container,
+            "needs_transcode": entry["needs_transcode"],
+            "needs_video_transcode": entry["needs_video_transcode"],
+            "size": entry["total_size"] or entry["estimated_size"]
+        })
     
     # Add a fallback option using the best video format directly
     if video_formats:
-        best_video = max(video_formats, key=lambda v: v.get("height", 0), default=None)
+        best_video = max(video_formats, key=lambda v: v.get("height") or 0, default=None)
         if best_video and best_video.get("format_id") and best_audio and best_audio.get("format_id"):
             fallback_id = f"{best_video['format_id']}+{best_audio['format_id']}"
             if not any(c["id"] == fallback_id for c in formatted_choices):
-                height = best_video.get("height", 0)
+                height = best_video.get("height") or 0
                 quality_desc = "High Quality" if height >= 1080 else "Medium Quality" if height >= 720 else "Standard Quality"
                 formatted_choices.append({
                     "id": fallback_id,
-                    "label": f"Video | {quality_desc} ({height}p) | Fallback Option"
+                    "label": f"Video | {quality_desc} ({height}p) | Fallback Option",
+                    "container": container,
+                    "needs_transcode": not (can_stream_copy(best_video, container, "video") and audio_copyable),
+                    "needs_video_transcode": not can_stream_copy(best_video, container, "video"),
+                    "size": estimate_format_size(best_video, duration) + audio_estimate
                 })
     
     # Add a simple format option that's less likely to be restricted
     formatted_choices.append({
         "id": "best[height<=720]",
-        "label": "Video | Medium Quality | Most Reliable Option"
+        "label": "Video | Medium Quality | Most Reliable Option",
+        "container": container,
+        "needs_transcode": False,
+        "size": 0  # Picked by yt-dlp at download time
     })
     
     return formatted_choices
 
-def download_video_with_progress(url, format_id, download_id, filename, format_mode):
-    """Download video with progress tracking using direct subprocess call to yt-dlp or Python library"""
+def record_throughput(kind, num_bytes, seconds):
+    """Fold one measured transfer or ffmpeg run into the rolling throughput estimate"""
+    if num_bytes < THROUGHPUT_MIN_SAMPLE_BYTES or seconds <= 0:
+        return
+    rate = num_bytes / seconds
+    with throughput_lock:
+        entry = throughput_estimates.get(kind)
+        if entry is None:
+            entry = throughput_estimates[kind] = {'rate': rate, 'samples': 0}
+        else:
+            entry['rate'] += THROUGHPUT_EWMA_ALPHA * (rate - entry['rate'])
+        entry['samples'] += 1
+        entry['updated'] = time.time()
+
+def estimated_throughput(kind):
+    """Current throughput estimate in bytes per second, or the prior when nothing was measured yet"""
+    with throughput_lock:
+        entry = throughput_estimates.get(kind)
+        return entry['rate'] if entry else THROUGHPUT_PRIORS[kind]
+
+def postprocess_kind(choice):
+    """Which ffmpeg work a choice needs after downloading: 'encode', 'remux' or None"""
+    if choice.get("needs_transcode") and "container" not in choice:
+        return "encode"
+    if choice.get("needs_video_transcode"):
+        return "encode"
+    if "container" in choice:
+        # Converting only the audio is cheap next to the video, so that merge still counts as a remux
+        return "remux"
+    return None
+
+def predict_choice_seconds(choice):
+    """Predict how long a choice takes to download and post-process on this node, None if its size is unknown"""
+    size = choice.get("size") or 0
+    if not size:
+        return None
+    seconds = size / estimated_throughput("download")
+    kind = postprocess_kind(choice)
+    if kind:
+        seconds += size / estimated_throughput(kind)
+    return seconds
+
+def format_predicted_time(seconds):
+    """Format a predicted duration for a choice label"""
+    if seconds < 60:
+        return "under 1 min"
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return f"~{minutes} min"
+    return f"~{minutes // 60} h {minutes % 60} min"
+
+def annotate_choice_predictions(choices):
+    """Add the predicted completion time to each choice and its label"""
+    for choice in choices:
+        seconds = predict_choice_seconds(choice)
+        choice["predicted_seconds"] = round(seconds, 1) if seconds is not None else None
+        if seconds is not None:
+            choice["label"] = f"{choice['label']} | {format_predicted_time(seconds)}"
+    return choices
+
+def pick_choice_for_deadline(choices, deadline):
+    """Auto selector: the best choice predicted to finish within deadline seconds.
+    
+    Choices are ordered best quality first. When nothing fits, the fastest choice wins.
+    """
+    predicted = [(choice, predict_choice_seconds(choice)) for choice in choices]
+    predicted = [(choice, seconds) for choice, seconds in predicted if seconds is not None]
+    if not predicted:
+        return choices[0] if choices else None
+    for choice, seconds in predicted:
+        if seconds <= deadline:
+            return choice
+    return min(predicted, key=lambda item: item[1])[0]
+
+def download_video_with_progress(url, format_id, download_id, filename, format_mode, video_info=None):
+    """Download video with progress tracking using direct subprocess call to yt-dlp or Python library.
+    
+    Only the network-bound part runs here. The raw streams are handed to the
+    post-processing stage, which merges or encodes them on its own worker pool.
+    """
     try:
-        # Determine output format and path
-        is_audio = format_mode == "mp3"
-        base_filename = os.path.splitext(filename)[0]
-        output_template = os.path.join(DOWNLOAD_FOLDER, filename)
+        # Every job works in its own staging directory, so output paths never collide
+        staging_dir = job_staging_dir(download_id)
+        os.makedirs(staging_dir, exist_ok=True)
         
-        # Update status to starting
-        download_progress[download_id]['status'] = 'Starting download...'
-        app.logger.info(f"Starting download for {download_id}: {url} with format {format_id}")
+        # Streams another job fetched recently come from the stream cache
+        section = download_progress[download_id].get('section')
+        cached_paths, missing_ids = checkout_cached_streams(video_info, format_id, staging_dir, section)
+        downloaded_paths = []
         
-        # Choose download method based on availability
-        if USE_YTDLP_COMMAND:
-            app.logger.info(f"Using yt-dlp command line for download")
-            return download_with_subprocess(url, format_id, download_id, filename, format_mode, output_template)
-        else:
-            app.logger.info(f"Using yt-dlp Python library for download")
-            return download_with_python_lib(url, format_id, download_id, filename, format_mode, output_template)
+        if missing_ids:
+            # Wait for a free download slot
+            download_progress[download_id]['status'] = 'Waiting for a download slot...'
+            if not acquire_download_slot(download_id, estimate_download_bytes(download_id, video_info, missing_ids)):
+                app.logger.info(f"Download {download_id} was cancelled while waiting for a slot")
+                remove_staging_dir(download_id)
+                return None
+            try:
+                # Update status to starting
+                download_progress[download_id].update({'status': 'Starting download...', 'queued': False})
+                app.logger.info(f"Starting download for {download_id}: {url} with format {format_id}")
+                
+                # Choose download method based on availability
+                if USE_YTDLP_COMMAND:
+                    app.logger.info(f"Using yt-dlp command line for download")
+                    downloaded_paths = download_with_subprocess(url, '+'.join(missing_ids), download_id, staging_dir, video_info)
+                else:
+                    app.logger.info(f"Using yt-dlp Python library for download")
+                    downloaded_paths = download_with_python_lib(url, '+'.join(missing_ids), download_id, staging_dir, video_info)
+            finally:
+                release_download_slot(download_id)
+            if download_progress[download_id].get('cancelled'):
+                # Library pool downloads run to the end, what they fetched after a cancellation is dropped
+                raise Exception("Download was cancelled")
+            cache_downloaded_streams(video_info, downloaded_paths, section)
+        
+        stream_paths = merge_stream_paths(format_id, cached_paths, downloaded_paths)
+        return hand_off_streams(download_id, stream_paths, format_id, filename, format_mode, video_info)
             
     except Exception as e:
+        remove_staging_dir(download_id)
+        if download_progress.get(download_id, {}).get('cancelled'):
+            # Its process was stopped by a cancellation or shutdown, that is no failure
+            app.logger.info(f"Download {download_id} stopped after it was cancelled")
+            return None
         app.logger.error(f"Download error: {str(e)}", exc_info=True)
-        
-        # Update download progress with error information
-        download_progress[download_id]['status'] = f'Error: {str(e)}'
-        download_progress[download_id]['error'] = str(e)
-        download_progress[download_id]['progress'] = 0
-        
-        # Check for specific error types and provide user-friendly messages
-        error_msg = str(e).lower()
-        
-        if "anti-bot protection" in error_msg or "sign in to confirm" in error_msg:
-            user_message = "YouTube's anti-bot protection is blocking this download. Try refreshing your cookies or downloading from your local computer."
-        elif "cookie file" in error_msg:
-            user_message = "There was an issue with your cookie file. Make sure it's in the correct Netscape format and is not expired."
-        elif "format not available" in error_msg:
-            user_message = "The requested video format is not available. Please try a different format."
-        elif "http error 403: forbidden" in error_msg:
-            user_message = "YouTube is blocking this download (HTTP 403 Forbidden). This usually happens when YouTube's API restrictions are in place. Try using a different format or try again later."
-        elif "precondition check failed" in error_msg:
-            user_message = "YouTube API returned 'Precondition check failed'. This usually indicates that your cookies are expired or the selected format is currently restricted. Try refreshing your cookies or selecting a different format."
-        elif "throttling" in error_msg:
-            user_message = "YouTube is throttling this download. Try selecting a different format or try again later."
-        elif "network error" in error_msg or "connection" in error_msg:
-            user_message = "A network error occurred. Please check your internet connection and try again."
-        elif "permission" in error_msg:
-            user_message = "Permission error. The application doesn't have permission to write to the download folder."
-        else:
-            user_message = f"Download failed: {str(e)}"
-        
-        download_progress[download_id]['user_message'] = user_message
-        raise Exception(user_message)
+        raise Exception(record_download_failure(download_id, e))
 
-def download_with_subprocess(url, format_id, download_id, filename, format_mode, output_template):
-    """Download using subprocess call to yt-dlp command line"""
-    try:
-        is_audio = format_mode == "mp3"
-        base_filename = os.path.splitext(filename)[0]
+def hand_off_streams(download_id, stream_paths, format_id, filename, format_mode, video_info=None):
+    """Pass the raw streams of a finished download on to post-processing, or publish them directly"""
+    # Jobs served entirely from the stream cache never waited for a download slot
+    download_progress[download_id]['queued'] = False
+    if not stream_paths:
+        raise Exception("Could not find downloaded streams")
+    stream_paths = list(dict.fromkeys(stream_paths))
+    
+    # Merge/encode on the post-processing pool, or publish the stream as it is
+    staging_dir = job_staging_dir(download_id)
+    staged_output = os.path.join(staging_dir, filename)
+    cmd = plan_postprocessing(stream_paths, staged_output, format_id, format_mode, video_info)
+    if cmd:
+        input_bytes = total_file_size(stream_paths)
+        kind = 'encode' if format_mode == 'mp3' or 'libx264' in cmd else 'remux'
+        return submit_postprocess_job(download_id, cmd, staged_output, filename, input_bytes, kind)
+    
+    # Keep the extension of what was actually downloaded
+    published_name = os.path.splitext(filename)[0] + os.path.splitext(stream_paths[0])[1]
+    final_output_path = publish_output_file(download_id, stream_paths[0], published_name)
+    remove_staging_dir(download_id)
+    return final_output_path
+
+# Known failure causes: (error class, substrings of the error, user-facing message).
+# The error class is part of the API job record and the webhook payload.
+DOWNLOAD_ERROR_CLASSES = [
+    ('anti_bot', ("anti-bot protection", "sign in to confirm"),
+     "YouTube's anti-bot protection is blocking this download. Try refreshing your cookies or downloading from your local computer."),
+    ('cookies', ("cookie file",),
+     "There was an issue with your cookie file. Make sure it's in the correct Netscape format and is not expired."),
+    ('format_unavailable', ("format not available",),
+     "The requested video format is not available. Please try a different format."),
+    ('forbidden', ("http error 403: forbidden", "http 403 forbidden"),
+     "YouTube is blocking this download (HTTP 403 Forbidden). This usually happens when YouTube's API restrictions are in place. Try using a different format or try again later."),
+    ('precondition_failed', ("precondition check failed",),
+     "YouTube API returned 'Precondition check failed'. This usually indicates that your cookies are expired or the selected format is currently restricted. Try refreshing your cookies or selecting a different format."),
+    ('throttled', ("throttling",),
+     "YouTube is throttling this download. Try selecting a different format or try again later."),
+    ('network', ("network error", "connection", "urlopen error", "proxy", "bad gateway"),
+     "A network error occurred. Please check your internet connection and try again."),
+    ('permission', ("permission",),
+     "Permission error. The application doesn't have permission to write to the download folder."),
+    ('timeout', ("timed out",),
+     "The download took too long and was stopped. Please try again later."),
+    ('disk_space', ("not enough disk space",),
+     "The download is too large for the server's storage. Please choose a smaller format or a shorter clip."),
+]
+
+def classify_download_error(e):
+    """Map a download error to an (error class, user-friendly message) pair"""
+    error_msg = str(e).lower()
+    for error_class, needles, user_message in DOWNLOAD_ERROR_CLASSES:
+        if any(needle in error_msg for needle in needles):
+            return error_class, user_message
+    return 'download_failed', f"Download failed: {str(e)}"
+
+def record_download_failure(download_id, e):
+    """Store a failed download's error in its progress entry and return a user-friendly message"""
+    # Update download progress with error information
+    download_progress[download_id]['status'] = f'Error: {str(e)}'
+    download_progress[download_id]['error'] = str(e)
+    download_progress[download_id]['progress'] = 0
+
+    # Check for specific error types and provide user-friendly messages
+    error_class, user_message = classify_download_error(e)
+    download_progress[download_id]['error_class'] = error_class
+    download_progress[download_id]['user_message'] = user_message
+    finish_job(download_id)
+    return user_message
+
+def build_download_command(url, format_id, staging_dir, video_info=None, section=None, identity=None, proxy=None):
+    """Build the yt-dlp command line that downloads the raw streams of a job into its staging directory"""
+    # Build the yt-dlp command
+    cmd = ["yt-dlp", "--newline"]
+    
+    # Sign in as the job's identity, or with cookies.txt/environment credentials
+    cmd.extend(identity_command_args(identity))
+    cmd.extend(proxy_command_args(proxy))
+    
+    # Add format selection. Merged formats are fetched as separate raw streams,
+    # the post-processing stage combines them afterwards.
+    cmd.extend(["--format", stream_format_selector(format_id)])
+    
+    # Add output template
+    cmd.extend(["--output", stream_output_template(staging_dir)])
+    
+    # Fetch only the requested time range, cutting at exact times rather than the nearest keyframes
+    if section:
+        cmd.extend(["--download-sections", format_section_spec(section), "--force-keyframes-at-cuts",
+                    "--downloader-args", CLIP_PROGRESS_DOWNLOADER_ARGS])
+    
+    # Have yt-dlp report where each stream ended up (--print implies --quiet, so keep the progress lines)
+    cmd.extend(["--print", f"after_move:{STREAM_PATH_MARKER}%(filepath)s", "--progress"])
         
-        # Build the yt-dlp command
-        cmd = ["yt-dlp", "--newline"]
+    # Add options to bypass YouTube restrictions
+    cmd.extend([
+        "--extractor-retries", "5",       # Retry extraction 5 times
+        "--fragment-retries", "10",       # Retry fragments 10 times
+        "--retry-sleep", "5",             # Sleep 5 seconds between retries
+        "--skip-unavailable-fragments",   # Skip unavailable fragments
+        "--no-check-certificates",        # Don't check certificates
+        "--geo-bypass",                   # Try to bypass geo-restrictions
+    ])
+    
+    # Reuse the cached extraction if we have one, otherwise let yt-dlp extract the URL again
+    if video_info:
+        info_path = write_info_json(video_info, os.path.join(staging_dir, "info.json"))
+        cmd.extend(["--load-info-json", info_path])
+    else:
+        cmd.append(url)
+    
+    # Log the command (without credentials)
+    safe_cmd = cmd.copy()
+    if "--username" in safe_cmd:
+        # Replace username and password with asterisks in the log
+        try:
+            username_index = safe_cmd.index("--username")
+            password_index = safe_cmd.index("--password")
+            safe_cmd[username_index + 1] = "********"
+            safe_cmd[password_index + 1] = "********"
+        except ValueError:
+            # If for some reason the indexes aren't found, just continue
+            pass
+    if proxy is not None and "--proxy" in safe_cmd:
+        safe_cmd[safe_cmd.index("--proxy") + 1] = proxy_label(proxy)
+    app.logger.info(f"Running command: {' '.join(safe_cmd)}")
+    
+    return cmd
+
+def handle_download_output_line(download_id, line, stream_paths, error_lines):
+    """Update progress, stream paths and collected errors from one line of yt-dlp output"""
+    is_progress = "[download]" in line and "%" in line
+    log_output_line(download_id, line, is_progress)
+    
+    # Collect error messages
+    if "ERROR:" in line or "WARNING:" in line:
+        error_lines.append(line)
+    
+    # Update progress based on output (a cancelled job may already be gone)
+    progress = download_progress.get(download_id) or {}
+    if is_progress:
+        try:
+            # Extract percentage
+            percent_match = PROGRESS_PERCENT_RE.search(line)
+            if percent_match:
+                # Collected first so the job record changes (and gets a new version) once per line
+                fields = {'progress': float(percent_match.group(1)), 'status': 'Downloading...'}
+                
+                # Extract speed
+                speed_match = PROGRESS_SPEED_RE.search(line)
+                if speed_match:
+                    fields['speed'] = speed_match.group(1)
+                
+                # Extract ETA
+                eta_match = PROGRESS_ETA_RE.search(line)
+                if eta_match:
+                    fields['eta'] = eta_match.group(1)
+                
+                # Extract file size
+                size_match = PROGRESS_SIZE_RE.search(line)
+                if size_match:
+                    fields['downloaded'] = size_match.group(1)
+                    fields['total_size'] = size_match.group(2)
+                progress.update(fields)
+        except Exception as e:
+            app.logger.error("Error parsing progress for %s: %s", download_id, e, extra={'download_id': download_id})
         
-        # Add cookies if available (preferred method)
-        if USE_YOUTUBE_COOKIES and COOKIES_FILE:
-            app.logger.info("Using YouTube cookies for download")
-            cmd.extend(["--cookies", COOKIES_FILE])
-        # Fall back to username/password if no cookies
+        # yt-dlp ends each stream with "100% of 12.34MiB in 00:00:05 at 2.45MiB/s"
+        done_match = PROGRESS_DONE_RE.search(line) if "100" in line else None
+        if done_match:
+            num_bytes = parse_file_size(done_match.group(1), done_match.group(2))
+            seconds = 0
+            for part in done_match.group(3).split(':'):
+                seconds = seconds * 60 + int(part)
+            record_throughput('download', num_bytes, seconds)
+    
+    # Clips are downloaded by ffmpeg, which reports the position reached in the clip
+    elif line.startswith(CLIP_POSITION_PREFIX) and progress.get('section'):
+        try:
+            apply_clip_position(progress, int(line[len(CLIP_POSITION_PREFIX):]) / 1e6)
+        except ValueError:
+            pass  # "N/A" until the first frame is written
+    
+    # Final path of each stream, as reported by yt-dlp
+    elif line.startswith(STREAM_PATH_MARKER):
+        stream_paths.append(line[len(STREAM_PATH_MARKER):])
+        app.logger.info(f"Found stream path: {stream_paths[-1]}")
+
+def apply_clip_position(progress, position):
+    """Set a clip job's progress from the position (seconds into the clip) ffmpeg has reached"""
+    start, end = progress['section']
+    progress.update({'progress': max(0.0, min(99.0, round(position / (end - start) * 100, 1))),
+                     'status': 'Downloading clip...'})
+
+def parse_file_size(value, unit):
+    """Convert a size such as ('12.34', 'MiB') from yt-dlp output to bytes"""
+    multipliers = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3,
+                   'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3}
+    return int(float(value) * multipliers.get(unit, 1))
+
+def log_output_line(download_id, line, is_progress=False):
+    """Log a line of yt-dlp output: errors and warnings always, other lines sampled and rate-limited at debug level"""
+    extra = {'download_id': download_id, 'event': 'ytdlp_output'}
+    if line.startswith("ERROR:"):
+        app.logger.error("[%s] yt-dlp: %s", download_id, line, extra=extra)
+        return
+    if line.startswith("WARNING:"):
+        app.logger.warning("[%s] yt-dlp: %s", download_id, line, extra=extra)
+        return
+    if not app.logger.isEnabledFor(logging.DEBUG):
+        return
+    
+    state = output_log_state.get(download_id)
+    if state is None:
+        state = output_log_state[download_id] = {'progress_lines': 0, 'tokens': LOG_OUTPUT_LINES_PER_SECOND,
+                                                 'refilled': time.monotonic(), 'dropped': 0}
+    if is_progress:
+        # Progress lines arrive many times per second, keep every Nth one
+        state['progress_lines'] += 1
+        if LOG_PROGRESS_SAMPLE <= 0 or state['progress_lines'] % LOG_PROGRESS_SAMPLE != 1 % LOG_PROGRESS_SAMPLE:
+            return
+    
+    # Token bucket: at most LOG_OUTPUT_LINES_PER_SECOND lines per second per job
+    now = time.monotonic()
+    state['tokens'] = min(LOG_OUTPUT_LINES_PER_SECOND,
+                          state['tokens'] + (now - state['refilled']) * LOG_OUTPUT_LINES_PER_SECOND)
+    state['refilled'] = now
+    if state['tokens'] < 1:
+        state['dropped'] += 1
+        return
+    state['tokens'] -= 1
+    if state['dropped']:
+        app.logger.debug("[%s] suppressed %d yt-dlp output lines", download_id, state['dropped'], extra=extra)
+        state['dropped'] = 0
+    app.logger.debug("[%s] yt-dlp: %s", download_id, line, extra=extra)
+
+def describe_ytdlp_failure(error_lines):
+    """Turn the error lines of a failed yt-dlp run into a user-facing error message"""
+    error_message = "Unknown error"
+    if error_lines:
+        error_message = "; ".join(error_lines)
+    
+    # Check for specific error patterns
+    if any("Sign in to confirm you're not a bot" in line for line in error_lines):
+        if USE_YOUTUBE_COOKIES or identity_pool:
+            app.logger.error("Anti-bot protection triggered despite cookies")
+            error_message = "YouTube anti-bot protection triggered despite using cookies. Your cookies may be expired or invalid."
         elif USE_YOUTUBE_AUTH:
-            app.logger.info("Using YouTube authentication for download")
-            cmd.extend(["--username", YOUTUBE_USERNAME, "--password", YOUTUBE_PASSWORD])
-        
-        # Add format selection
-        cmd.extend(["--format", format_id])
+            app.logger.error("Anti-bot protection triggered despite authentication")
+            error_message = "YouTube anti-bot protection triggered despite using authentication."
+        else:
+            error_message = "YouTube is blocking this request due to anti-bot protection. Try using cookies or authentication."
+    
+    # Check for cookie-related errors
+    elif any("Cookie file" in line for line in error_lines) and (USE_YOUTUBE_COOKIES or identity_pool):
+        app.logger.error("Cookie file error detected")
+        error_message = "There was an error with the cookie file. Make sure it's in the correct Netscape format."
+    
+    # Check for format-related errors
+    elif any("requested format not available" in line.lower() for line in error_lines):
+        app.logger.error("Format not available error detected")
+        error_message = "The requested video format is not available. Try a different format."
         
-        # Add output template
-        cmd.extend(["--output", output_template])
+    # Check for HTTP 403 Forbidden errors
+    elif any("HTTP Error 403: Forbidden" in line for line in error_lines):
+        app.logger.error("HTTP 403 Forbidden error detected")
+        error_message = "YouTube is blocking this download (HTTP 403 Forbidden). This usually happens when YouTube's API restrictions are in place. Try using a different format or try again later."
         
-        # Add post-processing for audio if needed
-        if is_audio:
-            cmd.extend(["--extract-audio", "--audio-format", "mp3", "--audio-quality", "192"])
-        else:
-            # For video, ensure the output is always MP4
-            cmd.extend(["--merge-output-format", "mp4"])
-            
-        # Add options to bypass YouTube restrictions
-        cmd.extend([
-            "--extractor-retries", "5",       # Retry extraction 5 times
-            "--fragment-retries", "10",       # Retry fragments 10 times
-            "--retry-sleep", "5",             # Sleep 5 seconds between retries
-            "--skip-unavailable-fragments",   # Skip unavailable fragments
-            "--no-check-certificates",        # Don't check certificates
-            "--geo-bypass",                   # Try to bypass geo-restrictions
-        ])
-        
-        # Add the URL
-        cmd.append(url)
+    # Check for Precondition check failed errors
+    elif any("Precondition check failed" in line for line in error_lines):
+        app.logger.error("Precondition check failed error detected")
+        error_message = "YouTube API returned 'Precondition check failed'. This usually indicates that your cookies are expired or the selected format is currently restricted. Try refreshing your cookies or selecting a different format."
         
-        # Log the command (without credentials)
-        safe_cmd = cmd.copy()
-        if USE_YOUTUBE_AUTH and "--username" in safe_cmd:
-            # Replace username and password with asterisks in the log
-            try:
-                username_index = safe_cmd.index("--username")
-                password_index = safe_cmd.index("--password")
-                safe_cmd[username_index + 1] = "********"
-                safe_cmd[password_index + 1] = "********"
-            except ValueError:
-                # If for some reason the indexes aren't found, just continue
-                pass
-        app.logger.info(f"Running command: {' '.join(safe_cmd)}")
+    # Check for throttling warnings
+    elif any("throttling" in line.lower() for line in error_lines):
+        app.logger.error("Throttling warning detected")
+        error_message = "YouTube is throttling this download. Try selecting a different format or try again later."
+    
+    return error_message
+
+def download_with_subprocess(url, format_id, download_id, staging_dir, video_info=None):
+    """Download using subprocess call to yt-dlp command line and return the paths of the raw streams"""
+    identity = acquire_identity(download_id)
+    proxy = acquire_proxy(download_id)
+    started = time.time()
+    try:
+        cmd = build_download_command(url, format_id, staging_dir, video_info,
+                                     download_progress[download_id].get('section'), identity, proxy)
         
         # Start the process
         process = subprocess.Popen(
@@ -491,179 +1617,183 @@ def download_with_subprocess(url, format_id, download_id, filename, format_mode,
             bufsize=1,
             universal_newlines=True
         )
+        track_child_process(process, download_id)
         
         # Process output line by line to update progress
-        final_output_path = None
+        stream_paths = []
         error_lines = []
-        for line in process.stdout:
-            line = line.strip()
-            app.logger.debug(f"yt-dlp output: {line}")
-            
-            # Collect error messages
-            if "ERROR:" in line or "WARNING:" in line:
-                error_lines.append(line)
-                app.logger.error(f"yt-dlp error/warning: {line}")
-            
-            # Update progress based on output
-            if "[download]" in line and "%" in line:
-                try:
-                    # Extract percentage
-                    percent_match = re.search(r'(\d+\.\d+)%', line)
-                    if percent_match:
-                        percent = float(percent_match.group(1))
-                        download_progress[download_id]['progress'] = percent
-                        download_progress[download_id]['status'] = 'Downloading...'
-                        
-                        # Extract speed
-                        speed_match = re.search(r'(\d+\.\d+\s*[KMG]iB/s)', line)
-                        if speed_match:
-                            download_progress[download_id]['speed'] = speed_match.group(1)
-                        
-                        # Extract ETA
-                        eta_match = re.search(r'ETA\s+(\d+:\d+)', line)
-                        if eta_match:
-                            download_progress[download_id]['eta'] = eta_match.group(1)
-                        
-                        # Extract file size
-                        size_match = re.search(r'(\d+\.\d+\s*[KMG]iB)\s+of\s+(\d+\.\d+\s*[KMG]iB)', line)
-                        if size_match:
-                            download_progress[download_id]['downloaded'] = size_match.group(1)
-                            download_progress[download_id]['total_size'] = size_match.group(2)
-                except Exception as e:
-                    app.logger.error(f"Error parsing progress: {e}")
-            
-            # Check for post-processing
-            elif "Extracting audio" in line or "Merging formats" in line or "Recoding video" in line:
-                download_progress[download_id]['status'] = 'Post-processing...'
-                download_progress[download_id]['progress'] = 95
-            
-            # Check for destination file
-            elif "[ExtractAudio] Destination:" in line:
-                try:
-                    final_output_path = line.split("[ExtractAudio] Destination:")[1].strip()
-                    app.logger.info(f"Found destination path: {final_output_path}")
-                except Exception as e:
-                    app.logger.error(f"Error parsing destination: {e}")
+        try:
+            for line in process.stdout:
+                line = line.strip()
+                handle_download_output_line(download_id, line, stream_paths, error_lines)
             
-            # Check for download completion
-            elif "Deleting original file" in line or "has already been downloaded" in line:
-                download_progress[download_id]['status'] = 'Finalizing...'
-                download_progress[download_id]['progress'] = 99
-        
-        # Wait for process to complete
-        process.wait()
+            # Wait for process to complete
+            process.wait()
+        finally:
+            untrack_child_process(process)
         
         # Check if process completed successfully
         if process.returncode != 0:
-            error_message = "Unknown error"
-            if error_lines:
-                error_message = "; ".join(error_lines)
-            
-            # Check for specific error patterns
-            if any("Sign in to confirm you're not a bot" in line for line in error_lines):
-                if USE_YOUTUBE_COOKIES:
-                    app.logger.error("Anti-bot protection triggered despite cookies")
-                    error_message = "YouTube anti-bot protection triggered despite using cookies. Your cookies may be expired or invalid."
-                elif USE_YOUTUBE_AUTH:
-                    app.logger.error("Anti-bot protection triggered despite authentication")
-                    error_message = "YouTube anti-bot protection triggered despite using authentication."
-                else:
-                    error_message = "YouTube is blocking this request due to anti-bot protection. Try using cookies or authentication."
-            
-            # Check for cookie-related errors
-            elif any("Cookie file" in line for line in error_lines) and USE_YOUTUBE_COOKIES:
-                app.logger.error("Cookie file error detected")
-                error_message = "There was an error with the cookie file. Make sure it's in the correct Netscape format."
-            
-            # Check for format-related errors
-            elif any("requested format not available" in line.lower() for line in error_lines):
-                app.logger.error("Format not available error detected")
-                error_message = "The requested video format is not available. Try a different format."
-                
-            # Check for HTTP 403 Forbidden errors
-            elif any("HTTP Error 403: Forbidden" in line for line in error_lines):
-                app.logger.error("HTTP 403 Forbidden error detected")
-                error_message = "YouTube is blocking this download (HTTP 403 Forbidden). This usually happens when YouTube's API restrictions are in place. Try using a different format or try again later."
-                
-            # Check for Precondition check failed errors
-            elif any("Precondition check failed" in line for line in error_lines):
-                app.logger.error("Precondition check failed error detected")
-                error_message = "YouTube API returned 'Precondition check failed'. This usually indicates that your cookies are expired or the selected format is currently restricted. Try refreshing your cookies or selecting a different format."
-                
-            # Check for throttling warnings
-            elif any("throttling" in line.lower() for line in error_lines):
-                app.logger.error("Throttling warning detected")
-                error_message = "YouTube is throttling this download. Try selecting a different format or try again later."
-            
+            error_message = describe_ytdlp_failure(error_lines)
             app.logger.error(f"yt-dlp process failed with return code {process.returncode}: {error_message}")
             raise Exception(f"yt-dlp process failed: {error_message}")
         
-        return find_and_process_output_file(download_id, base_filename, output_template, is_audio)
+        release_identity(identity)
+        release_proxy(proxy, num_bytes=total_file_size(stream_paths), seconds=time.time() - started)
+        return stream_paths
         
     except Exception as e:
+        release_identity(identity, e)
+        release_proxy(proxy, e)
         app.logger.error(f"Subprocess download error: {str(e)}", exc_info=True)
-        download_progress[download_id]['status'] = f'Error: {str(e)}'
-        download_progress[download_id]['error'] = str(e)
+        if not download_progress[download_id].get('cancelled'):
+            download_progress[download_id]['status'] = f'Error: {str(e)}'
+            download_progress[download_id]['error'] = str(e)
         raise
 
-def download_with_python_lib(url, format_id, download_id, filename, format_mode, output_template):
-    """Download using yt-dlp Python library"""
+def start_library_pool():
+    """Start the yt-dlp library worker processes and their progress relay if they are not running yet"""
+    global library_pool, library_progress_queue, library_slots
+    with library_pool_lock:
+        if library_slots is None:
+            library_slots = threading.BoundedSemaphore(LIBRARY_WORKERS)
+        if library_pool is None:
+            # Not "fork": the web process runs threads, and recycling workers needs spawn or forkserver
+            context = multiprocessing.get_context('spawn')
+            if library_progress_queue is None:
+                library_progress_queue = context.Queue()
+                threading.Thread(target=relay_library_progress, args=(library_progress_queue,),
+                                 name="library-progress", daemon=True).start()
+            options = {}
+            if LIBRARY_MAX_TASKS_PER_CHILD > 0 and sys.version_info >= (3, 11):
+                options['max_tasks_per_child'] = LIBRARY_MAX_TASKS_PER_CHILD
+            library_pool = ProcessPoolExecutor(max_workers=LIBRARY_WORKERS, mp_context=context,
+                                               initializer=library_worker.init_worker,
+                                               initargs=(library_progress_queue,), **options)
+            app.logger.info(f"Started {LIBRARY_WORKERS} yt-dlp library worker processes")
+        return library_pool
+
+def run_library_task(func, *args, download_id=None):
+    """Run a library_worker function in the worker pool (or in-process with LIBRARY_WORKERS=0) and return its result.
+    
+    A task of a job that is cancelled while it waits for a free worker is dropped. A running
+    task cannot be interrupted, its caller has to discard the result.
+    """
+    global library_pool
+    if LIBRARY_WORKERS <= 0:
+        return func(*args)
+    start_library_pool()
+    
+    def cancelled():
+        return download_id is not None and download_progress.get(download_id, {}).get('cancelled')
+    
+    # The pool queues ahead for its workers and nothing in its queue can be cancelled any more,
+    # so it is only handed as many tasks as it has workers
+    while not library_slots.acquire(timeout=LIBRARY_CANCEL_POLL):
+        if cancelled():
+            raise Exception("Download was cancelled before it started")
+    try:
+        if cancelled():
+            raise Exception("Download was cancelled before it started")
+        pool = start_library_pool()
+        try:
+            return pool.submit(func, *args).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool for the next task
+            with library_pool_lock:
+                if library_pool is pool:
+                    library_pool = None
+            raise Exception("The yt-dlp worker process crashed")
+    finally:
+        library_slots.release()
+
+def stop_library_pool():
+    """Shut the library worker pool down, ending downloads that are still running in it"""
+    global library_pool
+    with library_pool_lock:
+        pool, library_pool = library_pool, None
+    if pool is None:
+        return
+    # The executor cannot interrupt running tasks, so its workers are terminated directly
+    workers = list((pool._processes or {}).values())
+    pool.shutdown(wait=False)
+    for worker in workers:
+        worker.terminate()
+
+def relay_library_progress(progress_queue):
+    """Apply the progress updates that library workers send for their downloads"""
+    while True:
+        try:
+            download_id, d = progress_queue.get()
+            # A cancelled download may still be running in its worker, its progress is stale
+            if download_id in download_progress and not download_progress[download_id].get('cancelled'):
+                apply_library_progress(download_id, d)
+        except Exception as e:
+            app.logger.error(f"Error relaying library progress: {str(e)}")
+
+def apply_library_progress(download_id, d):
+    """Update a job's progress entry from a (compacted) yt-dlp library progress dict"""
+    if d['status'] == 'downloading' and 'clip_position' in d:
+        if download_progress[download_id].get('section'):
+            apply_clip_position(download_progress[download_id], d['clip_position'])
+    
+    elif d['status'] == 'downloading':
+        try:
+            if 'downloaded_bytes' in d and 'total_bytes' in d and d['total_bytes'] > 0:
+                percent = (d['downloaded_bytes'] / d['total_bytes']) * 100
+                download_progress[download_id]['progress'] = percent
+                download_progress[download_id]['status'] = 'Downloading...'
+                
+                # Update speed if available
+                if 'speed' in d and d['speed']:
+                    speed_bps = d['speed']
+                    if speed_bps < 1024:
+                        speed_str = f"{speed_bps:.2f} B/s"
+                    elif speed_bps < 1024 * 1024:
+                        speed_str = f"{speed_bps / 1024:.2f} KiB/s"
+                    else:
+                        speed_str = f"{speed_bps / (1024 * 1024):.2f} MiB/s"
+                    download_progress[download_id]['speed'] = speed_str
+                
+                # Update ETA if available
+                if 'eta' in d and d['eta']:
+                    minutes, seconds = divmod(d['eta'], 60)
+                    download_progress[download_id]['eta'] = f"{minutes:02d}:{seconds:02d}"
+                
+                # Update file size info
+                if 'downloaded_bytes' in d and 'total_bytes' in d:
+                    downloaded = format_file_size(d['downloaded_bytes'])
+                    total = format_file_size(d['total_bytes'])
+                    download_progress[download_id]['downloaded'] = downloaded
+                    download_progress[download_id]['total_size'] = total
+        except Exception as e:
+            app.logger.error(f"Error in progress callback: {str(e)}")
+    
+    elif d['status'] == 'finished':
+        download_progress[download_id]['status'] = 'Downloading...'
+        record_throughput('download', d.get('total_bytes') or d.get('downloaded_bytes') or 0, d.get('elapsed') or 0)
+    
+    elif d['status'] == 'error':
+        error_msg = d.get('error', 'Unknown error')
+        app.logger.error(f"Error in download: {error_msg}")
+        download_progress[download_id]['status'] = f'Error: {error_msg}'
+        download_progress[download_id]['error'] = error_msg
+
+def download_with_python_lib(url, format_id, download_id, staging_dir, video_info=None):
+    """Download using yt-dlp Python library and return the paths of the raw streams"""
+    identity = acquire_identity(download_id)
+    proxy = acquire_proxy(download_id)
+    started = time.time()
     try:
-        is_audio = format_mode == "mp3"
-        base_filename = os.path.splitext(filename)[0]
-        
-        # Create a progress hook that updates our progress tracking
-        def progress_callback(d):
-            if d['status'] == 'downloading':
-                try:
-                    if 'downloaded_bytes' in d and 'total_bytes' in d and d['total_bytes'] > 0:
-                        percent = (d['downloaded_bytes'] / d['total_bytes']) * 100
-                        download_progress[download_id]['progress'] = percent
-                        download_progress[download_id]['status'] = 'Downloading...'
-                        
-                        # Update speed if available
-                        if 'speed' in d and d['speed']:
-                            speed_bps = d['speed']
-                            if speed_bps < 1024:
-                                speed_str = f"{speed_bps:.2f} B/s"
-                            elif speed_bps < 1024 * 1024:
-                                speed_str = f"{speed_bps / 1024:.2f} KiB/s"
-                            else:
-                                speed_str = f"{speed_bps / (1024 * 1024):.2f} MiB/s"
-                            download_progress[download_id]['speed'] = speed_str
-                        
-                        # Update ETA if available
-                        if 'eta' in d and d['eta']:
-                            minutes, seconds = divmod(d['eta'], 60)
-                            download_progress[download_id]['eta'] = f"{minutes:02d}:{seconds:02d}"
-                        
-                        # Update file size info
-                        if 'downloaded_bytes' in d and 'total_bytes' in d:
-                            downloaded = format_file_size(d['downloaded_bytes'])
-                            total = format_file_size(d['total_bytes'])
-                            download_progress[download_id]['downloaded'] = downloaded
-                            download_progress[download_id]['total_size'] = total
-                except Exception as e:
-                    app.logger.error(f"Error in progress callback: {str(e)}")
-            
-            elif d['status'] == 'finished':
-                download_progress[download_id]['status'] = 'Post-processing...'
-                download_progress[download_id]['progress'] = 95
-            
-            elif d['status'] == 'error':
-                error_msg = d.get('error', 'Unknown error')
-                app.logger.error(f"Error in download: {error_msg}")
-                download_progress[download_id]['status'] = f'Error: {error_msg}'
-                download_progress[download_id]['error'] = error_msg
-        
         # Configure yt-dlp options
         ydl_opts = {
-            'format': format_id,
-            'outtmpl': output_template,
-            'progress_hooks': [progress_callback],
-            'quiet': False,
+            'format': stream_format_selector(format_id),
+            'outtmpl': stream_output_template(staging_dir),
+            # Progress and errors are reported through hooks and exceptions, not the console
+            'quiet': True,
+            'noprogress': True,
             'no_warnings': False,
-            'verbose': True,  # Enable verbose output for better error messages
+            'verbose': app.logger.isEnabledFor(logging.DEBUG),
             
             # Add options to bypass YouTube restrictions
             'extractor_retries': 5,           # Retry extraction 5 times
@@ -676,41 +1806,30 @@ def download_with_python_lib(url, format_id, download_id, filename, format_mode,
             'nocheckcertificate': True,       # Don't check certificates (alternative option)
         }
         
-        # Add cookies if available (preferred method)
-        if USE_YOUTUBE_COOKIES and COOKIES_FILE:
-            app.logger.info("Using YouTube cookies with Python library for download")
-            ydl_opts.update({
-                'cookiefile': COOKIES_FILE,
-            })
-        # Fall back to username/password if no cookies
-        elif USE_YOUTUBE_AUTH:
-            app.logger.info("Using YouTube authentication with Python library for download")
-            ydl_opts.update({
-                'username': YOUTUBE_USERNAME,
-                'password': YOUTUBE_PASSWORD,
-            })
-        
-        # Add post-processing for audio if needed
-        if is_audio:
-            ydl_opts.update({
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }]
-            })
-        else:
-            # For video, ensure the output is always MP4
-            ydl_opts.update({
-                'merge_output_format': 'mp4',
-            })
+        ydl_opts.update(identity_library_options(identity))
+        ydl_opts.update(proxy_library_options(proxy))
+        
+        # Reuse the cached extraction instead of fetching the page again
+        info_path = write_info_json(video_info, os.path.join(staging_dir, "info.json")) if video_info else None
+        section = download_progress[download_id].get('section')
         
         # Start the download
-        app.logger.info(f"Starting yt-dlp Python library download with options: {ydl_opts}")
+        app.logger.info("Starting yt-dlp Python library download for %s", download_id, extra={'download_id': download_id})
+        app.logger.debug("Library download options for %s: %s", download_id,
+                         {key: ('********' if key == 'password' else value) for key, value in ydl_opts.items()},
+                         extra={'download_id': download_id})
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+            if LIBRARY_WORKERS > 0:
+                # Progress comes back over the pool's queue, see relay_library_progress
+                stream_paths = run_library_task(library_worker.download, download_id, url, info_path, ydl_opts, section,
+                                                download_id=download_id)
+            else:
+                stream_paths = library_worker.download(download_id, url, info_path, ydl_opts, section,
+                                                       lambda d: apply_library_progress(download_id, d))
         except yt_dlp.utils.DownloadError as e:
+            if download_progress[download_id].get('cancelled'):
+                # Cancelling removed the staging directory under the still running download
+                raise Exception("Download was cancelled")
             error_str = str(e)
             app.logger.error(f"yt-dlp download error: {error_str}")
             
@@ -774,81 +1893,1010 @@ def download_with_python_lib(url, format_id, download_id, filename, format_mode,
             download_progress[download_id]['error'] = error_str
             raise Exception(f"yt-dlp download failed: {error_str}")
         
-        download_progress[download_id]['status'] = 'Finalizing...'
-        download_progress[download_id]['progress'] = 99
+        release_identity(identity)
+        release_proxy(proxy, num_bytes=total_file_size(stream_paths), seconds=time.time() - started)
+        return stream_paths
+        
+    except Exception as e:
+        release_identity(identity, e)
+        release_proxy(proxy, e)
+        app.logger.error(f"Python library download error: {str(e)}", exc_info=True)
+        if not download_progress[download_id].get('cancelled'):
+            download_progress[download_id]['status'] = f'Error: {str(e)}'
+            download_progress[download_id]['error'] = str(e)
+        raise
+
+def is_cacheable_format_id(format_id):
+    """Only plain format ids name a single elementary stream; selectors like 'best[height<=720]' do not"""
+    return bool(re.match(r'^[\w-]+$', format_id))
+
+def stream_cache_filename(video_id, format_id, ext):
+    """Name of a cached stream file; video ids never contain dots, so it can be parsed back"""
+    return f"{video_id}.f{format_id}.{ext}"
+
+def load_stream_cache_index():
+    """Rebuild the stream cache index from the files in the cache tier (oldest first)"""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(STORAGE_ROOTS['cache']):
+        for name in filenames:
+            parts = name.split('.')
+            if len(parts) != 3 or not parts[1].startswith('f'):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, (parts[0], parts[1][1:]), path, stat.st_size))
+    
+    with stream_cache_lock:
+        stream_cache.clear()
+        stream_cache_stats['bytes'] = 0
+        for mtime, key, path, size in sorted(entries):
+            stream_cache[key] = {'path': path, 'size': size, 'stored': mtime}
+            stream_cache_stats['bytes'] += size
+    app.logger.info(f"Stream cache holds {len(stream_cache)} stream(s), {format_file_size(stream_cache_stats['bytes'])}")
+
+def evict_stream_cache_entry(key):
+    """Drop a stream from the cache and delete its file (caller holds the lock)"""
+    entry = stream_cache.pop(key)
+    stream_cache_stats['bytes'] -= entry['size']
+    stream_cache_stats['evictions'] += 1
+    try:
+        os.remove(entry['path'])
+    except OSError as e:
+        app.logger.error(f"Error removing cached stream {entry['path']}: {str(e)}")
+
+def link_or_copy(src_path, dst_path):
+    """Hard-link a file (cheap, same filesystem) or fall back to copying it"""
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+def checkout_cached_streams(video_info, format_id, staging_dir, section=None):
+    """Link cached streams of a job into its staging directory.
+    
+    Returns the cached paths by format id and the format ids that still have to be downloaded.
+    Clips are cut while downloading, so they never use the cache of full streams.
+    """
+    format_ids = format_id.split('+')
+    if section or not STREAM_CACHE_MAX_BYTES or not video_info or not video_info.get('id') \
+            or not all(is_cacheable_format_id(fid) for fid in format_ids):
+        return {}, [format_id]
+    
+    cached_paths = {}
+    missing_ids = []
+    hits = []
+    now = time.time()
+    with stream_cache_lock:
+        for fid in format_ids:
+            key = (video_info['id'], fid)
+            entry = stream_cache.get(key)
+            if entry and now - entry['stored'] > STREAM_CACHE_TTL:
+                # Past the retention window
+                evict_stream_cache_entry(key)
+                entry = None
+            if not entry or not os.path.exists(entry['path']):
+                if entry:
+                    evict_stream_cache_entry(key)
+                stream_cache_stats['misses'] += 1
+                missing_ids.append(fid)
+                continue
+            
+            stream_cache.move_to_end(key)
+            stream_cache_stats['hits'] += 1
+            stream_cache_stats['bytes_served'] += entry['size']
+            hits.append((fid, entry))
+    
+    # A copy across filesystems can take long, so it runs without the lock
+    for fid, entry in hits:
+        staged_path = os.path.join(staging_dir, os.path.basename(entry['path']))
+        try:
+            link_or_copy(entry['path'], staged_path)
+        except OSError as e:
+            # Evicted in the meantime, or unreadable: download it after all
+            app.logger.warning(f"Could not use cached stream {entry['path']}: {str(e)}")
+            try:
+                os.remove(staged_path)
+            except OSError:
+                pass
+            with stream_cache_lock:
+                stream_cache_stats['hits'] -= 1
+                stream_cache_stats['bytes_served'] -= entry['size']
+                stream_cache_stats['misses'] += 1
+            missing_ids.append(fid)
+            continue
+        cached_paths[fid] = staged_path
+    missing_ids.sort(key=format_ids.index)
+    
+    if cached_paths:
+        app.logger.info(f"Stream cache hit for {video_info['id']}: {', '.join(cached_paths)}")
+    return cached_paths, missing_ids
+
+def cache_downloaded_streams(video_info, stream_paths, section=None):
+    """Add freshly downloaded streams to the cache and evict the least recently used ones beyond the size limit"""
+    if section or not STREAM_CACHE_MAX_BYTES or not video_info or not video_info.get('id'):
+        return
+    
+    for path in stream_paths:
+        # Stream files are named f<format_id>.<ext> by stream_output_template
+        name, ext = os.path.splitext(os.path.basename(path))
+        if not name.startswith('f') or not is_cacheable_format_id(name[1:]) or not os.path.isfile(path):
+            continue
+        key = (video_info['id'], name[1:])
+        size = os.path.getsize(path)
+        if size > STREAM_CACHE_MAX_BYTES:
+            continue
+        
+        cache_path = storage_path(stream_cache_filename(key[0], key[1], ext.lstrip('.')), 'cache')
+        with stream_cache_lock:
+            if key in stream_cache or key in stream_cache_pending:
+                continue
+            stream_cache_pending.add(key)
+        # Copied without the lock under a name the cache index ignores, and only listed once complete
+        partial_path = cache_path + '.part'
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            link_or_copy(path, partial_path)
+            os.replace(partial_path, cache_path)
+        except OSError as e:
+            app.logger.error(f"Error caching stream {path}: {str(e)}")
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+            with stream_cache_lock:
+                stream_cache_pending.discard(key)
+            continue
+        with stream_cache_lock:
+            stream_cache_pending.discard(key)
+            stream_cache[key] = {'path': cache_path, 'size': size, 'stored': time.time()}
+            stream_cache_stats['bytes'] += size
+            while stream_cache_stats['bytes'] > STREAM_CACHE_MAX_BYTES and stream_cache:
+                evict_stream_cache_entry(next(iter(stream_cache)))
+
+def merge_stream_paths(format_id, cached_paths, downloaded_paths):
+    """Put cached and downloaded streams back into the order of the format id (video first, then audio)"""
+    if not cached_paths:
+        return downloaded_paths
+    downloaded_by_id = {}
+    for path in downloaded_paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        downloaded_by_id[name[1:]] = path
+    return [cached_paths.get(fid) or downloaded_by_id.get(fid) for fid in format_id.split('+')
+            if cached_paths.get(fid) or downloaded_by_id.get(fid)]
+
+def speculate_extraction(url):
+    """Start extracting a URL in the background unless that is already under way, returns the speculation's state"""
+    if SPECULATION not in ('extract', 'warm'):
+        return 'disabled'
+    expire_speculation()
+    with speculation_lock:
+        entry = speculative_extractions.get(url)
+        if entry:
+            return 'ready' if entry['future'].done() else 'pending'
+        running = sum(1 for entry in speculative_extractions.values() if not entry['future'].done())
+        if running >= SPECULATION_MAX_EXTRACTIONS or len(speculative_extractions) >= SPECULATION_MAX_ENTRIES:
+            return 'busy'
+        speculative_extractions[url] = {'future': speculation_executor.submit(get_video_info, url),
+                                        'started': time.time()}
+        speculation_stats['extractions'] += 1
+    app.logger.info(f"Speculatively extracting {url}")
+    return 'started'
+
+def claim_speculative_info(url):
+    """The info dict a speculative extraction fetched for a URL (waiting for it if still running), None if there is none"""
+    if SPECULATION not in ('extract', 'warm'):
+        return None
+    with speculation_lock:
+        entry = speculative_extractions.pop(url, None)
+        if entry is None:
+            speculation_stats['extraction_misses'] += 1
+            return None
+    try:
+        video_info = entry['future'].result()
+    except Exception as e:
+        # Extract again: the failure may have been down to the identity or proxy it used
+        app.logger.info(f"Speculative extraction of {url} failed, extracting again: {str(e)}")
+        with speculation_lock:
+            speculation_stats['extraction_misses'] += 1
+        return None
+    with speculation_lock:
+        speculation_stats['extraction_hits'] += 1
+    return video_info
+
+def start_warming(token, url, choice, video_info):
+    """Fetch the streams of the preselected choice into the stream cache while the user is still choosing"""
+    if SPECULATION != 'warm' or not USE_YTDLP_COMMAND or not STREAM_CACHE_MAX_BYTES or not video_info.get('id'):
+        return False
+    format_ids = choice['id'].split('+')
+    # Unknown sizes cannot be bounded, selectors like 'best[height<=720]' cannot be cached
+    if not 0 < (choice.get('size') or 0) <= SPECULATION_MAX_BYTES \
+            or not all(is_cacheable_format_id(fid) for fid in format_ids):
+        return False
+    with stream_cache_lock:
+        missing_ids = [fid for fid in format_ids if (video_info['id'], fid) not in stream_cache]
+    if not missing_ids:
+        return False
+    
+    expire_speculation()
+    with speculation_lock:
+        if sum(1 for warm in speculative_warming.values() if not warm['done'].is_set()) >= SPECULATION_MAX_WARMING:
+            return False
+        warm = speculative_warming[token] = {'streams': {}, 'process': None, 'stopped': False,
+                                             'done': threading.Event(), 'started': time.time()}
+        speculation_stats['warmings'] += 1
+    threading.Thread(target=warm_streams, args=(token, warm, url, missing_ids, video_info),
+                     name="warm-streams", daemon=True).start()
+    return True
+
+def warm_streams(token, warm, url, format_ids, video_info):
+    """Download streams one at a time at the speculation rate limit and add each finished one to the stream cache"""
+    warm_id = f"warm-{token}"
+    staging_dir = job_staging_dir(warm_id)
+    os.makedirs(staging_dir, exist_ok=True)
+    duration = video_info.get('duration')
+    try:
+        # Smallest stream (usually the audio) first, it is the most likely to be complete in time
+        for fid in sorted(format_ids, key=lambda fid: estimate_format_size(find_format(video_info, fid) or {}, duration)):
+            with speculation_lock:
+                if warm['stopped']:
+                    return
+            identity = acquire_identity(warm_id, wait=False)
+            proxy = acquire_proxy(warm_id, wait=False)
+            try:
+                cmd = build_download_command(url, fid, staging_dir, video_info, identity=identity, proxy=proxy)
+                cmd.extend(["--limit-rate", str(SPECULATION_RATE_LIMIT)])
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                track_child_process(process, warm_id)
+            except Exception as e:
+                release_identity(identity, e)
+                release_proxy(proxy, e)
+                raise
+            with speculation_lock:
+                warm['process'] = process
+                stopped = warm['stopped']
+            if stopped:
+                process.kill()
+            
+            # Not handle_download_output_line: the capped rate must not count as the node's throughput
+            stream_paths = []
+            error_lines = []
+            for line in process.stdout:
+                line = line.strip()
+                if line.startswith(STREAM_PATH_MARKER):
+                    stream_paths.append(line[len(STREAM_PATH_MARKER):])
+                elif "ERROR:" in line:
+                    error_lines.append(line)
+            process.wait()
+            untrack_child_process(process)
+            
+            with speculation_lock:
+                warm['process'] = None
+                stopped = warm['stopped']
+            # Being stopped says nothing about the identity or proxy
+            error = Exception(describe_ytdlp_failure(error_lines)) if process.returncode != 0 and not stopped else None
+            release_identity(identity, error)
+            release_proxy(proxy, error)
+            if stopped:
+                return
+            if error:
+                app.logger.info(f"Warming {fid} of {video_info['id']} failed: {str(error)}")
+                return
+            cache_downloaded_streams(video_info, stream_paths)
+            with speculation_lock:
+                warm['streams'][fid] = total_file_size(stream_paths)
+            app.logger.info(f"Warmed stream {fid} of {video_info['id']}")
+    except Exception as e:
+        app.logger.error(f"Error warming streams of {video_info.get('id')}: {str(e)}")
+    finally:
+        # Partial files stay for settle_warming unless nothing can claim them any more
+        with speculation_lock:
+            stopped = warm['stopped']
+        if not stopped:
+            remove_staging_dir(warm_id)
+        warm['done'].set()
+
+def settle_warming(token, warm, format_id=None, download_id=None):
+    """Stop a selection's warming and account for what it fetched.
+    
+    Finished streams of the chosen format are in the stream cache already. A
+    stream that was still downloading has its partial files moved into the
+    job's staging directory, where yt-dlp resumes them. Everything else that
+    was fetched is wasted.
+    """
+    with speculation_lock:
+        warm['stopped'] = True
+        process = warm['process']
+    if process is not None and process.poll() is None:
+        process.kill()
+    warm['done'].wait(10)
+    
+    chosen = set(format_id.split('+')) if format_id else set()
+    used = sum(size for fid, size in warm['streams'].items() if fid in chosen)
+    wasted = sum(size for fid, size in warm['streams'].items() if fid not in chosen)
+    warm_dir = job_staging_dir(f"warm-{token}")
+    if os.path.isdir(warm_dir):
+        for name in os.listdir(warm_dir):
+            # Stream files are named f<format_id>.<ext>[.part...]; finished ones are counted above
+            fid = name.split('.')[0][1:]
+            if not name.startswith('f') or fid in warm['streams']:
+                continue
+            path = os.path.join(warm_dir, name)
+            size = os.path.getsize(path)
+            if fid in chosen and download_id:
+                os.makedirs(job_staging_dir(download_id), exist_ok=True)
+                os.replace(path, os.path.join(job_staging_dir(download_id), name))
+                used += size
+            else:
+                wasted += size
+        shutil.rmtree(warm_dir, ignore_errors=True)
+    
+    with speculation_lock:
+        speculation_stats['warm_hits' if used else 'warm_misses'] += 1
+        speculation_stats['bytes_fetched'] += used + wasted
+        speculation_stats['bytes_used'] += used
+        speculation_stats['bytes_wasted'] += wasted
+    if used or wasted:
+        app.logger.info(f"Warming for selection {token}: {format_file_size(used)} used, {format_file_size(wasted)} wasted",
+                        extra={'download_id': download_id})
+
+def claim_warmed_streams(token, format_id, download_id):
+    """Hand what was warmed for a selection to the job the user started from it (format_id None discards it)"""
+    with speculation_lock:
+        warm = speculative_warming.pop(token, None) if token else None
+    if warm is not None:
+        settle_warming(token, warm, format_id, download_id)
+
+def expire_speculation():
+    """Drop speculative extractions and warmings that were not used within SPECULATION_TTL"""
+    cutoff = time.time() - SPECULATION_TTL
+    with speculation_lock:
+        for url in [url for url, entry in speculative_extractions.items() if entry['started'] < cutoff]:
+            del speculative_extractions[url]
+            speculation_stats['extractions_unused'] += 1
+        expired = [(token, speculative_warming.pop(token)) for token, warm in list(speculative_warming.items())
+                   if warm['started'] < cutoff]
+    for token, warm in expired:
+        settle_warming(token, warm)
+
+def request_client():
+    """Identify the client of the current request as (client key, weight), None for an unknown API key"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        if api_key not in API_KEYS:
+            return None
+        # Only a digest of the key is kept in memory and logs
+        return 'key:' + hashlib.sha256(api_key.encode()).hexdigest()[:16], API_KEYS[api_key]
+    # Sessions are free to throw away, so anonymous clients are accounted by address
+    # (the forwarded one when `serve` runs with --trusted-proxy)
+    return 'ip:' + (request.remote_addr or 'unknown'), 1.0
+
+def new_client_state(weight=1.0):
+    """Scheduler bookkeeping for one client"""
+    return {'weight': weight, 'deficit': 0.0, 'credited': False, 'queue': [], 'active': 0, 'jobs': set()}
+
+def admit_client_job(download_id, client, weight=1.0):
+    """Register a new job for a client, False if the client already has too many unfinished jobs"""
+    with scheduler_lock:
+        state = scheduler_clients.get(client)
+        if state is None:
+            state = scheduler_clients[client] = new_client_state(weight)
+        state['weight'] = weight
+        if len(state['jobs']) >= CLIENT_MAX_ACTIVE_DOWNLOADS + CLIENT_MAX_QUEUED_JOBS:
+            return False
+        state['jobs'].add(download_id)
+        job_clients[download_id] = client
+        return True
+
+def forget_idle_client(client):
+    """Drop a client's bookkeeping once it has nothing queued, running or unfinished (call with scheduler_lock held)"""
+    state = scheduler_clients.get(client)
+    if state is not None and not state['jobs'] and not state['queue'] and not state['active']:
+        del scheduler_clients[client]
+
+def release_client_job(download_id):
+    """Forget a finished or cancelled job, waking it up if it is still waiting for a slot"""
+    with scheduler_lock:
+        client = job_clients.pop(download_id, None)
+        state = scheduler_clients.get(client)
+        if state is None:
+            return
+        state['jobs'].discard(download_id)
+        for ticket in [t for t in state['queue'] if t['download_id'] == download_id]:
+            state['queue'].remove(ticket)
+            ticket['wake'](False)
+        forget_idle_client(client)
+
+def dispatch_download_slots():
+    """Hand free download slots to waiting jobs by deficit round-robin (call with scheduler_lock held).
+    
+    The client at the front of the round gets credit equal to its weight once per
+    turn and is served while the credit lasts, then moves to the back.
+    """
+    room = disk_admission_room()
+    budget = disk_admission_budget()
+    now = time.time()
+    if budget is not None and not disk_usage_cache['stale'] and now - disk_usage_cache['measured'] <= DISK_RECHECK_INTERVAL:
+        reject_oversized_tickets(room)
+    
+    def next_startable(state):
+        """The client's next job if it has a slot to spare: the first in policy order that fits on disk"""
+        if not state['queue'] or state['active'] >= CLIENT_MAX_ACTIVE_DOWNLOADS:
+            return None
+        if budget is None:
+            return next_queued_ticket(state['queue'], now)
+        # A job that does not fit must not block the smaller ones queued behind it
+        for ticket in ordered_tickets(state['queue'], now):
+            if ticket['reserve'] <= budget:
+                return ticket
+            if not ticket.get('held_for_disk'):
+                ticket['held_for_disk'] = True
+                disk_stats['holds'] += 1
+                if ticket['download_id'] in download_progress:
+                    download_progress[ticket['download_id']]['status'] = 'Waiting for disk space...'
+        return None
+    
+    turns = 0  # Clients visited in the current round
+    gained = 0.0  # Credit handed out in the current round
+    idle_rounds = 0  # Rounds in a row that granted nothing and credited nothing
+    while len(slot_holders) < MAX_CONCURRENT_DOWNLOADS:
+        if not any(next_startable(state) for state in scheduler_clients.values()):
+            return
+        if turns >= len(scheduler_clients):
+            # Clients credited in an earlier round only get credit again in the next one, so
+            # a second round in a row that granted nothing and credited nothing would repeat forever
+            idle_rounds = 0 if gained else idle_rounds + 1
+            if idle_rounds >= 2:
+                app.logger.error("Scheduler round made no progress, leaving the queued jobs waiting")
+                return
+            turns, gained = 0, 0.0
+        turns += 1
+        client, state = next(iter(scheduler_clients.items()))
+        ticket = next_startable(state)
+        if ticket is None:
+            # Idle clients do not bank credit for later
+            if not state['queue']:
+                state['deficit'] = 0.0
+            state['credited'] = False
+            scheduler_clients.move_to_end(client)
+            continue
+        if not state['credited']:
+            state['deficit'] += state['weight']
+            state['credited'] = True
+            gained += max(0.0, state['weight'])
+        if state['deficit'] < 1:
+            state['credited'] = False
+            scheduler_clients.move_to_end(client)
+            continue
+        
+        state['deficit'] -= 1
+        state['queue'].remove(ticket)
+        state['active'] += 1
+        slot_holders[ticket['download_id']] = client
+        turns, gained, idle_rounds = 0, 0.0, 0
+        if budget is not None:
+            disk_reservations[ticket['download_id']] = ticket['reserve']
+            budget -= ticket['reserve']
+        ticket['granted'] = True
+        ticket['wake'](True)
+
+def schedule_fifo(ticket, now):
+    """FIFO policy: the job that has waited longest goes first"""
+    return ticket['queued_at']
+
+def schedule_sjf(ticket, now):
+    """Shortest job first with aging: estimated bytes minus credit for the time spent waiting"""
+    size = ticket['size'] or SJF_UNKNOWN_SIZE
+    return size - SJF_AGING_BYTES_PER_SECOND * (now - ticket['queued_at'])
+
+# Queue policies map (ticket, now) to a sort key, the lowest key is served next
+SCHEDULER_POLICIES = {
+    'fifo': schedule_fifo,
+    'sjf': schedule_sjf,
+}
+
+def next_queued_ticket(queue, now, policy=None):
+    """Pick the ticket of a client's queue that the scheduler policy serves next"""
+    if policy is None:
+        policy = SCHEDULER_POLICIES.get(SCHEDULER_POLICY, schedule_fifo)
+    return min(queue, key=lambda ticket: (policy(ticket, now), ticket['queued_at']))
+
+def ordered_tickets(queue, now, policy=None):
+    """A client's queue in the order the scheduler policy serves it"""
+    if policy is None:
+        policy = SCHEDULER_POLICIES.get(SCHEDULER_POLICY, schedule_fifo)
+    return sorted(queue, key=lambda ticket: (policy(ticket, now), ticket['queued_at']))
+
+def reject_oversized_tickets(room):
+    """Fail the queued jobs that would not fit even if every running job's disk usage went away (call with scheduler_lock held)"""
+    # What the running jobs have written so far is already taken from the room
+    limit = room + sum(disk_usage_cache['written'].get(download_id, 0) for download_id in disk_reservations)
+    for state in scheduler_clients.values():
+        for ticket in [t for t in state['queue'] if t['reserve'] > limit]:
+            state['queue'].remove(ticket)
+            ticket['error'] = (f"Not enough disk space: the download needs {format_file_size(ticket['reserve'])}, "
+                               f"the storage has room for at most {format_file_size(max(0, limit))}")
+            ticket['wake'](False)
+
+def estimate_download_bytes(download_id, video_info, format_ids):
+    """Estimated bytes a job still has to download, from the formats it fetches or its job record"""
+    duration = video_info.get('duration') if video_info else None
+    sizes = [estimate_format_size(fmt, duration) for fmt in (find_format(video_info, fid) for fid in format_ids) if fmt]
+    if sizes and len(sizes) == len(format_ids) and all(sizes):
+        return sum(sizes)
+    return download_progress.get(download_id, {}).get('estimated_bytes') or 0
+
+def disk_reservation_bytes(download_id, download_bytes=0):
+    """Disk space to reserve for a job: its estimated output with headroom for the streams and merge/encode intermediates"""
+    estimated = max(download_bytes, download_progress.get(download_id, {}).get('estimated_bytes') or 0)
+    return int((estimated or DISK_UNKNOWN_SIZE) * DISK_RESERVE_FACTOR)
+
+def directory_size(path):
+    """Total size of the files below a directory"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def storage_usage():
+    """Bytes held under the storage roots, nested roots counted once"""
+    roots = {os.path.abspath(root) for root in STORAGE_ROOTS.values()}
+    outermost = [root for root in roots if not any(root.startswith(other + os.sep) for other in roots)]
+    return sum(directory_size(root) for root in outermost)
+
+def job_written_bytes(download_id):
+    """Bytes a job has written so far: its staging directory and its published file"""
+    written = directory_size(job_staging_dir(download_id))
+    file_path = download_progress.get(download_id, {}).get('file_path')
+    if file_path and os.path.isfile(file_path):
+        written += os.path.getsize(file_path)
+    return written
+
+def refresh_disk_usage(max_age=DISK_USAGE_MAX_AGE):
+    """Measure free space, the storage roots and what reserved jobs have written, if the last measurement is older than max_age.
+    
+    Walking the storage can take long, so it never runs under scheduler_lock. Admission
+    works from the last measurement, which release_disk_reservation keeps up to date.
+    """
+    if DISK_RESERVE_FACTOR <= 0 or (not disk_usage_cache['stale'] and time.time() - disk_usage_cache['measured'] <= max_age):
+        return
+    if not disk_measure_lock.acquire(blocking=False):
+        return  # Another thread is measuring right now
+    try:
+        with scheduler_lock:
+            reserved = list(disk_reservations)
+            releases = disk_usage_cache['releases']
+        try:
+            written = {download_id: job_written_bytes(download_id) for download_id in reserved}
+            # Jobs write to the staging tier and are published to the media tier, both need the room
+            devices = {os.stat(STORAGE_ROOTS[tier]).st_dev: STORAGE_ROOTS[tier] for tier in ('staging', 'media')}
+            free = min(shutil.disk_usage(root).free for root in devices.values())
+            usage = storage_usage() if DISK_QUOTA_BYTES > 0 else 0
+        except OSError as e:
+            # Do not stall every download on a failing measurement
+            app.logger.warning(f"Disk admission check failed, admitting jobs unchecked: {str(e)}")
+            with scheduler_lock:
+                disk_usage_cache.update(failed=True, measured=time.time())
+            return
+        with scheduler_lock:
+            # A job that finished during the walk may or may not be part of it, so measure again next time
+            disk_usage_cache.update(bytes=usage, free=free, written=written, failed=False, measured=time.time(),
+                                    stale=disk_usage_cache['releases'] != releases)
+    finally:
+        disk_measure_lock.release()
+
+def outstanding_reservation(download_id, reserved):
+    """The part of a job's reservation it had not written to disk at the last measurement"""
+    return max(0, reserved - disk_usage_cache['written'].get(download_id, 0))
+
+def disk_admission_room():
+    """Bytes the storage can take on before the running jobs' reservations, None without admission control (call with scheduler_lock held)"""
+    if DISK_RESERVE_FACTOR <= 0 or disk_usage_cache['failed'] or not disk_usage_cache['measured']:
+        return None
+    room = disk_usage_cache['free'] - READY_MIN_FREE_BYTES
+    if DISK_QUOTA_BYTES > 0:
+        room = min(room, DISK_QUOTA_BYTES - disk_usage_cache['bytes'])
+    return room
+
+def disk_admission_budget():
+    """Bytes that can still be reserved for new jobs, None without admission control (call with scheduler_lock held)"""
+    room = disk_admission_room()
+    if room is None:
+        return None
+    return room - sum(outstanding_reservation(download_id, reserved) for download_id, reserved in disk_reservations.items())
+
+def release_disk_reservation(download_id):
+    """Settle a finished job's reservation against the size of its output and admit jobs held for disk space"""
+    file_path = download_progress.get(download_id, {}).get('file_path')
+    output = os.path.getsize(file_path) if file_path and os.path.isfile(file_path) else 0
+    with scheduler_lock:
+        reserved = disk_reservations.pop(download_id, None)
+        if reserved is None:
+            return
+        # Until the next measurement, the output takes the place of what the job had written by the last one
+        change = output - disk_usage_cache['written'].pop(download_id, 0)
+        disk_usage_cache['bytes'] += change
+        disk_usage_cache['free'] -= change
+        disk_usage_cache['releases'] += 1
+        disk_stats['finished'] += 1
+        disk_stats['reserved_bytes'] += reserved
+        disk_stats['output_bytes'] += output
+        dispatch_download_slots()
+    app.logger.info(f"Released disk reservation of {format_file_size(reserved)} for {download_id}, "
+                    f"output is {format_file_size(output)}", extra={'download_id': download_id})
+
+def queue_download_ticket(download_id, wake, size=0):
+    """Queue a job for a download slot; wake(granted) is called once it gets one or is cancelled"""
+    ticket = {'download_id': download_id, 'wake': wake, 'granted': False, 'size': size, 'queued_at': time.time(),
+              'reserve': disk_reservation_bytes(download_id, size)}
+    refresh_disk_usage()
+    with scheduler_lock:
+        client = job_clients.get(download_id)
+        if client is None:
+            # Jobs started without a request (e.g. from the command line) share one local client
+            client = job_clients[download_id] = 'local'
+        state = scheduler_clients.get(client)
+        if state is None:
+            state = scheduler_clients[client] = new_client_state()
+        state['jobs'].add(download_id)
+        state['queue'].append(ticket)
+        dispatch_download_slots()
+    return ticket
+
+def acquire_download_slot(download_id, size=0):
+    """Block until the scheduler grants the job a download slot, False if it was cancelled meanwhile"""
+    event = threading.Event()
+    ticket = queue_download_ticket(download_id, lambda granted: event.set(), size)
+    while not event.wait(DISK_RECHECK_INTERVAL):
+        # Space can also be freed behind the scheduler's back, e.g. by cleanup or other processes
+        if ticket.get('held_for_disk'):
+            refresh_disk_usage(DISK_RECHECK_INTERVAL)
+            with scheduler_lock:
+                dispatch_download_slots()
+    if ticket.get('error'):
+        raise Exception(ticket['error'])
+    return ticket['granted']
+
+async def async_acquire_download_slot(download_id, size=0):
+    """Wait on the event loop until the scheduler grants the job a download slot"""
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    
+    def wake(granted):
+        loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(granted))
+    
+    ticket = queue_download_ticket(download_id, wake, size)
+    try:
+        while not waiter.done():
+            await asyncio.wait({waiter}, timeout=DISK_RECHECK_INTERVAL)
+            if not waiter.done() and ticket.get('held_for_disk'):
+                await loop.run_in_executor(None, refresh_disk_usage, DISK_RECHECK_INTERVAL)
+                with scheduler_lock:
+                    dispatch_download_slots()
+        if ticket.get('error'):
+            raise Exception(ticket['error'])
+        return waiter.result()
+    except asyncio.CancelledError:
+        # The slot may have been granted just before the cancellation arrived
+        if ticket['granted']:
+            release_download_slot(download_id)
+        release_client_job(download_id)
+        raise
+
+def release_download_slot(download_id):
+    """Give a download slot back and pass it on to the next waiting job"""
+    with scheduler_lock:
+        client = slot_holders.pop(download_id, None)
+        state = scheduler_clients.get(client)
+        if state is not None:
+            state['active'] -= 1
+            forget_idle_client(client)
+        dispatch_download_slots()
+
+def start_async_runner():
+    """Start the event loop thread of the async job runner if it is not running yet"""
+    global async_loop
+    with async_loop_lock:
+        if async_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-runner", daemon=True).start()
+            async_loop = loop
+            app.logger.info("Started async job runner")
+    return async_loop
+
+def submit_download_job(url, format_id, download_id, filename, format_mode, video_info=None):
+    """Start a download on the configured job runner (safe to call from any thread)"""
+    # The async runner drives the yt-dlp command line, library mode always uses threads
+    if JOB_RUNNER == 'async' and USE_YTDLP_COMMAND:
+        loop = start_async_runner()
+        future = asyncio.run_coroutine_threadsafe(
+            async_download_video(url, format_id, download_id, filename, format_mode, video_info), loop)
+        async_jobs[download_id] = future
+        future.add_done_callback(lambda f: async_jobs.pop(download_id, None))
+        return future
+    
+    download_thread = threading.Thread(
+        target=download_video_with_progress,
+        args=(url, format_id, download_id, filename, format_mode, video_info),
+        daemon=True
+    )
+    download_thread.start()
+    return download_thread
+
+async def async_download_video(url, format_id, download_id, filename, format_mode, video_info=None):
+    """Async counterpart of download_video_with_progress, run on the async runner's event loop.
+    
+    File work (cache copies, the info JSON, publishing) runs on the loop's executor
+    so one job's disk I/O does not stall every other supervised job.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        staging_dir = job_staging_dir(download_id)
+        os.makedirs(staging_dir, exist_ok=True)
+        
+        # Streams another job fetched recently come from the stream cache
+        section = download_progress[download_id].get('section')
+        cached_paths, missing_ids = await loop.run_in_executor(
+            None, checkout_cached_streams, video_info, format_id, staging_dir, section)
+        downloaded_paths = []
         
-        return find_and_process_output_file(download_id, base_filename, output_template, is_audio)
+        if missing_ids:
+            # Wait for a free download slot
+            download_progress[download_id]['status'] = 'Waiting for a download slot...'
+            if not await async_acquire_download_slot(download_id, estimate_download_bytes(download_id, video_info, missing_ids)):
+                app.logger.info(f"Async download {download_id} was cancelled while waiting for a slot")
+                remove_staging_dir(download_id)
+                return None
+            try:
+                download_progress[download_id].update({'status': 'Starting download...', 'queued': False})
+                app.logger.info(f"Starting async download for {download_id}: {url} with format {format_id}")
+                downloaded_paths = await asyncio.wait_for(
+                    async_download_streams(url, '+'.join(missing_ids), download_id, staging_dir, video_info),
+                    timeout=DOWNLOAD_TIMEOUT)
+            finally:
+                release_download_slot(download_id)
+            await loop.run_in_executor(None, cache_downloaded_streams, video_info, downloaded_paths, section)
         
+        stream_paths = merge_stream_paths(format_id, cached_paths, downloaded_paths)
+        return await loop.run_in_executor(
+            None, hand_off_streams, download_id, stream_paths, format_id, filename, format_mode, video_info)
+    
+    except asyncio.CancelledError:
+        app.logger.info(f"Async download {download_id} was cancelled")
+        remove_staging_dir(download_id)
+        raise
+    except asyncio.TimeoutError:
+        app.logger.error(f"Async download {download_id} timed out after {DOWNLOAD_TIMEOUT} seconds")
+        await loop.run_in_executor(None, remove_staging_dir, download_id)
+        record_download_failure(download_id, Exception("Download timed out"))
     except Exception as e:
-        app.logger.error(f"Python library download error: {str(e)}", exc_info=True)
-        download_progress[download_id]['status'] = f'Error: {str(e)}'
-        download_progress[download_id]['error'] = str(e)
+        app.logger.error(f"Async download error: {str(e)}", exc_info=True)
+        await loop.run_in_executor(None, remove_staging_dir, download_id)
+        record_download_failure(download_id, e)
+
+async def async_download_streams(url, format_id, download_id, staging_dir, video_info=None):
+    """Run yt-dlp as an asyncio subprocess and return the paths of the raw streams"""
+    identity = await async_acquire_identity(download_id)
+    try:
+        proxy = await async_acquire_proxy(download_id)
+    except BaseException as e:
+        release_identity(identity, e)
         raise
+    started = time.time()
+    try:
+        # Building the command writes the (possibly multi-megabyte) info JSON
+        cmd = await asyncio.get_running_loop().run_in_executor(
+            None, build_download_command, url, format_id, staging_dir, video_info,
+            download_progress[download_id].get('section'), identity, proxy)
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=1024 * 1024  # Allow long lines
+        )
+    except BaseException as e:
+        release_identity(identity, e)
+        release_proxy(proxy, e)
+        raise
+    
+    stream_paths = []
+    error_lines = []
+    try:
+        while True:
+            raw_line = await process.stdout.readline()
+            if not raw_line:
+                break
+            line = raw_line.decode('utf-8', errors='replace').strip()
+            handle_download_output_line(download_id, line, stream_paths, error_lines)
+        await process.wait()
+    finally:
+        # Timeouts and cancellation land here: do not leave the child process behind
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        error_message = describe_ytdlp_failure(error_lines) if process.returncode != 0 else None
+        error = Exception(error_message) if error_message else None
+        release_identity(identity, error)
+        release_proxy(proxy, error, total_file_size(stream_paths), time.time() - started)
+    
+    if error_message:
+        app.logger.error(f"yt-dlp process failed with return code {process.returncode}: {error_message}")
+        raise Exception(f"yt-dlp process failed: {error_message}")
+    
+    return stream_paths
+
+def stream_format_selector(format_id):
+    """Turn a merged format like '137+140' into one that downloads each stream separately"""
+    return format_id.replace('+', ',')
 
-def find_and_process_output_file(download_id, base_filename, output_template, is_audio):
-    """Find and process the downloaded file"""
-    # Find the output file
-    final_output_path = None
+def job_staging_dir(download_id):
+    """Staging directory a job downloads and post-processes in"""
+    return os.path.join(STORAGE_ROOTS['staging'], download_id)
+
+def remove_staging_dir(download_id):
+    """Remove a job's staging directory and anything left in it"""
+    staging_dir = job_staging_dir(download_id)
+    if os.path.isdir(staging_dir):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def stream_output_template(staging_dir):
+    """Output template for the raw streams of a download"""
+    return os.path.join(staging_dir, "f%(format_id)s.%(ext)s")
+
+def plan_postprocessing(stream_paths, output_path, format_id, format_mode, video_info=None):
+    """Work out the ffmpeg command that turns the raw streams into the final file.
     
-    if is_audio:
-        # For audio, check for .mp3 file
-        expected_mp3 = os.path.join(DOWNLOAD_FOLDER, f"{base_filename}.mp3")
-        if os.path.exists(expected_mp3):
-            final_output_path = expected_mp3
-        else:
-            # Try to find any file with the same base name
-            possible_files = [f for f in os.listdir(DOWNLOAD_FOLDER) 
-                            if f.startswith(base_filename) and os.path.isfile(os.path.join(DOWNLOAD_FOLDER, f))]
-            if possible_files:
-                # Prefer .mp3 files if available
-                mp3_files = [f for f in possible_files if f.endswith('.mp3')]
-                if mp3_files:
-                    final_output_path = os.path.join(DOWNLOAD_FOLDER, mp3_files[0])
-                else:
-                    final_output_path = os.path.join(DOWNLOAD_FOLDER, possible_files[0])
-                app.logger.info(f"Found alternative audio file: {final_output_path}")
-            else:
-                raise Exception("Could not find downloaded audio file")
-    else:
-        # For video, check for the original filename
-        expected_mp4 = os.path.join(DOWNLOAD_FOLDER, f"{base_filename}.mp4")
-        if os.path.exists(expected_mp4):
-            final_output_path = expected_mp4
-        elif os.path.exists(output_template):
-            final_output_path = output_template
-        else:
-            # Try to find any file with the same base name
-            possible_files = [f for f in os.listdir(DOWNLOAD_FOLDER) 
-                            if f.startswith(base_filename) and os.path.isfile(os.path.join(DOWNLOAD_FOLDER, f))]
-            if possible_files:
-                # Prefer .mp4 files if available
-                mp4_files = [f for f in possible_files if f.endswith('.mp4')]
-                if mp4_files:
-                    final_output_path = os.path.join(DOWNLOAD_FOLDER, mp4_files[0])
-                else:
-                    final_output_path = os.path.join(DOWNLOAD_FOLDER, possible_files[0])
-                app.logger.info(f"Found alternative video file: {final_output_path}")
-            else:
-                raise Exception("Could not find downloaded video file")
+    Returns None when no CPU work is needed and the stream can simply be moved into place.
+    """
+    stream_formats = [find_format(video_info, fid) for fid in format_id.split('+')]
     
-    # Verify file exists and has content
-    if not final_output_path or not os.path.exists(final_output_path):
-        raise Exception(f"File not found after download")
+    if format_mode == "mp3":
+        # Skip the encode entirely when the source is MP3 already
+        if stream_formats[0] and not audio_needs_transcode(stream_formats[0], format_mode):
+            return None
+        return [FFMPEG_BINARY, "-y", "-loglevel", "error", "-i", stream_paths[0],
+                "-vn", "-c:a", "libmp3lame", "-b:a", "192k", output_path]
     
-    # For video files, ensure the extension is .mp4
-    if not is_audio and not final_output_path.endswith('.mp4'):
-        # Rename the file to have .mp4 extension
-        new_path = os.path.splitext(final_output_path)[0] + '.mp4'
+    if format_mode in AUDIO_MODES:
+        # Passthrough audio is served exactly as downloaded
+        return None
+    
+    if len(stream_paths) == 1:
+        if stream_paths[0].endswith('.mp4'):
+            return None
+        # Remux a single stream into MP4 without re-encoding
+        return [FFMPEG_BINARY, "-y", "-loglevel", "error", "-i", stream_paths[0],
+                "-c", "copy", "-movflags", "+faststart", output_path]
+    
+    # Merge video and audio, copying streams when the container allows it
+    video_format = stream_formats[0]
+    audio_format = stream_formats[-1] if len(stream_formats) > 1 else None
+    video_codec = ["-c:v", "copy"]
+    if video_format and not can_stream_copy(video_format, "mp4", "video"):
+        video_codec = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "20"]
+    audio_codec = ["-c:a", "copy"]
+    if audio_format and not can_stream_copy(audio_format, "mp4", "audio"):
+        audio_codec = ["-c:a", "aac", "-b:a", "192k"]
+    return [FFMPEG_BINARY, "-y", "-loglevel", "error",
+            "-i", stream_paths[0], "-i", stream_paths[1],
+            "-map", "0:v:0", "-map", "1:a:0"] + video_codec + audio_codec + [
+            "-movflags", "+faststart", output_path]
+
+def start_postprocess_workers():
+    """Start the post-processing worker threads if they are not running yet"""
+    with postprocess_condition:
+        if postprocess_workers:
+            return
+        for i in range(POSTPROCESS_WORKERS):
+            worker = threading.Thread(target=postprocess_worker, name=f"postprocess-{i}", daemon=True)
+            worker.start()
+            postprocess_workers.append(worker)
+        app.logger.info(f"Started {POSTPROCESS_WORKERS} post-processing workers")
+
+def update_postprocess_positions():
+    """Show every queued job its position in the post-processing queue (caller holds the condition)"""
+    for position, job in enumerate(postprocess_queue, start=1):
+        if job['download_id'] in download_progress:
+            download_progress[job['download_id']]['status'] = f'Post-processing (queued, position {position})...'
+            download_progress[job['download_id']]['postprocess_position'] = position
+
+def submit_postprocess_job(download_id, cmd, staged_output, filename, input_bytes=0, kind='remux'):
+    """Queue a finished download for the post-processing stage"""
+    start_postprocess_workers()
+    job = {
+        'download_id': download_id,
+        'cmd': cmd,
+        'staged_output': staged_output,
+        'filename': filename,
+        'input_bytes': input_bytes,
+        'kind': kind,
+        'done': threading.Event()
+    }
+    with postprocess_condition:
+        postprocess_queue.append(job)
+        download_progress[download_id]['progress'] = 95
+        update_postprocess_positions()
+        postprocess_condition.notify()
+    return job
+
+def postprocess_worker():
+    """Run queued post-processing jobs one at a time"""
+    while True:
+        with postprocess_condition:
+            while not postprocess_queue:
+                postprocess_condition.wait()
+            job = postprocess_queue.pop(0)
+            update_postprocess_positions()
+        run_postprocess_job(job)
+
+def run_postprocess_job(job):
+    """Merge or encode the raw streams of a download and publish the final file"""
+    download_id = job['download_id']
+    try:
+        if download_progress.get(download_id, {}).get('cancelled'):
+            app.logger.info(f"Skipping post-processing for cancelled download {download_id}")
+            return
+        
+        download_progress[download_id]['status'] = 'Post-processing...'
+        download_progress[download_id]['postprocess_position'] = 0
+        app.logger.info(f"Post-processing {download_id}: {' '.join(job['cmd'])}")
+        
+        started = time.time()
+        process = subprocess.Popen(job['cmd'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        track_child_process(process, download_id)
         try:
-            os.rename(final_output_path, new_path)
-            app.logger.info(f"Renamed file from {final_output_path} to {new_path}")
-            final_output_path = new_path
-        except Exception as e:
-            app.logger.error(f"Error renaming file to .mp4: {str(e)}")
+            _, stderr = process.communicate(timeout=POSTPROCESS_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        finally:
+            untrack_child_process(process)
+        if process.returncode != 0:
+            error_output = stderr.strip() if stderr else "Unknown error"
+            raise Exception(f"ffmpeg failed: {error_output[-500:]}")
+        record_throughput(job['kind'], job['input_bytes'], time.time() - started)
+        
+        download_progress[download_id]['status'] = 'Finalizing...'
+        download_progress[download_id]['progress'] = 99
+        publish_output_file(download_id, job['staged_output'], job['filename'])
+    except subprocess.TimeoutExpired:
+        app.logger.error(f"Post-processing timed out for {download_id}")
+        if download_id in download_progress:
+            download_progress[download_id]['status'] = 'Error: Post-processing timed out'
+            download_progress[download_id]['error'] = 'Post-processing timed out'
+            download_progress[download_id]['error_class'] = 'timeout'
+            finish_job(download_id)
+    except Exception as e:
+        app.logger.error(f"Post-processing error for {download_id}: {str(e)}", exc_info=True)
+        if download_id in download_progress:
+            download_progress[download_id]['status'] = f'Error: {str(e)}'
+            download_progress[download_id]['error'] = str(e)
+            download_progress[download_id]['user_message'] = "Converting the downloaded file failed. Please try a different format."
+            download_progress[download_id]['error_class'] = 'postprocess'
+            finish_job(download_id)
+    finally:
+        # The raw streams are not needed anymore
+        remove_staging_dir(download_id)
+        job['done'].set()
+
+def publish_output_file(download_id, staged_path, filename):
+    """Move a finished file from the job's staging directory into the serving area"""
+    # Verify file exists and has content
+    if not staged_path or not os.path.isfile(staged_path):
+        raise Exception(f"File not found after download")
     
-    file_size = os.path.getsize(final_output_path)
+    file_size = os.path.getsize(staged_path)
     if file_size == 0:
-        raise Exception(f"Downloaded file is empty: {final_output_path}")
+        raise Exception(f"Downloaded file is empty: {staged_path}")
+    
+    final_output_path = storage_publish(staged_path, filename)
     
     # Update download progress with final information
     download_progress[download_id]['status'] = 'Download complete!'
@@ -857,9 +2905,11 @@ def find_and_process_output_file(download_id, base_filename, output_template, is
     download_progress[download_id]['file_path'] = final_output_path
     download_progress[download_id]['filename'] = os.path.basename(final_output_path)
     download_progress[download_id]['download_url'] = f'/download_file/{os.path.basename(final_output_path)}'
+    download_progress[download_id]['file_size'] = file_size
     
     # Log success
     app.logger.info(f"Download successful: {final_output_path}, Size: {file_size} bytes")
+    finish_job(download_id)
     
     return final_output_path
 
@@ -880,28 +2930,28 @@ def update_progress_from_output(download_id, line):
         # Update progress based on output
         if "[download]" in line and "%" in line:
             # Extract percentage
-            percent_match = re.search(r'(\d+\.\d+)%', line)
+            percent_match = PROGRESS_PERCENT_RE.search(line)
             if percent_match:
-                percent = float(percent_match.group(1))
-                download_progress[download_id]['progress'] = percent
-                download_progress[download_id]['status'] = 'downloading'
+                # Collected first so the job record changes (and gets a new version) once per line
+                fields = {'progress': float(percent_match.group(1)), 'status': 'downloading'}
                 
                 # Extract speed
-                speed_match = re.search(r'(\d+\.\d+\s*[KMG]iB/s)', line)
+                speed_match = PROGRESS_SPEED_RE.search(line)
                 if speed_match:
-                    download_progress[download_id]['speed'] = speed_match.group(1)
+                    fields['speed'] = speed_match.group(1)
                 
                 # Extract ETA
-                eta_match = re.search(r'ETA\s+(\d+:\d+)', line)
+                eta_match = PROGRESS_ETA_RE.search(line)
                 if eta_match:
-                    download_progress[download_id]['eta'] = eta_match.group(1)
+                    fields['eta'] = eta_match.group(1)
                 
                 # Extract file size
-                size_match = re.search(r'(\d+\.\d+\s*[KMG]iB)\s+of\s+(\d+\.\d+\s*[KMG]iB)', line)
+                size_match = PROGRESS_SIZE_RE.search(line)
                 if size_match:
-                    download_progress[download_id]['size'] = f"{size_match.group(1)} of {size_match.group(2)}"
-                    download_progress[download_id]['downloaded'] = size_match.group(1)
-                    download_progress[download_id]['total_size'] = size_match.group(2)
+                    fields['size'] = f"{size_match.group(1)} of {size_match.group(2)}"
+                    fields['downloaded'] = size_match.group(1)
+                    fields['total_size'] = size_match.group(2)
+                download_progress[download_id].update(fields)
         
         # Check for post-processing
         elif "Extracting audio" in line or "Merging formats" in line or "Recoding video" in line:
@@ -920,10 +2970,10 @@ def update_progress_from_output(download_id, line):
         app.logger.error(f"Error updating progress from output: {str(e)}")
         app.logger.error(traceback.format_exc())
 
-def initialize_download_progress(download_id, filename, url=None, format_id=None, video_title=None, file_path=None):
+def initialize_download_progress(download_id, filename, url=None, format_id=None, video_title=None, file_path=None, estimated_bytes=0):
     """Initialize the download progress tracking for a new download"""
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    download_progress[download_id] = {
+    download_progress[download_id] = JobRecord({
         'progress': 0,
         'status': 'Starting download...',
         'speed': '--',
@@ -934,23 +2984,66 @@ def initialize_download_progress(download_id, filename, url=None, format_id=None
         'title': video_title,
         'file_path': file_path,
         'file_ready': False,  # Flag to indicate if file is ready for download
+        'queued': True,  # Until the download starts (a download slot is granted or every stream is cached)
+        'estimated_bytes': estimated_bytes,  # Expected size of the download, 0 if unknown
         'start_time': current_time,
         'last_updated': current_time,  # Track when this entry was last updated
         'cancelled': False  # Flag to track if download was cancelled
-    }
+    })
     
     # Log the download initialization
     app.logger.info(f"Initialized download tracking for {download_id}: {url} -> {file_path}")
 
 def is_valid_youtube_url(url):
     """Check if the URL is a valid YouTube URL"""
-    youtube_regex = (
-        r'(https?://)?(www\.)?'
-        r'(youtube|youtu|youtube-nocookie)\.(com|be)/'
-        r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})')
-    
-    match = re.match(youtube_regex, url)
-    return match is not None
+    return YOUTUBE_URL_RE.match(url) is not None
+
+def parse_timestamp(value):
+    """Parse a time such as '90', '1:30' or '01:02:03.5' into seconds, None when empty"""
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = float(value)
+    else:
+        seconds = 0.0
+        parts = str(value).strip().split(':')
+        if len(parts) > 3:
+            raise ValueError(f"Invalid time '{value}'")
+        try:
+            for part in parts:
+                seconds = seconds * 60 + float(part)
+        except ValueError:
+            raise ValueError(f"Invalid time '{value}'")
+    if seconds < 0 or not math.isfinite(seconds):
+        raise ValueError(f"Invalid time '{value}'")
+    return seconds
+
+def parse_section(start, end, duration=None):
+    """Validate a clip's start and end time, returns [start, end] in seconds or None for the whole video"""
+    start = parse_timestamp(start)
+    end = parse_timestamp(end)
+    if start is None and end is None:
+        return None
+    start = start or 0.0
+    if end is None:
+        if not duration:
+            raise ValueError("An end time is required for this video")
+        end = float(duration)
+    if duration:
+        end = min(end, float(duration))
+    if end <= start:
+        raise ValueError("The clip must end after it starts")
+    return [start, end]
+
+def format_section_spec(section):
+    """yt-dlp --download-sections value for a clip"""
+    return f"*{section[0]:g}-{section[1]:g}"
+
+def section_fraction(section, duration):
+    """Share of the video a clip covers, 1 for the whole video or an unknown duration"""
+    if not section or not duration:
+        return 1.0
+    return max(0.0, min(1.0, (section[1] - section[0]) / float(duration)))
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -963,20 +3056,21 @@ def index():
             return render_template('index.html', error="Please enter a valid YouTube URL")
         
         # Fix format_mode value to match the radio button value
-        if format_mode == "video":
+        if format_mode not in AUDIO_MODES:
             format_mode = "video"
-        elif format_mode == "mp3":
-            format_mode = "mp3"
             
         try:
-            video_info = get_video_info(url)
+            # A speculative extraction started when the URL was pasted may have done the work already
+            video_info = claim_speculative_info(url) or get_video_info(url)
             formats = video_info.get("formats", [])
-            choices = extract_format_choices(formats, format_mode)
-            session['url'] = url
-            session['format_mode'] = format_mode
-            session['formats'] = choices
-            session['video_title'] = video_info.get('title', 'Video')
-            return render_template('select_format.html', title=video_info.get('title'), choices=choices)
+            choices = extract_format_choices(formats, format_mode, duration=video_info.get("duration"))
+            annotate_choice_predictions(choices)
+            # Keep the selection server-side; the page only carries an opaque token
+            selection = store_selection(url, format_mode, video_info, choices)
+            if choices:
+                # Most users take the preselected first choice
+                start_warming(selection, url, choices[0], video_info)
+            return render_template('select_format.html', title=video_info.get('title'), choices=choices, selection=selection)
         except Exception as e:
             error_message = str(e)
             print(f"Error processing URL: {error_message}")
@@ -984,13 +3078,33 @@ def index():
 
     return render_template('index.html')
 
+@app.context_processor
+def inject_speculation():
+    """Tell the start page whether to announce pasted URLs to /speculate"""
+    return {'speculation_enabled': SPECULATION in ('extract', 'warm')}
+
+@app.route('/speculate', methods=['POST'])
+def speculate():
+    """Start extracting a URL that was pasted on the start page, before the form is submitted"""
+    url = request.form.get('url') or ''
+    if not is_valid_youtube_url(url):
+        return jsonify({'error': 'Not a valid YouTube URL'}), 400
+    state = speculate_extraction(url)
+    return jsonify({'state': state}), 202 if state == 'started' else 200
+
 @app.route('/download', methods=['POST'])
 def download():
+    download_id = None
     try:
         format_id = request.form.get('format')
-        url = session.get('url')
-        video_title = session.get('video_title', 'Video')
-        format_mode = session.get('format_mode', 'video')
+        selection = get_selection(request.form.get('selection'))
+        
+        if not selection:
+            return render_template('index.html', error="Your selection has expired. Please enter the YouTube URL again.")
+        
+        url = selection['url']
+        video_title = selection['video_title']
+        format_mode = selection['format_mode']
         
         if not url:
             return render_template('index.html', error="Missing URL. Please enter a YouTube URL.")
@@ -1002,35 +3116,67 @@ def download():
         if not is_valid_youtube_url(url):
             return render_template('index.html', error="Invalid YouTube URL. Please enter a valid YouTube URL.")
         
+        # Optional clip: only this time range is downloaded
+        duration = (selection.get('video_info') or {}).get('duration')
+        try:
+            section = parse_section(request.form.get('clip_start'), request.form.get('clip_end'), duration)
+        except ValueError as e:
+            return render_template('index.html', error=f"Invalid clip: {str(e)}")
+        fraction = section_fraction(section, duration)
+        
+        # "auto" picks the best option predicted to finish within the deadline
+        if format_id == "auto":
+            try:
+                deadline = float(request.form.get('deadline_minutes', 10)) * 60
+            except ValueError:
+                return render_template('index.html', error="Please enter the deadline in minutes.")
+            # A clip takes its share of the full download's time
+            choice = pick_choice_for_deadline(selection['choices'], deadline / fraction)
+            if not choice:
+                return render_template('index.html', error="No download options available for this video.")
+            format_id = choice['id']
+            app.logger.info(f"Auto-selected format {format_id} for a deadline of {deadline:.0f} seconds")
+        
         # Generate a unique download ID and filename
         download_id = str(uuid.uuid4())
-        ext = "mp3" if format_mode == "mp3" else "mp4"
+        
+        # Every client gets a bounded number of unfinished jobs
+        client, weight = request_client() or ('ip:' + (request.remote_addr or 'unknown'), 1.0)
+        if not admit_client_job(download_id, client, weight):
+            return render_template('index.html', error="You already have too many downloads running or queued. Please wait for some of them to finish."), 429
+        
+        # The chosen option knows its output container (passthrough audio keeps the source one)
+        choice = next((c for c in selection['choices'] if c['id'] == format_id), None)
+        if choice and choice.get('ext'):
+            ext = choice['ext']
+        else:
+            ext = "mp3" if format_mode == "mp3" else "mp4"
         filename = f"{uuid.uuid4()}.{ext}"
         
         # Ensure we have the absolute path
-        file_path = os.path.abspath(os.path.join(DOWNLOAD_FOLDER, filename))
-        
-        # Make sure the download directory exists
-        os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+        file_path = os.path.abspath(storage_path(filename))
         
         # Initialize progress tracking
-        initialize_download_progress(download_id, filename, url, format_id, video_title, file_path)
+        initialize_download_progress(download_id, filename, url, format_id, video_title, file_path,
+                                     int(choice.get('size', 0) * fraction) if choice else 0)
+        download_progress[download_id]['section'] = section
+        
+        # Streams warmed while the selection page was open are used, or discarded if another option was chosen.
+        # Clips are cut while downloading and never use them.
+        claim_warmed_streams(request.form.get('selection'), None if section else format_id, download_id)
         
         # Log the download request
         app.logger.info(f"Starting download: {url} with format {format_id} to {file_path}")
         
-        # Start download in a background thread
-        download_thread = threading.Thread(
-            target=download_video_with_progress,
-            args=(url, format_id, download_id, filename, format_mode),
-            daemon=True
-        )
-        download_thread.start()
+        # Start download in the background
+        submit_download_job(url, format_id, download_id, filename, format_mode, selection['video_info'])
         
         # Redirect to progress page
         return redirect(url_for('download_progress_page', download_id=download_id))
     except Exception as e:
         app.logger.error(f"Error starting download: {str(e)}", exc_info=True)
+        if download_id:
+            release_client_job(download_id)
         return render_template('index.html', error=f"Error: {str(e)}")
 
 def cleanup_old_downloads():
@@ -1072,14 +3218,20 @@ def cleanup_old_downloads():
         try:
             # Get the file path before removing the entry
             file_path = download_progress[download_id].get('file_path')
+            release_disk_reservation(download_id)
             
             # Remove the entry
             del download_progress[download_id]
+            notify_job_watchers()
+            with job_callbacks_lock:
+                job_callbacks.pop(download_id, None)
+            release_client_job(download_id)
             
             # Delete the file if it exists
             if file_path and os.path.exists(file_path):
                 os.remove(file_path)
                 app.logger.info(f"Deleted file for {download_id}: {file_path}")
+            remove_staging_dir(download_id)
             
             app.logger.info(f"Cleaned up download: {download_id}")
         except Exception as e:
@@ -1102,7 +3254,7 @@ def download_status(download_id):
 def download_file(filename):
     try:
         # Construct the file path
-        file_path = os.path.join(DOWNLOAD_FOLDER, filename)
+        file_path = storage_path(filename)
         
         # Check if file exists
         if not os.path.exists(file_path):
@@ -1130,11 +3282,7 @@ def download_file(filename):
             app.logger.info(f"Sending file: {file_path}, Size: {os.path.getsize(file_path)} bytes")
             
             # Determine the appropriate mimetype based on file extension
-            mimetype = None
-            if filename.endswith('.mp3'):
-                mimetype = 'audio/mpeg'
-            elif filename.endswith('.mp4'):
-                mimetype = 'video/mp4'
+            mimetype = MEDIA_MIMETYPES.get(os.path.splitext(filename)[1].lower())
             
             # Send the file with appropriate headers
             return send_file(file_path, 
@@ -1153,10 +3301,162 @@ def download_file(filename):
                               error_message=f"An unexpected error occurred: {str(e)}",
                               back_url=url_for('index'))
 
+def zip_dos_time(mtime):
+    """(time, date) fields of a ZIP header for a modification time"""
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def zip_entry_span(name, size, zip64):
+    """Bytes an entry takes in the archive: local header, data and data descriptor"""
+    return 30 + len(name) + (20 if zip64 else 0) + size + (24 if zip64 else 16)
+
+def plan_zip_bundle(files):
+    """Lay out an uncompressed ZIP of (archive name, path) pairs; returns the entries and the archive's exact size.
+    
+    Entries are stored, with the CRC in a data descriptor after the data, so the
+    archive can be written in one pass. ZIP64 fields are used where sizes or
+    offsets need them.
+    """
+    entries = []
+    offset = 0
+    for arcname, path in files:
+        stat = os.stat(path)
+        name = arcname.encode('utf-8')
+        zip64 = stat.st_size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT
+        entries.append({'name': name, 'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                        'offset': offset, 'zip64': zip64})
+        offset += zip_entry_span(name, stat.st_size, zip64)
+    directory_size = sum(46 + len(entry['name']) + (28 if entry['zip64'] else 0) for entry in entries)
+    zip64_end = offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT or len(entries) >= 0xFFFF
+    return entries, offset + directory_size + (56 + 20 if zip64_end else 0) + 22
+
+def stream_zip_bundle(entries):
+    """Generate the bytes of a ZIP planned by plan_zip_bundle, reading each file once in fixed-size chunks"""
+    crcs = []
+    for entry in entries:
+        dos_time, dos_date = zip_dos_time(entry['mtime'])
+        version = 45 if entry['zip64'] else 20
+        sizes = ZIP64_LIMIT if entry['zip64'] else 0
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if entry['zip64'] else b''
+        # Bit 3: CRC and sizes follow the data; bit 11: UTF-8 names
+        yield struct.pack('<IHHHHHIIIHH', 0x04034b50, version, 0x0808, 0, dos_time, dos_date,
+                          0, sizes, sizes, len(entry['name']), len(extra)) + entry['name'] + extra
+        
+        crc = 0
+        remaining = entry['size']
+        with open(entry['path'], 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(BUNDLE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    # The announced Content-Length cannot be kept anymore, abort the response
+                    raise IOError(f"{entry['path']} shrank while it was being sent")
+                crc = zlib.crc32(chunk, crc)
+                remaining -= len(chunk)
+                yield chunk
+        crcs.append(crc)
+        if entry['zip64']:
+            yield struct.pack('<IIQQ', 0x08074b50, crc, entry['size'], entry['size'])
+        else:
+            yield struct.pack('<IIII', 0x08074b50, crc, entry['size'], entry['size'])
+    
+    directory_offset = sum(zip_entry_span(entry['name'], entry['size'], entry['zip64']) for entry in entries)
+    directory_size = 0
+    for entry, crc in zip(entries, crcs):
+        dos_time, dos_date = zip_dos_time(entry['mtime'])
+        version = 45 if entry['zip64'] else 20
+        if entry['zip64']:
+            extra = struct.pack('<HHQQQ', 1, 24, entry['size'], entry['size'], entry['offset'])
+            size32 = offset32 = ZIP64_LIMIT
+        else:
+            extra = b''
+            size32, offset32 = entry['size'], entry['offset']
+        record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, 0x0808, 0,
+                             dos_time, dos_date, crc, size32, size32, len(entry['name']), len(extra),
+                             0, 0, 0, 0o100644 << 16, offset32) + entry['name'] + extra
+        directory_size += len(record)
+        yield record
+    
+    count = len(entries)
+    end_offset = directory_offset + directory_size
+    if directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT or count >= 0xFFFF:
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, directory_size, directory_offset)
+        yield struct.pack('<IIQI', 0x07064b50, 0, end_offset, 1)
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                      min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0)
+
+def bundle_archive_names(download_ids):
+    """Unique names inside a bundle for the files of finished jobs: the video title plus the file's extension"""
+    names = set()
+    files = []
+    for download_id in download_ids:
+        info = download_progress[download_id]
+        ext = os.path.splitext(info['file_path'])[1]
+        stem = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', info.get('title') or download_id).strip() or download_id
+        name = stem + ext
+        counter = 2
+        while name.lower() in names:
+            name = f"{stem} ({counter}){ext}"
+            counter += 1
+        names.add(name.lower())
+        files.append((name, info['file_path']))
+    return files
+
+def expire_bundles():
+    """Forget bundles older than BUNDLE_TTL"""
+    cutoff = time.time() - BUNDLE_TTL
+    with bundles_lock:
+        for bundle_id in [b for b, bundle in bundles.items() if bundle['created'] < cutoff]:
+            del bundles[bundle_id]
+
+@app.route('/api/bundles', methods=['POST'])
+def api_create_bundle():
+    """Group finished jobs into a bundle that downloads as one ZIP: {"jobs": [job ids]}"""
+    data = request.get_json(silent=True)
+    download_ids = data.get('jobs') if isinstance(data, dict) else None
+    if (not isinstance(download_ids, list) or not download_ids or len(download_ids) > BUNDLE_MAX_FILES
+            or not all(isinstance(download_id, str) for download_id in download_ids)):
+        return jsonify({'error': f'jobs must be a list of 1 to {BUNDLE_MAX_FILES} job ids'}), 400
+    download_ids = list(dict.fromkeys(download_ids))
+    missing = [download_id for download_id in download_ids if download_id not in download_progress]
+    if missing:
+        return jsonify({'error': 'Job not found', 'jobs': missing}), 404
+    unfinished = [download_id for download_id in download_ids if not download_progress[download_id].get('file_ready')]
+    if unfinished:
+        return jsonify({'error': 'Not all jobs have finished', 'jobs': unfinished}), 409
+    
+    expire_bundles()
+    bundle_id = uuid.uuid4().hex
+    files = bundle_archive_names(download_ids)
+    with bundles_lock:
+        bundles[bundle_id] = {'files': files, 'created': time.time()}
+    return jsonify({'id': bundle_id, 'url': url_for('download_bundle', bundle_id=bundle_id),
+                    'files': [name for name, path in files]}), 201
+
+@app.route('/bundle/<bundle_id>')
+def download_bundle(bundle_id):
+    """Stream the files of a bundle as an uncompressed ZIP, built on the fly"""
+    expire_bundles()
+    with bundles_lock:
+        bundle = bundles.get(bundle_id)
+    if bundle is None:
+        return jsonify({'error': 'Bundle not found'}), 404
+    try:
+        entries, size = plan_zip_bundle(bundle['files'])
+    except OSError:
+        return jsonify({'error': 'Some files of this bundle are no longer available'}), 410
+    
+    app.logger.info(f"Sending bundle {bundle_id}: {len(entries)} files, {size} bytes")
+    response = Response(stream_zip_bundle(entries), mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Length'] = str(size)
+    response.headers['Content-Disposition'] = f'attachment; filename="bundle-{bundle_id[:8]}.zip"'
+    return response
+
 @app.route('/check_file_ready/<filename>')
 def check_file_ready(filename):
     """Check if a file is ready for download"""
-    file_path = os.path.join(DOWNLOAD_FOLDER, filename)
+    file_path = storage_path(filename)
     
     # Check if file exists
     if not os.path.exists(file_path):
@@ -1199,7 +3499,7 @@ def progress_hook(d):
         return
         
     # Log the status for debugging
-    app.logger.debug(f"Progress hook: {download_id} - Status: {d['status']}")
+    app.logger.debug("Progress hook: %s - Status: %s", download_id, d['status'], extra={'download_id': download_id})
     
     # Update the last_updated timestamp
     download_progress[download_id]['last_updated'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -1241,79 +3541,876 @@ def get_progress(download_id):
     
     return jsonify(progress_data)
 
+def cancel_job(download_id):
+    """Cancel a download and clean up any partial files, returns (success, message)"""
+    if download_id not in download_progress:
+        return False, 'Download not found'
+    try:
+        # Get the file path
+        file_path = download_progress[download_id].get('file_path')
+        
+        # Mark the download as cancelled
+        download_progress[download_id]['status'] = 'Cancelled'
+        download_progress[download_id]['cancelled'] = True
+        download_progress[download_id]['progress'] = 0  # Reset progress
+        
+        # Jobs on the async runner can be stopped right away (this kills yt-dlp)
+        async_job = async_jobs.get(download_id)
+        if async_job:
+            async_job.cancel()
+        
+        # Delete the file if it exists
+        if file_path and os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+                app.logger.info(f"Deleted cancelled download file: {file_path}")
+            except Exception as file_error:
+                app.logger.error(f"Error deleting file {file_path}: {str(file_error)}")
+        else:
+            app.logger.info(f"No file to delete for cancelled download {download_id}")
+        remove_staging_dir(download_id)
+        finish_job(download_id)
+        
+        return True, 'Download cancelled'
+    except Exception as e:
+        app.logger.error(f"Error cancelling download: {str(e)}")
+        return False, f'Error: {str(e)}'
+
 @app.route('/cancel_download/<download_id>')
 def cancel_download(download_id):
     """Cancel a download and clean up any partial files"""
-    if download_id in download_progress:
+    success, message = cancel_job(download_id)
+    return jsonify({'success': success, 'message': message})
+
+def job_state(info):
+    """Summarize a progress entry as one of queued, running, complete, failed or cancelled"""
+    if info.get('cancelled'):
+        return 'cancelled'
+    if info.get('file_ready'):
+        return 'complete'
+    if info.get('error'):
+        return 'failed'
+    if info.get('queued'):
+        return 'queued'
+    return 'running'
+
+def api_job_view(download_id):
+    """The JSON representation of a job as returned by the API and sent to callbacks"""
+    info = download_progress[download_id]
+    file_url = None
+    if info.get('file_ready'):
+        file_url = info.get('base_url', '/').rstrip('/') + info['download_url']
+    return {
+        'id': download_id,
+        'state': job_state(info),
+        'status': info.get('status'),
+        'progress': info.get('progress', 0),
+        'url': info.get('url'),
+        'format': info.get('format_id'),
+        'mode': info.get('format_mode'),
+        'title': info.get('title'),
+        'file_url': file_url,
+        'size': info.get('file_size'),
+        'estimated_size': info.get('estimated_bytes') or None,
+        'section': info.get('section'),
+        'error': info.get('error'),
+        'error_class': info.get('error_class'),
+        'created': info.get('start_time'),
+        'version': info.get('version'),
+    }
+
+def sign_webhook_payload(body, secret):
+    """HMAC-SHA256 signature of a webhook body, as sent in the X-EasyTube-Signature header"""
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+class RefuseRedirects(urllib.request.HTTPRedirectHandler):
+    """Treat redirects as errors, so a callback endpoint cannot bounce the request to an internal address"""
+    
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+class PinnedConnection:
+    """Mixin for http.client connections to addresses resolved beforehand rather than to whatever the host resolves to now"""
+    
+    def __init__(self, host, addresses=(), **kwargs):
+        super().__init__(host, **kwargs)
+        self.addresses = addresses
+        self._create_connection = self.connect_pinned
+    
+    def connect_pinned(self, address, timeout, source_address=None):
+        error = OSError(f"No address to connect to for {self.host}")
+        for ip in self.addresses:
+            try:
+                return socket.create_connection((ip, address[1]), timeout, source_address)
+            except OSError as e:
+                error = e
+        raise error
+
+class PinnedHTTPConnection(PinnedConnection, http.client.HTTPConnection):
+    pass
+
+class PinnedHTTPSConnection(PinnedConnection, http.client.HTTPSConnection):
+    """The certificate is still checked against the URL's host"""
+
+class PinnedHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, addresses):
+        super().__init__()
+        self.addresses = addresses
+    
+    def http_open(self, req):
+        return self.do_open(PinnedHTTPConnection, req, addresses=self.addresses)
+
+class PinnedHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, addresses):
+        super().__init__()
+        self.addresses = addresses
+    
+    def https_open(self, req):
+        return self.do_open(PinnedHTTPSConnection, req, context=self._context, addresses=self.addresses)
+
+def webhook_opener(addresses):
+    """An opener that connects only to the given, already checked addresses and follows no redirects"""
+    # Environment proxies are bypassed: through a proxy the checked address would not be the one reached
+    return urllib.request.build_opener(urllib.request.ProxyHandler({}), RefuseRedirects,
+                                       PinnedHTTPHandler(addresses), PinnedHTTPSHandler(addresses))
+
+def resolve_callback_url(url):
+    """The addresses a callback URL may be delivered to, None unless it is http(s) and its host is allowlisted or entirely public"""
+    try:
+        parts = urllib.parse.urlsplit(url)
+        host, port = parts.hostname, parts.port
+    except ValueError:
+        return None
+    if parts.scheme not in ('http', 'https') or not host:
+        return None
+    try:
+        addresses = socket.getaddrinfo(host, port or (443 if parts.scheme == 'https' else 80), proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return None
+    ips = list(dict.fromkeys(address[4][0] for address in addresses))
+    if host.lower() in WEBHOOK_ALLOWED_HOSTS:
+        return ips
+    for address in ips:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        # Loopback, private, link-local (cloud metadata) and other special-purpose ranges are refused
+        if getattr(ip, 'ipv4_mapped', None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global:
+            return None
+    return ips
+
+def deliver_webhook(download_id, callback, payload):
+    """POST a job's outcome to its callback URL, retrying with exponential backoff"""
+    body = json.dumps(payload).encode()
+    headers = {'Content-Type': 'application/json', 'User-Agent': 'EasyTube-Webhook'}
+    secret = callback.get('secret') or WEBHOOK_SECRET
+    if secret:
+        headers['X-EasyTube-Signature'] = sign_webhook_payload(body, secret)
+    
+    delay = WEBHOOK_RETRY_DELAY
+    for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+        # Resolved and checked again before every attempt, and the request goes to exactly the
+        # checked addresses, so a host that changes its DNS answer (rebinding) cannot redirect it
+        addresses = resolve_callback_url(callback['url'])
+        if addresses is None:
+            app.logger.error(f"Callback URL of {download_id} does not resolve to a public address, giving up")
+            return False
         try:
-            # Get the file path
-            file_path = download_progress[download_id].get('file_path')
-            
-            # Mark the download as cancelled
-            download_progress[download_id]['status'] = 'Cancelled'
-            download_progress[download_id]['cancelled'] = True
-            download_progress[download_id]['progress'] = 0  # Reset progress
-            
-            # Delete the file if it exists
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    app.logger.info(f"Deleted cancelled download file: {file_path}")
-                except Exception as file_error:
-                    app.logger.error(f"Error deleting file {file_path}: {str(file_error)}")
-            else:
-                app.logger.info(f"No file to delete for cancelled download {download_id}")
-            
-            return jsonify({'success': True, 'message': 'Download cancelled'})
+            req = urllib.request.Request(callback['url'], data=body, headers=headers, method='POST')
+            with webhook_opener(addresses).open(req, timeout=WEBHOOK_TIMEOUT) as response:
+                app.logger.info(f"Delivered callback for {download_id} (HTTP {response.status})")
+                return True
+        except urllib.error.HTTPError as e:
+            # Client errors other than rate limiting will not go away by retrying
+            if 400 <= e.code < 500 and e.code not in (408, 429):
+                app.logger.error(f"Callback for {download_id} was rejected with HTTP {e.code}, giving up")
+                return False
+            app.logger.warning(f"Callback for {download_id} failed with HTTP {e.code} (attempt {attempt}/{WEBHOOK_MAX_ATTEMPTS})")
         except Exception as e:
-            app.logger.error(f"Error cancelling download: {str(e)}")
-            return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+            app.logger.warning(f"Callback for {download_id} failed: {str(e)} (attempt {attempt}/{WEBHOOK_MAX_ATTEMPTS})")
+        if attempt < WEBHOOK_MAX_ATTEMPTS:
+            time.sleep(delay)
+            delay *= 2
     
-    return jsonify({'success': False, 'message': 'Download not found'})
+    app.logger.error(f"Giving up on callback for {download_id} after {WEBHOOK_MAX_ATTEMPTS} attempts")
+    return False
 
-@app.route('/check_ytdlp')
-def check_ytdlp():
-    """Check if yt-dlp is properly installed and working"""
+def finish_job(download_id):
+    """Release a finished job's client quota and disk reservation and send its callback, at most once per job"""
+    release_client_job(download_id)
+    release_disk_reservation(download_id)
+    output_log_state.pop(download_id, None)
+    with job_callbacks_lock:
+        callback = job_callbacks.pop(download_id, None)
+    if not callback or download_id not in download_progress:
+        return
+    payload = api_job_view(download_id)
+    payload['event'] = 'job.finished'
+    threading.Thread(target=deliver_webhook, args=(download_id, callback, payload), daemon=True).start()
+
+def prepare_api_job(download_id, url, format_id, format_mode, file_stem, deadline=None, clip=None, policy=None):
+    """Extract the video info of an API job, resolve its format and start the download"""
+    try:
+        download_progress[download_id]['status'] = 'Fetching video info...'
+        video_info = get_video_info(url)
+        choices = extract_format_choices(video_info.get("formats", []), format_mode, policy,
+                                         duration=video_info.get("duration"))
+        
+        # The clip can only be checked against the video's duration now
+        section = parse_section(*clip, video_info.get("duration")) if clip else None
+        fraction = section_fraction(section, video_info.get("duration"))
+        
+        # Without a format the best option for the mode is used, like the first entry of the selection page
+        if not format_id or format_id == 'auto':
+            if not choices:
+                raise Exception("No downloadable formats found for this video")
+            choice = choices[0]
+            if format_id == 'auto' and deadline:
+                choice = pick_choice_for_deadline(choices, deadline / fraction)
+            format_id = choice['id']
+        choice = next((c for c in choices if c['id'] == format_id), None)
+        if choice and choice.get('ext'):
+            ext = choice['ext']
+        else:
+            ext = "mp3" if format_mode == "mp3" else "mp4"
+        filename = f"{file_stem}.{ext}"
+        
+        if download_progress[download_id].get('cancelled'):
+            return
+        download_progress[download_id].update({
+            'status': 'Starting download...',
+            'title': video_info.get('title'),
+            'format_id': format_id,
+            'estimated_bytes': int(choice.get('size', 0) * fraction) if choice else 0,
+            'section': section,
+            'file_path': os.path.abspath(storage_path(filename)),
+            'download_url': f'/download_file/{filename}',
+        })
+        app.logger.info(f"Starting API download: {url} with format {format_id} to {filename}")
+        submit_download_job(url, format_id, download_id, filename, format_mode, video_info)
+    except Exception as e:
+        app.logger.error(f"Error preparing API job {download_id}: {str(e)}")
+        record_download_failure(download_id, e)
+
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    """Submit a download job: {"url", "format" (optional format id or "auto"), "deadline", "mode", "start", "end", "callback_url", "callback_secret"}"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    
+    url = data.get('url')
+    format_id = data.get('format')
+    format_mode = data.get('mode', 'video')
+    callback_url = data.get('callback_url')
+    callback_secret = data.get('callback_secret')
+    
+    if not isinstance(url, str) or not is_valid_youtube_url(url):
+        return jsonify({'error': 'A valid YouTube URL is required'}), 400
+    if format_mode not in ('video',) + AUDIO_MODES:
+        return jsonify({'error': f"Unknown mode '{format_mode}'"}), 400
+    if format_id is not None and (not isinstance(format_id, str) or not re.fullmatch(r'[\w.+-]+', format_id)):
+        return jsonify({'error': 'Invalid format'}), 400
+    # Clip times are checked here as far as possible, against the duration once it is known
+    clip = None
+    if data.get('start') is not None or data.get('end') is not None:
+        try:
+            parse_section(data.get('start'), data.get('end'), float('inf'))
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': f'Invalid clip: {str(e)}'}), 400
+        clip = (data.get('start'), data.get('end'))
+    deadline = data.get('deadline')
+    if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline <= 0):
+        return jsonify({'error': 'deadline must be a positive number of seconds'}), 400
+    if callback_url is not None and (not isinstance(callback_url, str) or resolve_callback_url(callback_url) is None):
+        return jsonify({'error': 'callback_url must be an http(s) URL of a public host'}), 400
+    if callback_secret is not None and (not isinstance(callback_secret, str) or not callback_secret):
+        return jsonify({'error': 'callback_secret must be a non-empty string'}), 400
+    
+    client = request_client()
+    if client is None:
+        return jsonify({'error': 'Unknown API key'}), 401
+    
+    download_id = str(uuid.uuid4())
+    if not admit_client_job(download_id, *client):
+        return jsonify({'error': 'Too many unfinished jobs for this client'}), 429
+    file_stem = str(uuid.uuid4())
+    initialize_download_progress(download_id, file_stem, url, format_id)
+    download_progress[download_id].update({
+        'url': url,
+        'format_id': format_id,
+        'format_mode': format_mode,
+        'base_url': request.host_url,
+    })
+    if callback_url:
+        with job_callbacks_lock:
+            job_callbacks[download_id] = {'url': callback_url, 'secret': callback_secret}
+    
+    threading.Thread(target=prepare_api_job, args=(download_id, url, format_id, format_mode, file_stem, deadline, clip),
+                     daemon=True).start()
+    
+    response = jsonify(api_job_view(download_id))
+    response.headers['Location'] = url_for('api_get_job', download_id=download_id)
+    return response, 202
+
+@app.route('/api/jobs/<download_id>', methods=['GET'])
+def api_get_job(download_id):
+    """Return the state of a job"""
+    if download_id not in download_progress:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(api_job_view(download_id))
+
+@app.route('/api/jobs/<download_id>', methods=['DELETE'])
+def api_cancel_job(download_id):
+    """Cancel a job"""
+    if download_id not in download_progress:
+        return jsonify({'error': 'Job not found'}), 404
+    info = download_progress[download_id]
+    if info.get('file_ready') or info.get('error'):
+        return jsonify({'error': 'Job has already finished', 'job': api_job_view(download_id)}), 409
+    success, message = cancel_job(download_id)
+    if not success:
+        return jsonify({'error': message}), 500
+    return jsonify(api_job_view(download_id))
+
+def job_status_changes(seen):
+    """API views of the jobs newer than the versions a client has seen, and the ids that are unknown"""
+    changed, missing = {}, []
+    for download_id, version in seen.items():
+        info = download_progress.get(download_id)
+        if info is not None and info.get('version', 0) <= (version or 0):
+            continue
+        try:
+            changed[download_id] = api_job_view(download_id)
+        except KeyError:
+            # Unknown, or cleaned up in the meantime
+            missing.append(download_id)
+    return changed, missing
+
+@app.route('/api/status', methods=['POST'])
+def api_job_status():
+    """Return the jobs that changed since the versions a client has seen: {"jobs": {"<id>": <version>}, "wait": <seconds>}"""
+    global job_status_waiters
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('jobs'), (dict, list)):
+        return jsonify({'error': 'Expected {"jobs": {"<id>": <last seen version>, ...}}'}), 400
+    seen = data['jobs'] if isinstance(data['jobs'], dict) else dict.fromkeys(data['jobs'], 0)
+    if len(seen) > STATUS_MAX_JOBS:
+        return jsonify({'error': f'At most {STATUS_MAX_JOBS} jobs per request'}), 400
+    if not all(isinstance(download_id, str) for download_id in seen) or \
+            any(isinstance(version, bool) or not isinstance(version, (int, type(None))) for version in seen.values()):
+        return jsonify({'error': 'Job ids must be strings and versions integers or null'}), 400
+    wait = data.get('wait', 0)
+    if isinstance(wait, bool) or not isinstance(wait, (int, float)) or wait < 0:
+        return jsonify({'error': 'wait must be a non-negative number of seconds'}), 400
+    
+    def has_news(changed, missing):
+        # A job the client has seen before that is gone now is news as well
+        return changed or any(seen[download_id] for download_id in missing)
+    
+    # Register as a waiter before the first look, so no change can slip in between
+    waiting = False
+    if wait > 0:
+        with job_status_condition:
+            if job_status_waiters < STATUS_MAX_WAITERS:
+                job_status_waiters += 1
+                generation = job_status_generation
+                waiting = True
+    try:
+        changed, missing = job_status_changes(seen)
+        if wait > 0 and not waiting and not has_news(changed, missing):
+            # Every waiter slot is taken, so tell the client to back off rather than answer an empty poll at once
+            response = jsonify({'error': 'Too many waiting status requests', 'jobs': changed, 'missing': missing})
+            response.headers['Retry-After'] = str(STATUS_RETRY_AFTER)
+            return response, 429
+        deadline = time.monotonic() + min(wait, STATUS_MAX_WAIT)
+        while waiting and not has_news(changed, missing) and time.monotonic() < deadline:
+            with job_status_condition:
+                if job_status_generation == generation:
+                    job_status_condition.wait(max(0, deadline - time.monotonic()))
+                generation = job_status_generation
+            changed, missing = job_status_changes(seen)
+    finally:
+        if waiting:
+            with job_status_condition:
+                job_status_waiters -= 1
+    return jsonify({'jobs': changed, 'missing': missing})
+
+@app.route('/throughput')
+def throughput_statistics():
+    """Report the node's measured download and post-processing throughput"""
+    with throughput_lock:
+        measured = {kind: dict(entry) for kind, entry in throughput_estimates.items()}
+    return jsonify({kind: measured.get(kind, {'rate': prior, 'samples': 0, 'prior': True})
+                    for kind, prior in THROUGHPUT_PRIORS.items()})
+
+@app.route('/scheduler/stats')
+def scheduler_statistics():
+    """Report download slot usage and the per-client queues"""
+    with scheduler_lock:
+        clients = {client: {'weight': state['weight'], 'active': state['active'],
+                            'queued': len(state['queue']), 'jobs': len(state['jobs'])}
+                   for client, state in scheduler_clients.items()}
+        return jsonify({'slots': MAX_CONCURRENT_DOWNLOADS, 'active': len(slot_holders), 'clients': clients})
+
+@app.route('/identities/stats')
+def identity_statistics():
+    """Report the identity pool: runs in use, health and quarantine of each identity"""
+    with identity_condition:
+        reload_identity_pool(force=True)
+        now = time.time()
+        identities = {name: {'kind': identity['kind'], 'active': identity['active'],
+                             'health': round(identity['health'], 3),
+                             'successes': identity['successes'], 'failures': identity['failures'],
+                             'quarantined_for': max(0, int(identity['quarantined_until'] - now))}
+                      for name, identity in identity_pool.items()}
+    return jsonify({'directory': IDENTITY_DIR, 'max_concurrent': IDENTITY_MAX_CONCURRENT,
+                    'identities': identities})
+
+@app.route('/proxies/stats')
+def proxy_statistics():
+    """Report the proxy pool: runs in use, measured throughput, latency and error rate of each proxy"""
+    with proxy_condition:
+        now = time.time()
+        proxies = [{'proxy': proxy_label(proxy), 'active': proxy['active'], 'runs': proxy['runs'],
+                    'failures': proxy['failures'], 'error_rate': round(proxy['error_rate'], 3),
+                    'throughput': round(proxy['throughput']) if proxy['throughput'] is not None else None,
+                    'latency': round(proxy['latency'], 2) if proxy['latency'] is not None else None,
+                    'ejected_for': max(0, int(proxy['ejected_until'] - now))}
+                   for proxy in proxy_pool]
+    return jsonify({'max_concurrent': PROXY_MAX_CONCURRENT, 'proxies': proxies})
+
+@app.route('/stream_cache/stats')
+def stream_cache_statistics():
+    """Report stream cache usage and hit rate"""
+    with stream_cache_lock:
+        stats = dict(stream_cache_stats)
+        stats['streams'] = len(stream_cache)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+    stats['max_bytes'] = STREAM_CACHE_MAX_BYTES
+    stats['ttl'] = STREAM_CACHE_TTL
+    return jsonify(stats)
+
+@app.route('/speculation/stats')
+def speculation_statistics():
+    """Report how often speculative extractions and warmed streams were used, and the bytes wasted"""
+    expire_speculation()
+    with speculation_lock:
+        stats = dict(speculation_stats)
+        stats['pending_extractions'] = len(speculative_extractions)
+        stats['warming'] = sum(1 for warm in speculative_warming.values() if not warm['done'].is_set())
+    extractions = stats['extraction_hits'] + stats['extraction_misses']
+    warmings = stats['warm_hits'] + stats['warm_misses']
+    stats['extraction_hit_rate'] = round(stats['extraction_hits'] / extractions, 4) if extractions else 0.0
+    stats['warm_hit_rate'] = round(stats['warm_hits'] / warmings, 4) if warmings else 0.0
+    stats['mode'] = SPECULATION
+    stats['rate_limit'] = SPECULATION_RATE_LIMIT
+    return jsonify(stats)
+
+@app.route('/disk/stats')
+def disk_statistics():
+    """Report free space, the quota, outstanding disk reservations and the jobs held for disk space"""
+    # Only the scheduler's last measurement is reported, a dashboard polling this must not walk the storage
+    with scheduler_lock:
+        budget = disk_admission_budget()
+        stats = dict(disk_stats)
+        stats['reservations'] = len(disk_reservations)
+        stats['reserved_outstanding'] = sum(outstanding_reservation(download_id, reserved)
+                                            for download_id, reserved in disk_reservations.items())
+        stats['held'] = sum(1 for state in scheduler_clients.values()
+                            for ticket in state['queue'] if ticket.get('held_for_disk'))
+        # The storage roots are only measured against a quota
+        stats['used_bytes'] = disk_usage_cache['bytes'] if DISK_QUOTA_BYTES > 0 and disk_usage_cache['measured'] else None
+        stats['measured_age'] = round(time.time() - disk_usage_cache['measured'], 1) if disk_usage_cache['measured'] else None
+    stats['free_bytes'] = {tier: shutil.disk_usage(root).free for tier, root in STORAGE_ROOTS.items()}
+    stats['admission_budget'] = budget
+    stats['reserve_factor'] = DISK_RESERVE_FACTOR
+    stats['quota_bytes'] = DISK_QUOTA_BYTES
+    # How much of what was reserved finished jobs actually ended up using
+    stats['output_per_reserved'] = round(stats['output_bytes'] / stats['reserved_bytes'], 4) if stats['reserved_bytes'] else 0.0
+    return jsonify(stats)
+
+def run_self_test():
+    """Check the yt-dlp version and extract a known video end to end, and cache the result"""
+    started = time.time()
+    result = {'checked_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
     try:
         # Get yt-dlp version
-        result = subprocess.run(
-            ["yt-dlp", "--version"], capture_output=True, text=True
-        )
-        version = result.stdout.strip()
+        if USE_YTDLP_COMMAND:
+            version_result = subprocess.run(["yt-dlp", "--version"], capture_output=True, text=True, timeout=10)
+            version = version_result.stdout.strip()
+        else:
+            version = yt_dlp.version.__version__
         
-        # Try to get info for a test video
-        test_url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"  # A well-known video that's unlikely to be taken down
-        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
-            info = ydl.extract_info(test_url, download=False)
-            title = info.get('title', 'Unknown')
-            formats = len(info.get('formats', []))
+        # Extract a test video the way jobs do: in the library pool, with a pooled identity and proxy
+        info = get_video_info(SELF_TEST_URL)
         
-        return jsonify({
+        result.update({
             'status': 'success',
             'version': version,
             'test_video': {
-                'title': title,
-                'formats_available': formats
+                'title': info.get('title', 'Unknown'),
+                'formats_available': len(info.get('formats', []))
             },
             'message': f"yt-dlp {version} is working correctly"
         })
     except Exception as e:
-        app.logger.error(f"Error checking yt-dlp: {str(e)}", exc_info=True)
-        return jsonify({
+        app.logger.error(f"yt-dlp self-test failed: {str(e)}")
+        result.update({
             'status': 'error',
             'message': f"Error checking yt-dlp: {str(e)}"
-        }), 500
+        })
+    result['latency'] = round(time.time() - started, 3)
+    
+    with self_test_lock:
+        self_test_result.clear()
+        self_test_result.update(result)
+    app.logger.info(f"yt-dlp self-test: {result['status']} in {result['latency']}s")
+    return result
 
-if __name__ == '__main__':
+def self_test_loop():
+    """Run the self-test on a fixed schedule"""
+    while True:
+        run_self_test()
+        time.sleep(SELF_TEST_INTERVAL)
+
+def start_self_test_scheduler():
+    """Start the background self-test thread if it is not running yet"""
+    global self_test_thread
+    with self_test_lock:
+        if self_test_thread is None and SELF_TEST_INTERVAL > 0:
+            self_test_thread = threading.Thread(target=self_test_loop, name="self-test", daemon=True)
+            self_test_thread.start()
+
+@app.route('/healthz')
+def healthz():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: there is room in the job queues and on disk"""
+    checks = {}
+    
+    active_jobs = count_active_jobs()
+    checks['jobs'] = {'ok': active_jobs < READY_MAX_ACTIVE_JOBS, 'active': active_jobs, 'limit': READY_MAX_ACTIVE_JOBS}
+    
+    with postprocess_condition:
+        queued = len(postprocess_queue)
+    checks['postprocess_queue'] = {'ok': queued < READY_MAX_POSTPROCESS_QUEUE, 'queued': queued, 'limit': READY_MAX_POSTPROCESS_QUEUE}
+    
+    try:
+        free_bytes = shutil.disk_usage(STORAGE_ROOTS['media']).free
+        checks['disk'] = {'ok': free_bytes >= READY_MIN_FREE_BYTES, 'free_bytes': free_bytes, 'min_free_bytes': READY_MIN_FREE_BYTES}
+    except OSError as e:
+        checks['disk'] = {'ok': False, 'error': str(e)}
+    
+    ready = all(check['ok'] for check in checks.values())
+    return jsonify({'status': 'ready' if ready else 'not ready', 'checks': checks}), 200 if ready else 503
+
+@app.route('/check_ytdlp')
+def check_ytdlp():
+    """Report the last result of the background yt-dlp self-test"""
+    start_self_test_scheduler()
+    with self_test_lock:
+        result = dict(self_test_result)
+    
+    if not result:
+        return jsonify({'status': 'pending', 'message': "The first yt-dlp self-test is still running"}), 503
+    return jsonify(result), 200 if result['status'] == 'success' else 500
+
+def initialize_app():
+    """Start logging, create the storage directories, look for yt-dlp and pick up the stream cache.
+    
+    Kept out of the module body because library pool workers are spawned and
+    import this file again (as __mp_main__) while only needing library_worker.
+    """
+    global USE_YTDLP_COMMAND
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    
+    os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+    for storage_root in STORAGE_ROOTS.values():
+        os.makedirs(storage_root, exist_ok=True)
+    
+    # Log if credentials are available (without revealing them)
+    if USE_YOUTUBE_AUTH:
+        app.logger.info("YouTube credentials found in environment variables")
+    else:
+        app.logger.warning("No YouTube credentials found in environment variables")
+    if USE_YOUTUBE_COOKIES:
+        app.logger.info(f"YouTube cookies file found at {COOKIES_FILE}")
+    elif YOUTUBE_COOKIES:
+        app.logger.info("YouTube cookies found in environment variables but will not be used")
+    else:
+        app.logger.warning("No YouTube cookies found")
+    
+    USE_YTDLP_COMMAND = ytdlp_command_available()
+    app.logger.info(f"Using yt-dlp command line: {USE_YTDLP_COMMAND}")
+    
+    # Pick up streams cached before a restart
+    if STREAM_CACHE_MAX_BYTES:
+        load_stream_cache_index()
+
+if __name__ != '__mp_main__':
+    initialize_app()
+
+def migrate_storage_command(args):
+    """Move an existing flat download folder into the sharded layout"""
+    moved = migrate_flat_storage(args.tier, dry_run=args.dry_run)
+    action = "Would move" if args.dry_run else "Moved"
+    print(f"{action} {moved} file(s) into {STORAGE_SHARD_LEVELS}-level shards under {STORAGE_ROOTS[args.tier]}")
+
+def load_batch_manifest(path):
+    """The latest record of every URL in a batch manifest"""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run
+                continue
+            if isinstance(record, dict) and record.get('url'):
+                records[record['url']] = record
+    return records
+
+def run_batch_item(url, format_id=None, format_mode='video', policy=None, deadline=None):
+    """Download one URL through the regular job pipeline and return its manifest record"""
+    started = time.time()
+    record = {'url': url}
+    if not is_valid_youtube_url(url):
+        record.update(status='failed', error='Not a valid YouTube URL', error_class='invalid_url')
+    else:
+        download_id = str(uuid.uuid4())
+        file_stem = str(uuid.uuid4())
+        initialize_download_progress(download_id, file_stem, url, format_id)
+        download_progress[download_id].update({'url': url, 'format_id': format_id, 'format_mode': format_mode})
+        prepare_api_job(download_id, url, format_id, format_mode, file_stem, deadline, policy=policy)
+        
+        # Download and post-processing run on their own workers
+        while job_state(download_progress[download_id]) in ('queued', 'running'):
+            time.sleep(0.5)
+        # Nobody polls the job afterwards, so do not keep it in memory
+        info = download_progress.pop(download_id)
+        record.update(status=job_state(info), title=info.get('title'), format=info.get('format_id'),
+                      path=os.path.abspath(info['file_path']) if info.get('file_ready') else None,
+                      bytes=info.get('file_size'), error=info.get('error'), error_class=info.get('error_class'))
+    record['duration'] = round(time.time() - started, 1)
+    record['finished'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return record
+
+def batch_command(args):
+    """Download a list of URLs without the web interface, recording each result in a JSONL manifest"""
+    global CLIENT_MAX_ACTIVE_DOWNLOADS
+    # The batch is this process's only client, so it may use all download slots
+    CLIENT_MAX_ACTIVE_DOWNLOADS = max(CLIENT_MAX_ACTIVE_DOWNLOADS, args.jobs)
+    
+    source = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    with source:
+        urls = list(dict.fromkeys(line.strip() for line in source if line.strip() and not line.lstrip().startswith('#')))
+    recorded = load_batch_manifest(args.manifest)
+    pending = [url for url in urls
+               if url not in recorded or (args.retry_failed and recorded[url].get('status') != 'complete')]
+    print(f"{len(urls)} URL(s), {len(urls) - len(pending)} already in {args.manifest}, {len(pending)} to download")
+    
+    counts = {}
+    written = set()
+    with open(args.manifest, 'a', encoding='utf-8') as manifest:
+        def write_result(future):
+            # Records are appended as they finish, so an interrupted batch resumes where it stopped
+            record = future.result()
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+            written.add(future)
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+            print(f"[{len(written)}/{len(pending)}] {record['status']}: {record['url']} "
+                  f"{record.get('path') or record.get('error') or ''}".rstrip(), flush=True)
+        
+        policy = FORMAT_POLICIES[args.policy] if args.policy else None
+        executor = ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix='batch')
+        futures = [executor.submit(run_batch_item, url, args.format, args.mode, policy, args.deadline)
+                   for url in pending]
+        try:
+            for future in as_completed(futures):
+                write_result(future)
+        except KeyboardInterrupt:
+            print("Interrupted, finishing the running downloads (Ctrl-C again to abort)", flush=True)
+            for future in futures:
+                future.cancel()
+            for future in as_completed([f for f in futures if not f.cancelled() and f not in written]):
+                write_result(future)
+        executor.shutdown()
+    
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "Nothing to do")
+    if any(status != 'complete' for status in counts):
+        sys.exit(1)
+
+def count_active_jobs():
+    """Number of downloads that are still running or waiting for post-processing"""
+    return sum(1 for info in list(download_progress.values())
+               if not info.get('file_ready') and not info.get('error') and not info.get('cancelled'))
+
+def track_child_process(process, download_id):
+    """Remember a yt-dlp or ffmpeg process started for a job until it has exited"""
+    with child_processes_lock:
+        child_processes[process] = download_id
+
+def untrack_child_process(process):
+    """Forget a child process once it has exited"""
+    with child_processes_lock:
+        child_processes.pop(process, None)
+
+def stop_child_processes(timeout=CHILD_STOP_TIMEOUT):
+    """Terminate the tracked child processes, killing those that have not exited after timeout seconds"""
+    with child_processes_lock:
+        processes = list(child_processes.items())
+    for process, download_id in processes:
+        if process.poll() is None:
+            app.logger.info(f"Stopping {os.path.basename(process.args[0])} (pid {process.pid}) of {download_id}")
+            process.terminate()
+    deadline = time.time() + timeout
+    for process, download_id in processes:
+        try:
+            process.wait(max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            app.logger.warning(f"Killing pid {process.pid} of {download_id}, it did not exit in time")
+            process.kill()
+            process.wait()
+
+def wait_for_active_jobs(grace_period):
+    """Let in-flight downloads finish for up to grace_period seconds, then cancel what is left"""
+    deadline = time.time() + grace_period
+    active = count_active_jobs()
+    while active and time.time() < deadline:
+        app.logger.info(f"Waiting for {active} in-flight download(s) to finish...")
+        time.sleep(min(5, max(0.1, deadline - time.time())))
+        active = count_active_jobs()
+    
+    if active:
+        app.logger.warning(f"Grace period over, cancelling {active} download(s)")
+        for future in list(async_jobs.values()):
+            future.cancel()
+        cancelled = []
+        for download_id, info in list(download_progress.items()):
+            if not info.get('file_ready') and not info.get('error'):
+                info['status'] = 'Cancelled'
+                info['cancelled'] = True
+                cancelled.append(download_id)
+        # Thread-runner jobs only stop when their processes do; they must not outlive the server
+        stop_child_processes()
+        stop_library_pool()
+        for download_id in cancelled:
+            remove_staging_dir(download_id)
+
+def serve_command(args):
+    """Run the production WSGI server and shut down gracefully on SIGTERM/SIGINT"""
+    from waitress import create_server
+    
+    proxy_options = {}
+    if args.trusted_proxy:
+        # waitress then takes REMOTE_ADDR from the proxy's headers, so anonymous clients are
+        # told apart by their own address instead of all sharing the proxy's
+        proxy_options = {'trusted_proxy': args.trusted_proxy, 'trusted_proxy_count': args.trusted_proxy_count,
+                         'trusted_proxy_headers': args.trusted_proxy_headers, 'clear_untrusted_proxy_headers': True}
+    server = create_server(
+        app,
+        host=args.host,
+        port=args.port,
+        threads=args.threads,
+        connection_limit=args.connection_limit,
+        channel_timeout=args.channel_timeout,
+        backlog=args.backlog,
+        ident="EasyTube",
+        **proxy_options
+    )
+    
+    def handle_shutdown_signal(signum, frame):
+        # waitress stops its main loop on SystemExit
+        app.logger.info(f"Received signal {signum}, shutting down")
+        raise SystemExit(0)
+    
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    
+    start_self_test_scheduler()
+    app.logger.info(f"Serving on http://{args.host}:{args.port} with {args.threads} threads "
+                    f"(connection limit {args.connection_limit}, channel timeout {args.channel_timeout}s)")
+    if args.trusted_proxy:
+        app.logger.info(f"Trusting {args.trusted_proxy_headers} from {args.trusted_proxy} "
+                        f"({args.trusted_proxy_count} proxy hop(s))")
+    try:
+        server.run()
+    finally:
+        server.close()
+        wait_for_active_jobs(args.grace_period)
+        app.logger.info("Server stopped")
+
+def run_dev_server(args=None):
+    """Run the Flask development server"""
     port = int(os.environ.get("PORT", 5000))
     app.logger.info(f"Starting server on port {port}")
     
     # Log authentication methods available
-    if USE_YOUTUBE_COOKIES:
+    with identity_condition:
+        reload_identity_pool(force=True)
+    if identity_pool:
+        app.logger.info(f"Using {len(identity_pool)} identities from {IDENTITY_DIR}")
+    elif USE_YOUTUBE_COOKIES:
         app.logger.info(f"Using YouTube cookies from file: {COOKIES_FILE}")
     elif USE_YOUTUBE_AUTH:
         app.logger.info("Using YouTube username/password authentication")
     else:
         app.logger.warning("No YouTube authentication methods available")
     
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    start_self_test_scheduler()
+    app.run(host="0.0.0.0", port=port, debug=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="YouTube Downloader")
+    subparsers = parser.add_subparsers(dest='command')
+    
+    migrate_parser = subparsers.add_parser('migrate-storage', help="Move files from a flat download folder into shard directories")
+    migrate_parser.add_argument('--tier', default='media', choices=sorted(STORAGE_ROOTS), help="Storage tier to migrate")
+    migrate_parser.add_argument('--dry-run', action='store_true', help="Only report what would be moved")
+    migrate_parser.set_defaults(func=migrate_storage_command)
+    
+    serve_parser = subparsers.add_parser('serve', help="Run the production server")
+    serve_parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'), help="Interface to listen on")
+    serve_parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)), help="Port to listen on")
+    serve_parser.add_argument('--threads', type=int, default=int(os.environ.get('SERVER_THREADS', 16)),
+                              help="Worker threads handling requests")
+    serve_parser.add_argument('--connection-limit', type=int, default=int(os.environ.get('SERVER_CONNECTION_LIMIT', 1000)),
+                              help="Maximum number of open client connections")
+    serve_parser.add_argument('--channel-timeout', type=int, default=int(os.environ.get('SERVER_CHANNEL_TIMEOUT', 120)),
+                              help="Seconds an idle or keep-alive connection stays open")
+    serve_parser.add_argument('--backlog', type=int, default=int(os.environ.get('SERVER_BACKLOG', 1024)),
+                              help="Listen backlog for pending connections")
+    serve_parser.add_argument('--grace-period', type=int, default=int(os.environ.get('SHUTDOWN_GRACE_PERIOD', 300)),
+                              help="Seconds to let in-flight downloads finish on shutdown")
+    serve_parser.add_argument('--trusted-proxy', default=os.environ.get('TRUSTED_PROXY'),
+                              help="Address of the reverse proxy whose forwarding headers are trusted ('*' for any)")
+    serve_parser.add_argument('--trusted-proxy-count', type=int, default=int(os.environ.get('TRUSTED_PROXY_COUNT', 1)),
+                              help="Proxies in front of the server, counted from the right of X-Forwarded-For")
+    serve_parser.add_argument('--trusted-proxy-headers', default=os.environ.get('TRUSTED_PROXY_HEADERS', 'x-forwarded-for x-forwarded-proto'),
+                              help="Space-separated forwarding headers the trusted proxy sets")
+    serve_parser.set_defaults(func=serve_command)
+    
+    batch_parser = subparsers.add_parser('batch', help="Download a list of URLs without the web interface")
+    batch_parser.add_argument('input', nargs='?', default='-', help="File with one URL per line ('-' for stdin)")
+    batch_parser.add_argument('--manifest', default='manifest.jsonl',
+                              help="JSONL file results are appended to; URLs already in it are skipped")
+    batch_parser.add_argument('--retry-failed', action='store_true', help="Download URLs that failed in earlier runs again")
+    batch_parser.add_argument('--mode', default='video', choices=('video',) + AUDIO_MODES, help="What to download")
+    batch_parser.add_argument('--format', help="Format id, or 'auto' with --deadline; the best option by default")
+    batch_parser.add_argument('--policy', choices=sorted(FORMAT_POLICIES), help="Format selection policy (default FORMAT_POLICY)")
+    batch_parser.add_argument('--deadline', type=float, help="With --format auto, seconds each download should finish in")
+    batch_parser.add_argument('--jobs', type=int, default=4, help="URLs processed in parallel")
+    batch_parser.set_defaults(func=batch_command)
+    
+    args = parser.parse_args()
+    # Without a command, start the development server as before
+    getattr(args, 'func', run_dev_server)(args)
\ No newline at end of file
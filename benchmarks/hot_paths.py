@@ -0,0 +1,226 @@
+# file: benchmarks/hot_paths.py
+"""Microbenchmarks for the per-video and per-output-line hot paths of app.py.
+
+Covers format selection (extract_format_choices) on formats lists of 24, 72 and
+200 entries, yt-dlp output parsing (handle_download_output_line and
+update_progress_from_output) over captured progress logs, format_file_size and
+is_valid_youtube_url. For each benchmark it prints operations per second and
+the memory allocated per operation (tracemalloc peak).
+
+Throughput is also expressed relative to a fixed pure-Python calibration loop,
+so a baseline recorded on one machine remains meaningful on another. Each
+benchmark is warmed up first, then timed alternately with the calibration loop
+and the median ratio of those pairs counts, so a busy machine skews the result
+less. With --check the run fails (exit status 1) when a benchmark got slower,
+or allocates more, than the baseline by more than --threshold; a benchmark
+that looks slower is measured again before it is reported.
+
+    python benchmarks/hot_paths.py
+    python benchmarks/hot_paths.py --save-baseline
+    python benchmarks/hot_paths.py --check --threshold 0.5
+
+The fixtures in benchmarks/fixtures are modelled on yt-dlp's --dump-json and
+--newline output; benchmarks/record_fixtures.py captures new ones from real videos.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+BASELINE_PATH = os.path.join(BENCH_DIR, "hot_paths_baseline.json")
+
+FORMAT_FIXTURES = ["formats_24.json", "formats_72.json", "formats_200.json"]
+PROGRESS_FIXTURES = ["progress_dash.log", "progress_hls.log"]
+
+FILE_SIZES = [0, 512, 1023, 2048, 700 * 1024, 5 * 1024 ** 2, 740 * 1024 ** 2, 3 * 1024 ** 3, 17 * 1024 ** 3]
+URLS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "youtube.com/watch?v=dQw4w9WgXcQ&list=PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs&index=2",
+    "https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ?start=30",
+    "https://m.youtube.com/watch?app=desktop&v=dQw4w9WgXcQ",
+    "https://vimeo.com/76979871",
+    "not a url at all",
+    "https://www.youtube.com/@somechannel/videos",
+]
+
+
+def load_app():
+    """Import app.py from a scratch directory so it does not touch the real download folder"""
+    os.chdir(tempfile.mkdtemp(prefix="easytube-bench-"))
+    os.environ.setdefault("STREAM_CACHE_MAX_BYTES", "0")
+    sys.path.insert(0, APP_DIR)
+    import logging
+    logging.disable(logging.CRITICAL)
+    import app
+    return app
+
+
+def calibration():
+    """Fixed pure-Python workload the benchmark results are measured against"""
+    table = {}
+    for i in range(2000):
+        table[str(i)] = i * i
+    return sum(value for key, value in table.items() if key.endswith("7"))
+
+
+def build_benchmarks(app):
+    """(name, function) pairs; each function performs one operation"""
+    benchmarks = []
+    for fixture in FORMAT_FIXTURES:
+        with open(os.path.join(FIXTURE_DIR, fixture), encoding="utf-8") as f:
+            info = json.load(f)
+        formats, duration = info["formats"], info.get("duration")
+        for mode in ("video", "audio", "mp3"):
+            benchmarks.append((f"extract_format_choices[{fixture}, {mode}]",
+                               lambda formats=formats, mode=mode, duration=duration:
+                               app.extract_format_choices(formats, mode, duration=duration)))
+
+    download_id = "bench"
+    app.initialize_download_progress(download_id, "bench.mp4")
+    for fixture in PROGRESS_FIXTURES:
+        with open(os.path.join(FIXTURE_DIR, fixture), encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+        def parse_log(lines=lines):
+            stream_paths, error_lines = [], []
+            for line in lines:
+                app.handle_download_output_line(download_id, line, stream_paths, error_lines)
+
+        def update_log(lines=lines):
+            app.download_progress[download_id]['progress'] = 0
+            for line in lines:
+                app.update_progress_from_output(download_id, line)
+
+        benchmarks.append((f"handle_download_output_line[{fixture}, {len(lines)} lines]", parse_log))
+        benchmarks.append((f"update_progress_from_output[{fixture}, {len(lines)} lines]", update_log))
+
+    benchmarks.append((f"format_file_size[{len(FILE_SIZES)} sizes]",
+                       lambda: [app.format_file_size(size) for size in FILE_SIZES]))
+    benchmarks.append((f"is_valid_youtube_url[{len(URLS)} urls]",
+                       lambda: [app.is_valid_youtube_url(url) for url in URLS]))
+    return benchmarks
+
+
+def loops_for(func, min_time):
+    """Loop count that runs func for about min_time seconds (this also warms it up)"""
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return loops
+        loops *= 2 if elapsed < min_time / 4 else max(2, int(min_time / max(elapsed, 1e-9)))
+
+
+def timed_rate(func, loops):
+    """Operations per second of one timing run"""
+    started = time.perf_counter()
+    for _ in range(loops):
+        func()
+    return loops / (time.perf_counter() - started)
+
+
+def measure(func, min_time, repeats):
+    """Median ops/s and median throughput relative to the calibration loop.
+
+    Calibration and benchmark runs alternate, so a slowdown of the machine
+    during the measurement affects both sides of most pairs.
+    """
+    loops = loops_for(func, min_time)
+    calibration_loops = loops_for(calibration, min_time)
+    for _ in range(loops):
+        func()  # Warm-up at full length, loops_for may have started cold
+    rates, ratios = [], []
+    for _ in range(repeats):
+        reference = timed_rate(calibration, calibration_loops)
+        rate = timed_rate(func, loops)
+        rates.append(rate)
+        ratios.append(rate / reference)
+    return statistics.median(rates), statistics.median(ratios)
+
+
+def allocated_per_op(func, samples=5):
+    """Peak bytes allocated while one operation runs (smallest of a few samples)"""
+    func()  # Warm up caches so one-time allocations are not counted
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(samples):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        return min(peaks)
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per timing run")
+    parser.add_argument("--repeats", type=int, default=9, help="timing runs per benchmark (the median counts)")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 on regressions against the baseline")
+    parser.add_argument("--threshold", type=float, default=0.3,
+                        help="allowed slowdown or allocation growth as a fraction of the baseline")
+    args = parser.parse_args()
+
+    app = load_app()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["benchmarks"]
+
+    print(f"{'benchmark':<62}{'ops/s':>12}{'relative':>11}{'alloc B/op':>12}{'vs baseline':>13}")
+    results = {}
+    regressions = []
+    for name, func in build_benchmarks(app):
+        if args.filter not in name:
+            continue
+        rate, relative = measure(func, args.min_time, args.repeats)
+        allocated = allocated_per_op(func)
+
+        comparison = ""
+        previous = baseline.get(name)
+        if previous:
+            change = relative / previous["relative"] - 1
+            if change < -args.threshold:
+                # Measure again at twice the length before calling it a regression, once is often noise
+                rate, relative = max((rate, relative), measure(func, args.min_time, args.repeats * 2),
+                                     key=lambda result: result[1])
+                change = relative / previous["relative"] - 1
+            comparison = f"{change:+.1%}"
+            if change < -args.threshold:
+                regressions.append(f"{name}: {change:+.1%} throughput")
+            if allocated > previous["allocated"] * (1 + args.threshold) + 256:
+                regressions.append(f"{name}: {allocated} B/op allocated, baseline {previous['allocated']}")
+        results[name] = {"relative": relative, "allocated": allocated}
+        print(f"{name:<62}{rate:>12,.0f}{relative:>11.4f}{allocated:>12,}{comparison:>13}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "benchmarks": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print("\nRegressions beyond the threshold:")
+        for regression in regressions:
+            print(f"  {regression}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# file: benchmarks/record_fixtures.py
+"""Record benchmark fixtures for hot_paths.py from a real video.
+
+Saves the video's formats list (without stream URLs, fragments and headers,
+which expire and only bloat the file) as formats_<count>.json, and with
+--progress-log also downloads the given format and saves yt-dlp's --newline
+output as the progress log. Runs the same yt-dlp app.py uses.
+
+    python benchmarks/record_fixtures.py "https://www.youtube.com/watch?v=..."
+    python benchmarks/record_fixtures.py "https://www.youtube.com/watch?v=..." --progress-log progress_dash.log -f 137+140
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Format fields that are never read by the code under benchmark
+DROPPED_FORMAT_KEYS = ("url", "manifest_url", "fragment_base_url", "fragments", "http_headers",
+                       "downloader_options", "hls_aes", "request_data")
+
+
+def record_formats(url):
+    """Dump a video's info and keep the fields the format selection reads"""
+    result = subprocess.run(["yt-dlp", "--dump-json", "--no-playlist", url],
+                            capture_output=True, text=True, check=True)
+    info = json.loads(result.stdout)
+    formats = [{key: value for key, value in fmt.items() if key not in DROPPED_FORMAT_KEYS}
+               for fmt in info.get("formats") or []]
+    path = os.path.join(FIXTURE_DIR, f"formats_{len(formats)}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"id": info.get("id"), "duration": info.get("duration"), "formats": formats}, f, indent=1)
+        f.write("\n")
+    return path
+
+
+def record_progress_log(url, format_id, name):
+    """Download a format into a scratch directory and keep yt-dlp's output lines"""
+    with tempfile.TemporaryDirectory(prefix="easytube-fixture-") as scratch:
+        result = subprocess.run(["yt-dlp", "--newline", "--no-playlist", "-f", format_id,
+                                 "-o", os.path.join(scratch, "%(id)s.f%(format_id)s.%(ext)s"), url],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        sys.exit(f"yt-dlp failed:\n{result.stdout}")
+    path = os.path.join(FIXTURE_DIR, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(result.stdout)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", help="video to record")
+    parser.add_argument("--progress-log", metavar="NAME", help="also record a download's output under this name")
+    parser.add_argument("-f", "--format", default="bestvideo[height<=720]+bestaudio",
+                        help="format to download for the progress log")
+    args = parser.parse_args()
+
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    print(f"Saved {record_formats(args.url)}")
+    if args.progress_log:
+        print(f"Saved {record_progress_log(args.url, args.format, args.progress_log)}")
+
+
+if __name__ == "__main__":
+    main()
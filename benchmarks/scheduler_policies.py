@@ -0,0 +1,149 @@
+# file: benchmarks/scheduler_policies.py
+"""Compare completion times of the download queue policies (FIFO vs. SJF with aging).
+
+Replays a synthetic job mix (MP3s, HD videos and a few 4K videos arriving at
+random from a number of clients) against a fixed number of download slots in
+simulated time. Jobs go through app.py's own scheduler: per-client queues
+served by deficit round-robin, with the policy ordering each client's queue,
+so the policy only reorders jobs of the same client. Prints mean, p95 and max
+completion time (arrival to finished download) overall and per job class.
+
+    python benchmarks/scheduler_policies.py
+    python benchmarks/scheduler_policies.py --load 0.95 --slots 8 --clients 2 --aging 2097152
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+import tempfile
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MB = 1024 * 1024
+
+# (class name, share of jobs, smallest size, largest size)
+JOB_MIX = [
+    ("mp3", 0.50, 5 * MB, 40 * MB),
+    ("hd", 0.35, 100 * MB, 800 * MB),
+    ("4k", 0.15, 2000 * MB, 4000 * MB),
+]
+
+
+def load_app():
+    """Import app.py from a scratch directory so it does not touch the real download folder"""
+    os.chdir(tempfile.mkdtemp(prefix="easytube-bench-"))
+    os.environ.setdefault("STREAM_CACHE_MAX_BYTES", "0")
+    sys.path.insert(0, APP_DIR)
+    import logging
+    logging.disable(logging.CRITICAL)
+    import app
+    return app
+
+
+class SimulatedClock:
+    """Stands in for the time module inside app.py, so the scheduler sees simulated time"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+def generate_jobs(count, load, slots, slot_rate, clients, seed):
+    """Random arrivals from random clients whose offered load is the given fraction of the slots' capacity"""
+    rng = random.Random(seed)
+    mean_size = sum(share * (low + high) / 2 for _, share, low, high in JOB_MIX)
+    arrival_rate = load * slots * slot_rate / mean_size
+    jobs = []
+    now = 0.0
+    for index in range(count):
+        now += rng.expovariate(arrival_rate)
+        pick = rng.random()
+        for name, share, low, high in JOB_MIX:
+            pick -= share
+            if pick <= 0:
+                break
+        jobs.append({"id": f"job-{index}", "class": name, "size": rng.uniform(low, high), "arrival": now,
+                     "client": f"client-{rng.randrange(clients)}"})
+    return jobs
+
+
+def simulate(app, policy, jobs, slot_rate):
+    """Run the jobs through app.py's scheduler in simulated time and return their completion times"""
+    clock = SimulatedClock()
+    real_time, app.time = app.time, clock
+    app.SCHEDULER_POLICY = policy
+    by_id = {job["id"]: job for job in jobs}
+    running = []  # heap of (finish time, job id)
+    completion = {}
+
+    def start(download_id):
+        heapq.heappush(running, (clock.now + by_id[download_id]["size"] / slot_rate, download_id))
+
+    try:
+        arrivals = iter(jobs)
+        job = next(arrivals, None)
+        while job or running:
+            # Advance to the next arrival or finished download
+            next_arrival = job["arrival"] if job else float("inf")
+            next_finish = running[0][0] if running else float("inf")
+            clock.now = min(next_arrival, next_finish)
+            if next_finish <= next_arrival:
+                _, download_id = heapq.heappop(running)
+                completion[download_id] = clock.now - by_id[download_id]["arrival"]
+                app.release_download_slot(download_id)
+                app.release_client_job(download_id)
+            else:
+                app.admit_client_job(job["id"], job["client"])
+                app.queue_download_ticket(job["id"], lambda granted, download_id=job["id"]: start(download_id),
+                                          job["size"])
+                job = next(arrivals, None)
+    finally:
+        app.time = real_time
+    return completion
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=5000, help="jobs per run")
+    parser.add_argument("--load", type=float, default=0.85, help="offered load as a fraction of capacity")
+    parser.add_argument("--slots", type=int, default=4, help="concurrent download slots")
+    parser.add_argument("--clients", type=int, default=4, help="clients the jobs come from")
+    parser.add_argument("--client-slots", type=int, help="download slots one client may hold (CLIENT_MAX_ACTIVE_DOWNLOADS)")
+    parser.add_argument("--slot-rate", type=float, default=20 * MB, help="bytes per second per slot")
+    parser.add_argument("--aging", type=float, help="SJF_AGING_BYTES_PER_SECOND to use")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    app = load_app()
+    if args.aging is not None:
+        app.SJF_AGING_BYTES_PER_SECOND = args.aging
+    if args.client_slots is not None:
+        app.CLIENT_MAX_ACTIVE_DOWNLOADS = args.client_slots
+    app.MAX_CONCURRENT_DOWNLOADS = args.slots
+    app.CLIENT_MAX_QUEUED_JOBS = args.jobs  # Nothing is rejected, every job is measured
+    app.DISK_RESERVE_FACTOR = 0  # Only the queue order is compared, not the local disk
+    jobs = generate_jobs(args.jobs, args.load, args.slots, args.slot_rate, args.clients, args.seed)
+
+    print(f"{args.jobs} jobs from {args.clients} clients, load {args.load:.2f}, {args.slots} slots at "
+          f"{args.slot_rate / MB:.0f} MiB/s ({app.CLIENT_MAX_ACTIVE_DOWNLOADS} per client), "
+          f"aging {app.SJF_AGING_BYTES_PER_SECOND / MB:.1f} MiB/s")
+    print(f"{'policy':<8}{'class':<8}{'mean s':>10}{'p95 s':>10}{'max s':>10}")
+    for name in app.SCHEDULER_POLICIES:
+        completion = simulate(app, name, jobs, args.slot_rate)
+        for job_class in ["all"] + [mix[0] for mix in JOB_MIX]:
+            times = [completion[job["id"]] for job in jobs if job_class in ("all", job["class"])]
+            print(f"{name:<8}{job_class:<8}{sum(times) / len(times):>10.1f}"
+                  f"{percentile(times, 0.95):>10.1f}{max(times):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# file: benchmarks/server_load.py
+"""Compare request throughput and latency of the dev server and the production server.
+
+Starts app.py in a temporary working directory, sends requests from a number of
+concurrent keep-alive clients and prints requests/s and latency percentiles.
+
+    python benchmarks/server_load.py --server dev
+    python benchmarks/server_load.py --server serve --threads 16
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def wait_for_port(port, timeout=60):
+    """Wait until something accepts connections on the port"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def start_server(kind, port, threads, workdir):
+    """Start app.py with the dev server or the production server"""
+    cmd = [sys.executable, APP_PATH]
+    if kind == "serve":
+        cmd += ["serve", "--host", "127.0.0.1", "--port", str(port), "--threads", str(threads)]
+    env = dict(os.environ, PORT=str(port))
+    process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, start_new_session=True)
+    wait_for_port(port)
+    return process
+
+
+def stop_server(process):
+    """Stop the server and the dev server's reloader child"""
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def run_client(port, path, count, latencies, errors):
+    """Send count requests over one keep-alive connection"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run_benchmark(port, path, requests, concurrency):
+    latencies = []
+    errors = []
+    per_client = max(1, requests // concurrency)
+    clients = [threading.Thread(target=run_client, args=(port, path, per_client, latencies, errors))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["dev", "serve"], default="serve")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--threads", type=int, default=16, help="Server threads (serve only)")
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--path", action="append", help="Paths to request (default: / and a status poll)")
+    args = parser.parse_args()
+
+    paths = args.path or ["/", "/download_status/benchmark"]
+    with tempfile.TemporaryDirectory() as workdir:
+        process = start_server(args.server, args.port, args.threads, workdir)
+        try:
+            # Warm up template caches and connections
+            run_benchmark(args.port, paths[0], 100, 4)
+            for path in paths:
+                result = run_benchmark(args.port, path, args.requests, args.concurrency)
+                print(f"{args.server:5s} {path:30s} {result['rps']:8.0f} req/s  "
+                      f"p50 {result['p50_ms']:6.1f} ms  p95 {result['p95_ms']:6.1f} ms  "
+                      f"p99 {result['p99_ms']:6.1f} ms  errors {result['errors']}")
+        finally:
+            stop_server(process)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# file: library_worker.py
+"""yt-dlp library work for the worker processes of app.py's library pool.
+
+Extraction and downloads through the yt-dlp Python library are CPU-heavy
+(signature deciphering, JSON parsing, per-chunk progress hooks) and would hold
+the GIL in the web process. app.py runs these functions in a process pool
+instead and receives download progress over a queue.
+"""
+import os
+import tempfile
+import threading
+import time
+
+import yt_dlp
+
+PROGRESS_INTERVAL = 0.25  # Seconds between relayed "downloading" updates per job
+PROGRESS_KEYS = ('status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+                 'speed', 'eta', 'elapsed', 'error', 'clip_position')
+CLIP_POSITION_PREFIX = 'out_time_us='  # Line of ffmpeg's -progress report with the position in microseconds
+
+progress_queue = None
+
+
+def init_worker(queue):
+    """Process pool initializer: remember the queue progress is relayed over"""
+    global progress_queue
+    progress_queue = queue
+
+
+def compact_progress(d):
+    """The part of a yt-dlp progress dict the web process uses (the full dict holds the info dict)"""
+    return {key: d[key] for key in PROGRESS_KEYS if d.get(key) is not None}
+
+
+def extract_info(url, ydl_opts):
+    """Extract a video's info dict, sanitized so it can be sent back to the web process"""
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except yt_dlp.utils.DownloadError as e:
+        # The original exception carries a traceback that cannot be pickled
+        raise yt_dlp.utils.DownloadError(str(e)) from None
+
+
+def watch_clip_progress(path, relay, stop):
+    """Relay the clip position from an ffmpeg -progress file until stop is set"""
+    offset = 0
+    while not stop.wait(PROGRESS_INTERVAL):
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                # Each stream's ffmpeg run starts the file over
+                if os.fstat(f.fileno()).st_size < offset:
+                    offset = 0
+                f.seek(offset)
+                report = f.read()
+                offset = f.tell()
+        except OSError:
+            continue
+        for line in reversed(report.splitlines()):
+            if line.startswith(CLIP_POSITION_PREFIX):
+                try:
+                    relay({'status': 'downloading', 'clip_position': int(line[len(CLIP_POSITION_PREFIX):]) / 1e6})
+                except ValueError:
+                    pass  # "N/A" until the first frame is written
+                break
+
+
+def download(job_id, url, info_path, ydl_opts, section=None, on_progress=None):
+    """Download the raw streams of a job and return their paths.
+
+    Progress goes to on_progress when given (in-process use), otherwise it is
+    relayed to the web process as (job_id, progress) tuples on the queue.
+    """
+    stream_paths = []
+    last_relayed = [0.0]
+
+    def relay(d):
+        progress = compact_progress(d)
+        if on_progress is not None:
+            on_progress(progress)
+            return
+        # Only every few hundred milliseconds, chunks arrive much faster than that
+        now = time.monotonic()
+        if progress.get('status') == 'downloading' and now - last_relayed[0] < PROGRESS_INTERVAL:
+            return
+        last_relayed[0] = now
+        if progress_queue is not None:
+            progress_queue.put((job_id, progress))
+
+    opts = dict(ydl_opts, progress_hooks=[relay], post_hooks=[stream_paths.append])
+    watcher = None
+    stop_watching = threading.Event()
+    if section:
+        # Fetch only the requested time range, cutting at exact times
+        opts['download_ranges'] = yt_dlp.utils.download_range_func(None, [tuple(section)])
+        opts['force_keyframes_at_cuts'] = True
+        # ffmpeg does the cutting and reports no progress hooks, so have it write a progress report
+        fd, progress_path = tempfile.mkstemp(prefix='clip-progress-', suffix='.txt')
+        os.close(fd)
+        opts['external_downloader_args'] = {'ffmpeg_o': ['-progress', progress_path, '-nostats']}
+        watcher = threading.Thread(target=watch_clip_progress, args=(progress_path, relay, stop_watching), daemon=True)
+        watcher.start()
+
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            if info_path:
+                # Reuse the cached extraction instead of fetching the page again
+                ydl.download_with_info_file(info_path)
+            else:
+                ydl.download([url])
+    except yt_dlp.utils.DownloadError as e:
+        raise yt_dlp.utils.DownloadError(str(e)) from None
+    finally:
+        if watcher is not None:
+            stop_watching.set()
+            watcher.join()
+            os.remove(progress_path)
+    return stream_paths
@@ -31,7 +31,7 @@ if not exist downloads (
 
 REM Run the application
 echo Starting YouTube Downloader...
-python app.py
+python app.py serve
 
 REM Deactivate virtual environment on exit
 call venv\Scripts\deactivate.bat
@@ -28,7 +28,7 @@ fi
 
 # Run the application
 echo "Starting YouTube Downloader..."
-python app.py
+python app.py serve
 
 # Deactivate virtual environment on exit
 deactivate 
\ No newline at end of file
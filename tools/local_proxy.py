@@ -0,0 +1,154 @@
+# file: tools/local_proxy.py
+"""A local HTTP proxy to try out the egress proxy pool (PROXY_POOL) without real proxies.
+
+Tunnels HTTPS (CONNECT) and forwards plain HTTP requests. It can be made slow
+or unreliable, so the pool's throughput/latency routing and the ejection of
+failing proxies can be watched on GET /proxies/stats. Run a few with different
+settings and list them in PROXY_POOL:
+
+    python tools/local_proxy.py --port 8901
+    python tools/local_proxy.py --port 8902 --rate 262144 --latency 1
+    python tools/local_proxy.py --port 8903 --fail 0.5
+    PROXY_POOL=http://127.0.0.1:8901,http://127.0.0.1:8902,http://127.0.0.1:8903 python app.py
+"""
+import argparse
+import http.client
+import http.server
+import random
+import select
+import socket
+import time
+import urllib.parse
+
+BUFFER_SIZE = 64 * 1024
+# Headers that belong to one connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade'}
+
+
+class Throttle:
+    """Sleeps as needed to keep a transfer at or below a rate in bytes per second (0 for unlimited)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.sent = 0
+
+    def account(self, num_bytes):
+        self.sent += num_bytes
+        if self.rate > 0:
+            ahead = self.sent / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def refuse(self):
+        """Apply the configured latency and decide whether this request fails"""
+        time.sleep(self.server.latency)
+        if random.random() < self.server.fail:
+            self.send_error(502, "Simulated proxy failure")
+            return True
+        return False
+
+    def do_CONNECT(self):
+        if self.refuse():
+            return
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=30)
+        except OSError as e:
+            self.send_error(502, f"Cannot reach {self.path}: {e}")
+            return
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        self.close_connection = True
+
+        # Shovel bytes both ways; only the download direction is throttled
+        throttle = Throttle(self.server.rate)
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, failed = select.select(sockets, [], sockets, 60)
+                if failed or not readable:
+                    break
+                for sock in readable:
+                    data = sock.recv(BUFFER_SIZE)
+                    if not data:
+                        return
+                    if sock is upstream:
+                        self.connection.sendall(data)
+                        throttle.account(len(data))
+                    else:
+                        upstream.sendall(data)
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+
+    def forward(self):
+        """Send a plain HTTP request on to its origin and stream the response back"""
+        if self.refuse():
+            return
+        url = urllib.parse.urlsplit(self.path)
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        headers = {key: value for key, value in self.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else None
+        try:
+            upstream = connection_class(url.netloc, timeout=30)
+            upstream.request(self.command, urllib.parse.urlunsplit(('', '', url.path or '/', url.query, '')),
+                             body=body, headers=headers)
+            response = upstream.getresponse()
+        except OSError as e:
+            self.send_error(502, f"Cannot reach {url.netloc}: {e}")
+            return
+
+        self.send_response(response.status, response.reason)
+        for key, value in response.getheaders():
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != 'content-length':
+                self.send_header(key, value)
+        # Without a length the end of the body is the end of the connection
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        throttle = Throttle(self.server.rate)
+        try:
+            while True:
+                data = response.read(BUFFER_SIZE)
+                if not data:
+                    break
+                self.wfile.write(data)
+                throttle.account(len(data))
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+
+    do_GET = do_POST = do_HEAD = do_PUT = do_DELETE = forward
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="interface to listen on")
+    parser.add_argument("--port", type=int, default=8901, help="port to listen on")
+    parser.add_argument("--rate", type=int, default=0, help="bytes per second per connection (0 for unlimited)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added before every request")
+    parser.add_argument("--fail", type=float, default=0.0, help="fraction of requests answered with 502")
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer((args.host, args.port), ProxyHandler)
+    server.daemon_threads = True
+    server.rate, server.latency, server.fail = args.rate, args.latency, args.fail
+    print(f"Proxy listening on http://{args.host}:{args.port} (rate {args.rate or 'unlimited'}, "
+          f"latency {args.latency}s, failing {args.fail:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()